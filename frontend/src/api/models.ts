@@ -1,7 +1,8 @@
 import { AIChatCompletion, AIChatCompletionDelta, AIChatCompletionOperationOptions } from "@microsoft/ai-chat-protocol";
 
 export const enum RetrievalMode {
-    Hybrid = "rag",
+    Rag = "rag",
+    Hybrid = "hybrid",
     Vectors = "vector",
     Text = "keyword"
 }
@@ -11,6 +12,7 @@ export type ChatAppRequestOverrides = {
     top?: number;
     temperature?: number;
     score_threshold?: number;
+    server_history?: boolean;
 };
 
 export type ChatAppRequestContext = {
@@ -43,6 +45,13 @@ export interface ChatCompletionResponse extends AIChatCompletion {
     context: ResponseContext;
 }
 
+export type StreamStage = {
+    name: "rephrasing" | "rephrased" | "retrieved";
+    elapsed_ms: number;
+    detail: string | null;
+};
+
 export interface ChatCompletionDeltaResponse extends AIChatCompletionDelta {
     context: ResponseContext;
+    stage?: StreamStage;
 }
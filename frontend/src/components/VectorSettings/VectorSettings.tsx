@@ -17,7 +17,7 @@ export const VectorSettings = ({ updateRetrievalMode, defaultRetrievalMode }: Pr
     const retrievalModeFieldId = useId();
 
     const onRetrievalModeChange = (_ev: SelectionEvents, data: OptionOnSelectData) => {
-        const mode = (data.optionValue as RetrievalMode) || RetrievalMode.Hybrid;
+        const mode = (data.optionValue as RetrievalMode) || RetrievalMode.Rag;
         setRetrievalMode(mode);
         updateRetrievalMode(mode);
     };
@@ -30,15 +30,18 @@ export const VectorSettings = ({ updateRetrievalMode, defaultRetrievalMode }: Pr
                 aria-labelledby={retrievalModeId}
                 selectedOptions={[retrievalMode.toString()]}
                 value={
-                    retrievalMode === RetrievalMode.Hybrid
+                    retrievalMode === RetrievalMode.Rag
                         ? "RAG with Vector Search"
-                        : retrievalMode === RetrievalMode.Vectors
-                          ? "Vector Search"
-                          : "Keyword Search"
+                        : retrievalMode === RetrievalMode.Hybrid
+                          ? "Hybrid Search"
+                          : retrievalMode === RetrievalMode.Vectors
+                            ? "Vector Search"
+                            : "Keyword Search"
                 }
                 onOptionSelect={onRetrievalModeChange}
             >
-                <Option value={RetrievalMode.Hybrid}>RAG with Vector Search</Option>
+                <Option value={RetrievalMode.Rag}>RAG with Vector Search</Option>
+                <Option value={RetrievalMode.Hybrid}>Hybrid Search</Option>
                 <Option value={RetrievalMode.Vectors}>Vector Search</Option>
                 <Option value={RetrievalMode.Text}>Keyword Search</Option>
             </Dropdown>
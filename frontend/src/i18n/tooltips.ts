@@ -8,6 +8,6 @@ export const toolTipText = {
     retrieveNumber:
         "Sets the number of search results to retrieve from Azure DocumentDB (with MongoDB compatibility). More results may increase the likelihood of finding the correct answer, but may lead to the model getting 'lost in the middle'.",
     retrievalMode:
-        "Sets the retrieval mode for the Azure DocumentDB (with MongoDB compatibility) query. `RAG with Vector Search` uses a combination of vector search and LLM rephrasing, `Vectors` uses only vector search, and `Text` uses only full text search.",
+        "Sets the retrieval mode for the Azure DocumentDB (with MongoDB compatibility) query. `RAG with Vector Search` uses a combination of vector search and LLM rephrasing, `Hybrid` fuses vector and full text search, `Vectors` uses only vector search, and `Text` uses only full text search.",
     streamChat: "Continuously streams the response to the chat UI as it is generated."
 };
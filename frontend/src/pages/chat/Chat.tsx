@@ -37,7 +37,7 @@ const Chat = () => {
     const [temperature, setTemperature] = useState<number>(0.3);
     const [retrieveCount, setRetrieveCount] = useState<number>(3);
     const [scoreThreshold, setScoreThreshold] = useState<number>(0);
-    const [retrievalMode, setRetrievalMode] = useState<RetrievalMode>(RetrievalMode.Hybrid);
+    const [retrievalMode, setRetrievalMode] = useState<RetrievalMode>(RetrievalMode.Rag);
 
     const lastQuestionRef = useRef<string>("");
     const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
@@ -119,14 +119,17 @@ const Chat = () => {
                 { content: a[1].message.content, role: "assistant" }
             ]);
 
-            const allMessages: AIChatMessage[] = [...messages, { content: question, role: "user" }];
+            // Once the server knows the session it keeps the conversation, so only the new question is sent.
+            const newMessage: AIChatMessage = { content: question, role: "user" };
+            const allMessages: AIChatMessage[] = sessionState ? [newMessage] : [...messages, newMessage];
             const options: ChatAppRequestOptions = {
                 context: {
                     overrides: {
                         top: retrieveCount,
                         retrieval_mode: retrievalMode,
                         temperature: temperature,
-                        score_threshold: scoreThreshold
+                        score_threshold: scoreThreshold,
+                        server_history: true
                     }
                 },
                 sessionState: sessionState ? sessionState : null
@@ -169,6 +172,7 @@ const Chat = () => {
         setActiveAnalysisPanelTab(undefined);
         setAnswers([]);
         setStreamedAnswers([]);
+        setSessionState(null);
         setIsLoading(false);
         setIsStreaming(false);
     };
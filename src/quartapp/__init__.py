@@ -6,6 +6,7 @@ from .approaches import (
     Context,
     DatabaseSetup,
     DataPoint,
+    Hybrid,
     KeyWord,
     Message,
     OpenAISetup,
@@ -28,6 +29,7 @@ __all__ = [
     "create_app",
     "DatabaseSetup",
     "DataPoint",
+    "Hybrid",
     "KeyWord",
     "Message",
     "OpenAISetup",
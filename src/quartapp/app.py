@@ -1,12 +1,17 @@
+import asyncio
 import logging
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import aclosing
+from dataclasses import dataclass
 from json import dumps
 from pathlib import Path
 from typing import Any
+from uuid import uuid4
 
 from quart import Quart, Response, jsonify, make_response, request, send_file, send_from_directory
 
-from quartapp.approaches.schemas import RetrievalResponse, RetrievalResponseDelta
+from quartapp.approaches.schemas import AIChatRoles, Message, RetrievalResponse, RetrievalResponseDelta
+from quartapp.approaches.stream_replay import ReplayGapError
 from quartapp.config import AppConfig
 
 logging.basicConfig(
@@ -16,18 +21,198 @@ logging.basicConfig(
 )
 
 
-async def format_as_ndjson(r: AsyncGenerator[RetrievalResponseDelta, None]) -> AsyncGenerator[str, None]:
+def is_message_delta(event: RetrievalResponseDelta) -> bool:
+    return event.delta is not None and event.context is None and not event.sessionState and event.stage is None
+
+
+def delta_line(message: Message) -> str:
+    """
+    Serialize a message-only delta, with the same output as `dumps(RetrievalResponseDelta(delta=message).to_dict())`
+    but without building the dictionaries.
+    """
+    return (
+        '{"context": null, "delta": {"content": '
+        + dumps(message.content, ensure_ascii=False)
+        + ', "role": '
+        + dumps(message.role)
+        + '}, "sessionState": null}\n'
+    )
+
+
+class DeltaCoalescer:
+    """
+    Merges consecutive message deltas into single NDJSON lines (see `format_as_ndjson`).
+
+    Adding a token only appends it to a list: lines are built when the merged tokens reach `coalesce_chars`
+    characters, when the timer started by their first token fires after `coalesce_ms`, or when another kind of
+    event arrives, and `ready` is set so the response writes them.
+    """
+
+    def __init__(self, coalesce_ms: float, coalesce_chars: int):
+        self._loop = asyncio.get_running_loop()
+        self._coalesce_ms = coalesce_ms
+        self._coalesce_chars = coalesce_chars
+        self._lines: list[str] = []
+        self._tokens: list[str] = []
+        self._chars = 0
+        self._role = AIChatRoles.ASSISTANT
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def add(self, event: RetrievalResponseDelta) -> None:
+        if not is_message_delta(event):
+            self.flush()
+            self._lines.append(dumps(event.to_dict(), ensure_ascii=False) + "\n")
+            self.ready.set()
+            return
+        assert event.delta is not None
+        if self._tokens and event.delta.role != self._role:
+            self.flush()
+        if not self._tokens:
+            self._role = event.delta.role
+            if self._coalesce_ms > 0:
+                self._flush_timer = self._loop.call_later(self._coalesce_ms / 1000, self.flush)
+        content = event.delta.content or ""
+        self._tokens.append(content)
+        self._chars += len(content)
+        if self._coalesce_chars > 0 and self._chars >= self._coalesce_chars:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._tokens:
+            self._lines.append(delta_line(Message(content="".join(self._tokens), role=self._role)))
+            self._tokens.clear()
+            self._chars = 0
+            self.ready.set()
+
+    def close(self) -> None:
+        self.flush()
+        self.closed = True
+        self.ready.set()
+
+    def take(self) -> list[str]:
+        lines, self._lines = self._lines, []
+        self.ready.clear()
+        return lines
+
+
+async def coalesce_as_ndjson(
+    r: AsyncGenerator[RetrievalResponseDelta, None], coalesce_ms: float, coalesce_chars: int
+) -> AsyncGenerator[str, None]:
+    coalescer = DeltaCoalescer(coalesce_ms, coalesce_chars)
+
+    async def read_stream() -> None:
+        try:
+            async for event in r:
+                coalescer.add(event)
+        finally:
+            coalescer.close()
+
+    # The stream is read in its own task, so the response only wakes up when there is a line to write.
+    reader = asyncio.ensure_future(read_stream())
+    try:
+        while not coalescer.closed:
+            await coalescer.ready.wait()
+            for line in coalescer.take():
+                yield line
+        # Raises the error that ended the stream, if any.
+        await reader
+    finally:
+        reader.cancel()
+        await asyncio.wait({reader})
+
+
+async def format_as_ndjson(
+    r: AsyncGenerator[RetrievalResponseDelta, None], coalesce_ms: float = 0, coalesce_chars: int = 0
+) -> AsyncGenerator[str, None]:
     """
     Format the response as NDJSON
+
+    With `coalesce_ms` or `coalesce_chars` set, consecutive message deltas are merged into a single line, written
+    once it holds `coalesce_chars` characters or `coalesce_ms` after its first delta, whichever comes first. Any
+    other event flushes the merged deltas before it is written.
     """
     try:
-        async for event in r:
-            yield dumps(event.to_dict(), ensure_ascii=False) + "\n"
+        # Close the stream as soon as the response is, so a client disconnecting also stops the generation.
+        async with aclosing(r):
+            if coalesce_ms > 0 or coalesce_chars > 0:
+                async with aclosing(coalesce_as_ndjson(r, coalesce_ms, coalesce_chars)) as lines:
+                    async for line in lines:
+                        yield line
+            else:
+                async for event in r:
+                    if is_message_delta(event):
+                        assert event.delta is not None
+                        yield delta_line(event.delta)
+                    else:
+                        yield dumps(event.to_dict(), ensure_ascii=False) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield dumps({"error": str(error)}, ensure_ascii=False) + "\n"
 
 
+async def format_as_sse(key: str, events: AsyncIterator[tuple[int, str]]) -> AsyncGenerator[str, None]:
+    """
+    Format buffered NDJSON lines as Server-Sent Events, with ids a client can resume from
+    """
+    try:
+        async for event_id, line in events:
+            yield f"id: {key}:{event_id}\ndata: {line.rstrip()}\n\n"
+    except ReplayGapError as error:
+        yield f"event: error\ndata: {dumps({'error': str(error)})}\n\n"
+
+
+def sse_response_headers() -> dict[str, str]:
+    return {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+
+
+@dataclass
+class ChatRequest:
+    """The body of a request to the chat routes, with the defaults of the overrides applied."""
+
+    messages: list
+    session_state: str | None
+    retrieval_mode: str
+    temperature: float
+    top: int
+    score_threshold: float
+    server_history: bool
+
+
+async def read_chat_request() -> ChatRequest | tuple[Response, int]:
+    """Parse the body of a chat request, or return the error response for a malformed one."""
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+
+    # Get the request body
+    body = await request.get_json()
+
+    if not body:
+        return jsonify({"error": "request body is empty"}), 400
+
+    # Get the request message
+    messages: list = body.get("messages", [])
+
+    if not messages and len(messages) == 0:
+        return jsonify({"error": "request must have a message"}), 400
+
+    # Get the overrides from the context
+    override = body.get("context", {}).get("overrides", {})
+    return ChatRequest(
+        messages=messages,
+        session_state=body.get("sessionState", body.get("session_state")),
+        retrieval_mode=override.get("retrieval_mode", "vector"),
+        temperature=override.get("temperature", 0.3),
+        top=override.get("top", 3),
+        score_threshold=override.get("score_threshold", 0),
+        server_history=override.get("server_history", False),
+    )
+
+
 def create_app(test_config: dict[str, Any] | None = None) -> Quart:
     app_config = AppConfig()
 
@@ -37,10 +222,27 @@ def create_app(test_config: dict[str, Any] | None = None) -> Quart:
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    @app.before_serving
+    async def start_background_tasks() -> None:
+        app_config.setup.start()
+
+    @app.after_serving
+    async def close_database() -> None:
+        await app_config.wait_for_history_writes()
+        await app_config.setup.close()
+
     available_approaches = {
         "vector": app_config.run_vector,
         "rag": app_config.run_rag,
         "keyword": app_config.run_keyword,
+        "hybrid": app_config.run_hybrid,
+    }
+
+    streaming_approaches = {
+        "vector": app_config.run_vector_stream,
+        "rag": app_config.run_rag_stream,
+        "keyword": app_config.run_keyword_stream,
+        "hybrid": app_config.run_hybrid_stream,
     }
 
     @app.route("/")
@@ -61,42 +263,30 @@ def create_app(test_config: dict[str, Any] | None = None) -> Quart:
     async def hello() -> Response:
         return jsonify({"answer": "Hello, World!"})
 
+    if app_config.stats_endpoint:
+        # Not authenticated, so only enabled on deployments that are not publicly reachable.
+        @app.route("/stats", methods=["GET"])
+        async def stats() -> Response:
+            return jsonify(app_config.stats())
+
     @app.route("/chat", methods=["POST"])
     async def chat() -> Any:
-        if not request.is_json:
-            return jsonify({"error": "request must be json"}), 415
-
-        # Get the request body
-        body = await request.get_json()
-
-        if not body:
-            return jsonify({"error": "request body is empty"}), 400
-
-        # Get the request message
-        messages: list = body.get("messages", [])
-
-        if not messages and len(messages) == 0:
-            return jsonify({"error": "request must have a message"}), 400
+        chat_request = await read_chat_request()
+        if not isinstance(chat_request, ChatRequest):
+            return chat_request
+        messages = chat_request.messages
 
-        # Get the request session_state, context from the request body
-        session_state = body.get("sessionState", None)
-        context = body.get("context", {})
-
-        # Get the overrides from the context
-        override = context.get("overrides", {})
-        retrieval_mode: str = override.get("retrieval_mode", "vector")
-        temperature: float = override.get("temperature", 0.3)
-        top: int = override.get("top", 3)
-        score_threshold: float = override.get("score_threshold", 0)
-
-        if approach := available_approaches.get(retrieval_mode):
+        if approach := available_approaches.get(chat_request.retrieval_mode):
             try:
+                # The client only sent its newest message; the rest of the conversation is kept server-side.
+                if chat_request.server_history:
+                    messages = await app_config.with_server_history(chat_request.session_state, messages)
                 response: RetrievalResponse = await approach(
-                    session_state=session_state,
+                    session_state=chat_request.session_state,
                     messages=messages,
-                    temperature=temperature,
-                    limit=top,
-                    score_threshold=score_threshold,
+                    temperature=chat_request.temperature,
+                    limit=chat_request.top,
+                    score_threshold=chat_request.score_threshold,
                 )
             except Exception as error:
                 logging.exception("Exception while generating response: %s", error)
@@ -106,45 +296,82 @@ def create_app(test_config: dict[str, Any] | None = None) -> Quart:
 
     @app.route("/chat/stream", methods=["POST"])
     async def stream_chat() -> Any:
-        if not request.is_json:
-            return jsonify({"error": "request must be json"}), 415
-
-        # Get the request body
-        body = await request.get_json()
-
-        if not body:
-            return jsonify({"error": "request body is empty"}), 400
-
-        # Get the request message
-        messages: list = body.get("messages", [])
-
-        if not messages and len(messages) == 0:
-            return jsonify({"error": "request must have a message"}), 400
-
-        # Get the request session_state, context from the request body
-        session_state = body.get("session_state", None)
-        context = body.get("context", {})
+        chat_request = await read_chat_request()
+        if not isinstance(chat_request, ChatRequest):
+            return chat_request
+        messages = chat_request.messages
+        session_state = chat_request.session_state
 
-        # Get the overrides from the context
-        override = context.get("overrides", {})
-        retrieval_mode: str = override.get("retrieval_mode", "vector")
-        temperature: float = override.get("temperature", 0.3)
-        top: int = override.get("top", 3)
-        score_threshold: float = override.get("score_threshold", 0)
-
-        if retrieval_mode == "rag":
-            result: AsyncGenerator[RetrievalResponseDelta, None] = app_config.run_rag_stream(
+        if stream_approach := streaming_approaches.get(chat_request.retrieval_mode):
+            try:
+                # The client only sent its newest message; the rest of the conversation is kept server-side.
+                if chat_request.server_history:
+                    messages = await app_config.with_server_history(session_state, messages)
+            except Exception as error:
+                logging.exception("Exception while loading the chat history: %s", error)
+                return jsonify({"error": str(error)}), 500
+            result: AsyncGenerator[RetrievalResponseDelta, None] = stream_approach(
                 session_state=session_state,
                 messages=messages,
-                temperature=temperature,
-                limit=top,
-                score_threshold=score_threshold,
+                temperature=chat_request.temperature,
+                limit=chat_request.top,
+                score_threshold=chat_request.score_threshold,
+            )
+            response = await make_response(
+                format_as_ndjson(result, app_config.setup.stream_coalesce_ms, app_config.setup.stream_coalesce_chars)
             )
-            response = await make_response(format_as_ndjson(result))
             response.mimetype = "application/x-ndjson"
             return response
         return jsonify({"error": "Not Implemented!"}), 501
 
+    @app.route("/chat/sse", methods=["GET", "POST"])
+    async def sse_chat() -> Any:
+        replay = app_config.setup.stream_replay
+
+        # A reconnecting client resumes the answer it was receiving, without asking the question again.
+        last_event_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+        if last_event_id:
+            key, _, after = last_event_id.rpartition(":")
+            stream = replay.resume(key) if key and after.isdigit() else None
+            if stream is None:
+                return jsonify({"error": "stream not found or expired"}), 404
+            if not stream.can_resume(int(after)):
+                return jsonify({"error": "events after Last-Event-ID are no longer buffered"}), 409
+            return await make_response(format_as_sse(key, stream.follow(int(after))), sse_response_headers())
+        if request.method == "GET":
+            return jsonify({"error": "Last-Event-ID is required to resume a stream"}), 400
+
+        chat_request = await read_chat_request()
+        if not isinstance(chat_request, ChatRequest):
+            return chat_request
+        messages = chat_request.messages
+        session_state = chat_request.session_state
+
+        if stream_approach := streaming_approaches.get(chat_request.retrieval_mode):
+            try:
+                # The client only sent its newest message; the rest of the conversation is kept server-side.
+                if chat_request.server_history:
+                    messages = await app_config.with_server_history(session_state, messages)
+            except Exception as error:
+                logging.exception("Exception while loading the chat history: %s", error)
+                return jsonify({"error": str(error)}), 500
+            result: AsyncGenerator[RetrievalResponseDelta, None] = stream_approach(
+                session_state=session_state,
+                messages=messages,
+                temperature=chat_request.temperature,
+                limit=chat_request.top,
+                score_threshold=chat_request.score_threshold,
+            )
+            # The answer is produced into the replay buffer and keeps going if the client drops the connection.
+            # A new conversation has no sessionState yet, so its buffer gets a key of its own.
+            key = session_state or str(uuid4())
+            stream = replay.start(
+                key,
+                format_as_ndjson(result, app_config.setup.stream_coalesce_ms, app_config.setup.stream_coalesce_chars),
+            )
+            return await make_response(format_as_sse(key, stream.follow()), sse_response_headers())
+        return jsonify({"error": "Not Implemented!"}), 501
+
     return app
 
 
@@ -1,4 +1,5 @@
 from .base import ApproachesBase
+from .hybrid import Hybrid
 from .keyword import KeyWord
 from .rag import RAG
 from .schemas import (
@@ -20,6 +21,7 @@ __all__ = [
     "Context",
     "DatabaseSetup",
     "DataPoint",
+    "Hybrid",
     "KeyWord",
     "Message",
     "OpenAISetup",
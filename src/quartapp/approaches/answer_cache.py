@@ -0,0 +1,148 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from langchain_core.documents import Document
+from pymongo.errors import PyMongoError
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.utils import cosine_similarity, document_id
+
+DocumentsKey = tuple[tuple[str, ...], float]
+
+
+def document_ids(documents: list[Document]) -> tuple[str, ...]:
+    return tuple(document_id(document) for document in documents)
+
+
+@dataclass
+class CachedAnswer:
+    embedding: list[float]
+    answer: str
+    created_at: float
+
+
+@dataclass
+class AnswerLookup:
+    """
+    Result of an answer cache lookup, kept so a miss can be stored once the answer is generated.
+    """
+
+    key: DocumentsKey
+    embedding: list[float]
+    answer: str | None = None
+    distance: float | None = None
+
+    def describe(self) -> str:
+        if self.answer is None:
+            return "miss"
+        return f"hit (distance {self.distance:.3f})"
+
+
+class AnswerCache:
+    """
+    Semantic cache of RAG answers.
+
+    An answer is reused when a new question retrieves the same documents, at the same temperature, and its
+    rephrased-question embedding is within `max_distance` cosine distance of a cached one. Entries expire after
+    `ttl_seconds` and the cache holds at most `max_size` answers. The whole cache is dropped when the data
+    version recorded in the metadata collection changes, which `scripts/add_data.py` bumps on every ingestion;
+    the version is read at most once every `version_poll_seconds`.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl_seconds: float | None = 3600,
+        max_distance: float = 0.05,
+        metadata_collection: AsyncCollection | None = None,
+        collection_name: str = "",
+        version_poll_seconds: float = 30,
+    ):
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._max_distance = max_distance
+        self._metadata_collection = metadata_collection
+        self._collection_name = collection_name
+        self._version_poll_seconds = version_poll_seconds
+        self._buckets: OrderedDict[DocumentsKey, list[CachedAnswer]] = OrderedDict()
+        self._size = 0
+        self._data_version: int | None = None
+        self._version_checked_at: float | None = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def clear(self) -> None:
+        self._buckets.clear()
+        self._size = 0
+
+    async def _check_data_version(self) -> None:
+        if self._metadata_collection is None:
+            return
+        now = time.monotonic()
+        if self._version_checked_at is not None and now - self._version_checked_at < self._version_poll_seconds:
+            return
+        self._version_checked_at = now
+        try:
+            metadata = await self._metadata_collection.find_one({"_id": self._collection_name}, {"data_version": 1})
+        except PyMongoError as error:
+            logging.warning("Could not read the data version, keeping cached answers: %s", error)
+            return
+        data_version = metadata.get("data_version", 0) if metadata else 0
+        if self._data_version is not None and data_version != self._data_version:
+            self.clear()
+            self.invalidations += 1
+        self._data_version = data_version
+
+    def _is_expired(self, cached_answer: CachedAnswer) -> bool:
+        return self._ttl_seconds is not None and time.monotonic() - cached_answer.created_at > self._ttl_seconds
+
+    async def lookup(self, embedding: list[float], documents: list[Document], temperature: float) -> AnswerLookup:
+        await self._check_data_version()
+        lookup = AnswerLookup(key=(document_ids(documents), temperature), embedding=embedding)
+
+        bucket = self._buckets.get(lookup.key, [])
+        live = [cached_answer for cached_answer in bucket if not self._is_expired(cached_answer)]
+        if len(live) != len(bucket):
+            self._size -= len(bucket) - len(live)
+            if live:
+                self._buckets[lookup.key] = live
+            else:
+                del self._buckets[lookup.key]
+
+        for cached_answer in live:
+            distance = 1 - cosine_similarity(embedding, cached_answer.embedding)
+            if distance <= self._max_distance and (lookup.distance is None or distance < lookup.distance):
+                lookup.answer, lookup.distance = cached_answer.answer, distance
+
+        if lookup.answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._buckets.move_to_end(lookup.key)
+        return lookup
+
+    def store(self, lookup: AnswerLookup, answer: str) -> None:
+        self._buckets.setdefault(lookup.key, []).append(CachedAnswer(lookup.embedding, answer, time.monotonic()))
+        self._buckets.move_to_end(lookup.key)
+        self._size += 1
+        while self._size > self._max_size:
+            # Evict the oldest answer of the least recently used documents.
+            oldest_key, oldest_bucket = next(iter(self._buckets.items()))
+            oldest_bucket.pop(0)
+            self._size -= 1
+            if not oldest_bucket:
+                del self._buckets[oldest_key]
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": self._size,
+            "max_size": self._max_size,
+            "invalidations": self.invalidations,
+        }
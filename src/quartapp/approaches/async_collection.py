@@ -0,0 +1,65 @@
+import asyncio
+from collections.abc import Mapping, Sequence
+from typing import Any
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, UpdateResult
+
+
+class AsyncCollection:
+    """
+    Awaitable facade over a synchronous pymongo Collection.
+
+    Every round-trip is run on the default executor so that request handlers never block the event loop,
+    while the underlying MongoClient stays a regular synchronous client that can be shared with the
+    LangChain vector store.
+    """
+
+    def __init__(self, collection: Collection):
+        self._collection = collection
+
+    @property
+    def collection(self) -> Collection:
+        return self._collection
+
+    async def find(
+        self,
+        filter: Mapping[str, Any],
+        projection: Mapping[str, Any] | None = None,
+        limit: int = 0,
+        sort: Sequence[tuple[str, Any]] | None = None,
+    ) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self._find, filter, projection, limit, sort)
+
+    def _find(
+        self,
+        filter: Mapping[str, Any],
+        projection: Mapping[str, Any] | None,
+        limit: int,
+        sort: Sequence[tuple[str, Any]] | None,
+    ) -> list[dict[str, Any]]:
+        # The cursor is drained inside the worker thread, getMore round-trips included.
+        return list(self._collection.find(filter, projection, sort=sort).limit(limit))
+
+    async def find_one(
+        self, filter: Mapping[str, Any], projection: Mapping[str, Any] | None = None
+    ) -> dict[str, Any] | None:
+        return await asyncio.to_thread(self._collection.find_one, filter, projection)
+
+    async def insert_one(self, document: Mapping[str, Any]) -> InsertOneResult:
+        return await asyncio.to_thread(self._collection.insert_one, document)
+
+    async def update_one(
+        self, filter: Mapping[str, Any], update: Mapping[str, Any], upsert: bool = False
+    ) -> UpdateResult:
+        return await asyncio.to_thread(self._collection.update_one, filter, update, upsert)
+
+    async def count_documents(self, filter: Mapping[str, Any]) -> int:
+        return await asyncio.to_thread(self._collection.count_documents, filter)
+
+    async def bulk_write(self, requests: Sequence[UpdateOne], ordered: bool = True) -> BulkWriteResult:
+        return await asyncio.to_thread(self._collection.bulk_write, requests, ordered)
+
+    async def delete_many(self, filter: Mapping[str, Any]) -> DeleteResult:
+        return await asyncio.to_thread(self._collection.delete_many, filter)
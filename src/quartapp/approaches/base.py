@@ -1,10 +1,18 @@
+import asyncio
+import logging
 from abc import ABC, abstractmethod
 
 from langchain_community.vectorstores import AzureCosmosDBVectorSearch
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_openai.chat_models.base import BaseChatOpenAI
-from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.local_index import LocalVectorIndex, is_missing_similarity_index_error
+from quartapp.approaches.schemas import LocalIndexMode
+from quartapp.approaches.utils import TEXT_SCORE, TEXT_SEARCH_PROJECTION
+from quartapp.approaches.vector_index import RecordedVectorIndex
 
 
 class ApproachesBase(ABC):
@@ -13,12 +21,81 @@ class ApproachesBase(ABC):
         vector_store: AzureCosmosDBVectorSearch,
         embedding: Embeddings,
         chat: BaseChatOpenAI,
-        data_collection: Collection,
+        data_collection: AsyncCollection,
+        local_index: LocalVectorIndex | None = None,
+        local_index_mode: LocalIndexMode = LocalIndexMode.OFF,
+        vector_index: RecordedVectorIndex | None = None,
     ):
         self._vector_store = vector_store
         self._embedding = embedding
         self._chat = chat
         self._data_collection = data_collection
+        self._local_index = local_index
+        self._local_index_mode = local_index_mode if local_index is not None else LocalIndexMode.OFF
+        self._vector_index = vector_index
+
+    async def _embed_query(self, query: str) -> list[float]:
+        return await self._embedding.aembed_query(query)
+
+    async def _text_search(self, query: str, limit: int) -> list[Document]:
+        # Best matches first, so the limit keeps them and hybrid fusion ranks them by relevance.
+        text_response = await self._data_collection.find(
+            {"$text": {"$search": query}},
+            {**TEXT_SEARCH_PROJECTION, "score": TEXT_SCORE},
+            limit=limit,
+            sort=[("score", TEXT_SCORE)],
+        )
+        documents: list[Document] = []
+        for document in text_response:
+            # Keep the _id so results can be matched with vector search results.
+            metadata = {**document["metadata"], "_id": document["_id"]} if "_id" in document else document["metadata"]
+            documents.append(Document(page_content=document["textContent"], metadata=metadata))
+        return documents
+
+    def _prefers_local_index(self) -> bool:
+        # Until the first load completes, queries go to Cosmos.
+        return (
+            self._local_index is not None
+            and self._local_index_mode == LocalIndexMode.PRIMARY
+            and self._local_index.loaded
+        )
+
+    def _search_local_index(self, embedding: list[float], limit: int, score_threshold: float) -> list[Document]:
+        assert self._local_index is not None
+        return [document for document, _ in self._local_index.search(embedding, limit, score_threshold)]
+
+    def _falls_back_on(self, error: OperationFailure) -> bool:
+        if self._local_index is None or not self._local_index.loaded or not is_missing_similarity_index_error(error):
+            return False
+        logging.warning("Vector index not found, serving the query from the local vector index")
+        self._local_index.fallbacks += 1
+        return True
+
+    async def _similarity_search(self, query: str, limit: int, score_threshold: float) -> list[Document]:
+        # Embed through our own embeddings (batched and cached) rather than the retriever, which embeds with the
+        # vector store's synchronous embed_query.
+        return await self._search_by_vector(await self._embed_query(query), limit, score_threshold)
+
+    async def _search_by_vector(self, embedding: list[float], limit: int, score_threshold: float) -> list[Document]:
+        if self._prefers_local_index():
+            return self._search_local_index(embedding, limit, score_threshold)
+
+        # Same search the similarity retriever runs, minus the embedding call, on the default executor. The pipeline
+        # has to match the kind of index the collection has, which the vector store alone assumes is IVF.
+        options = await self._vector_index.search_options(limit) if self._vector_index is not None else {}
+        try:
+            docs_and_scores = await asyncio.to_thread(
+                self._vector_store._similarity_search_with_score,
+                embedding,
+                k=limit,
+                score_threshold=score_threshold,
+                **options,
+            )
+        except OperationFailure as error:
+            if not self._falls_back_on(error):
+                raise
+            return self._search_local_index(embedding, limit, score_threshold)
+        return [document for document, _ in docs_and_scores]
 
     @abstractmethod
     async def run(
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+from langchain_core.embeddings import Embeddings
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that batches concurrent query embeddings.
+
+    Queries passed to `aembed_query` are held for at most `window_ms` after the first one arrives, or until
+    `max_batch_size` are waiting, and then embedded with a single `aembed_documents` call whose vectors are handed
+    back to each caller. Identical queries in a batch are embedded once. Synchronous calls and document embeddings
+    (used by ingestion) are passed straight through.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_batch_size: int = 16, window_ms: float = 5):
+        self._embeddings = embeddings
+        self._max_batch_size = max_batch_size
+        self._window_seconds = window_ms / 1000
+        self._pending: list[tuple[str, asyncio.Future[list[float]]]] = []
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self._requests: set[asyncio.Task] = set()
+        self.batches = 0
+        self.queries = 0
+        self.full_batches = 0
+        self.failed_batches = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embeddings
+
+    async def aembed_query(self, text: str) -> list[float]:
+        future: asyncio.Future[list[float]] = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self._max_batch_size:
+            self.full_batches += 1
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(self._window_seconds, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            request = asyncio.create_task(self._embed_batch(batch))
+            # Keep a reference until the request is done, the event loop only holds weak ones.
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+    async def _embed_batch(self, batch: list[tuple[str, asyncio.Future[list[float]]]]) -> None:
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.queries += len(batch)
+        try:
+            vectors = dict(zip(texts, await self._embeddings.aembed_documents(texts), strict=True))
+        except Exception as error:
+            self.failed_batches += 1
+            logging.warning("Could not embed a batch of %d queries: %s", len(texts), error)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for text, future in batch:
+            # A caller may have been cancelled while the batch was in flight.
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embeddings.embed_query(text)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self._embeddings.aembed_documents(texts)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+            "avg_batch_fill": round(self.queries / self.batches / self._max_batch_size, 3) if self.batches else 0.0,
+            "full_batches": self.full_batches,
+            "failed_batches": self.failed_batches,
+            "max_batch_size": self._max_batch_size,
+        }
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that caches query vectors.
+
+    Entries are keyed on the normalized query text together with the model and dimensions, kept in an
+    in-memory LRU bounded by `max_size` and optionally expired after `ttl_seconds`. When `path` is set the
+    vectors are also written to a SQLite file, so the cache survives restarts. Document embeddings (used by
+    ingestion) are passed straight through.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model: str,
+        dimensions: int | None = None,
+        max_size: int = 1024,
+        ttl_seconds: float | None = None,
+        path: str | None = None,
+    ):
+        self._embeddings = embeddings
+        self._model = model
+        self._dimensions = dimensions
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[list[float], float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db: sqlite3.Connection | None = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL)"
+            )
+            if ttl_seconds is not None:
+                self._db.execute("DELETE FROM embeddings WHERE created_at < ?", (time.time() - ttl_seconds,))
+            self._db.commit()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embeddings
+
+    def _key(self, text: str) -> str:
+        raw_key = f"{self._model}\x00{self._dimensions}\x00{normalize_query(text)}"
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self._ttl_seconds is not None and time.time() - created_at > self._ttl_seconds
+
+    def _remember(self, key: str, vector: list[float], created_at: float) -> None:
+        # Callers hold the lock.
+        self._entries[key] = (vector, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key: str) -> list[float] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[1]):
+                del self._entries[key]
+                entry = None
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._is_expired(row[1]):
+                    entry = (array("d", row[0]).tolist(), row[1])
+                    self._remember(key, *entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _store(self, key: str, vector: list[float]) -> None:
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, vector, created_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                    (key, array("d", vector).tobytes(), created_at),
+                )
+                self._db.commit()
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = self._embeddings.embed_query(text)
+            self._store(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        # Only the on-disk store does blocking I/O.
+        vector = await asyncio.to_thread(self._lookup, key) if self._db is not None else self._lookup(key)
+        if vector is None:
+            vector = await self._embeddings.aembed_query(text)
+            if self._db is not None:
+                await asyncio.to_thread(self._store, key, vector)
+            else:
+                self._store(key, vector)
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self._embeddings.aembed_documents(texts)
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_size": self._max_size,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import math
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+import tiktoken
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_openai.chat_models.base import BaseChatOpenAI
+
+TokenCounter = Callable[[str], int]
+
+SUMMARY_PROMPT = """\
+Summarize the conversation below between a user and a restaurant chatbot in at most 60 words. Keep the dishes, \
+preferences and constraints the user mentioned, since later questions may refer back to them.
+
+Earlier summary:
+{summary}
+
+Conversation:
+{conversation}
+
+Summary:"""
+
+
+def estimate_tokens(text: str) -> int:
+    # About four characters per token for English text with the OpenAI tokenizers.
+    return math.ceil(len(text) / 4)
+
+
+@functools.cache
+def token_counter(model: str) -> TokenCounter:
+    """Count tokens with the model's tokenizer, or estimate them when it cannot be loaded (e.g. offline)."""
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as error:
+        logging.warning("Could not load a tokenizer for %s, estimating token counts: %s", model, error)
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def format_message(message: dict[str, Any]) -> str:
+    return f"{message.get('role', 'user')}: {message.get('content', '')}"
+
+
+def prefix_keys(messages: list[dict[str, Any]]) -> list[str]:
+    """keys[i] identifies messages[: i + 1], so a summary can be found again from any later conversation."""
+    keys: list[str] = []
+    digest = ""
+    for message in messages:
+        digest = hashlib.sha256((digest + json.dumps(message, sort_keys=True, default=str)).encode()).hexdigest()
+        keys.append(digest)
+    return keys
+
+
+@dataclass
+class PackedHistory:
+    text: str
+    kept: int
+    dropped: int
+    summarized: int
+    tokens: int
+    unpacked_tokens: int
+
+    def describe(self) -> str:
+        summary = f", {self.summarized} summarized" if self.summarized else ""
+        return (
+            f"kept {self.kept} of {self.kept + self.dropped} messages{summary}, "
+            f"{self.tokens} tokens (saved {self.unpacked_tokens - self.tokens})"
+        )
+
+
+class HistoryPacker:
+    """
+    Fits the chat history of the rephrase prompt into a token budget.
+
+    Messages are written as `role: content` lines and the most recent ones that fit in `max_tokens` are kept. When a
+    chat model is given, dropped messages are folded into a rolling summary in the background; the summary is kept
+    in memory (at most `max_summaries`), keyed by the conversation prefix it covers, and takes the place of the
+    dropped messages on later turns. Token counts are compared with the dict repr the prompt used to embed.
+    """
+
+    def __init__(
+        self,
+        count_tokens: TokenCounter = estimate_tokens,
+        max_tokens: int = 1000,
+        chat: BaseChatOpenAI | None = None,
+        max_summaries: int = 256,
+    ):
+        self._count_tokens = count_tokens
+        self._max_tokens = max_tokens
+        self._chat = chat
+        self._max_summaries = max_summaries
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+        self._summarizing: dict[str, asyncio.Task] = {}
+        self.packs = 0
+        self.unpacked_tokens = 0
+        self.packed_tokens = 0
+        self.dropped_messages = 0
+        self.summaries_created = 0
+        self.summaries_used = 0
+        self.summary_failures = 0
+
+    def _latest_summary(self, keys: list[str], end: int) -> tuple[int, str | None]:
+        # The summary covering the longest prefix of messages[:end].
+        for covered in range(end, 0, -1):
+            summary = self._summaries.get(keys[covered - 1])
+            if summary is not None:
+                self._summaries.move_to_end(keys[covered - 1])
+                return covered, summary
+        return 0, None
+
+    def pack(self, chat_history: list[dict[str, Any]]) -> PackedHistory:
+        lines = [format_message(message) for message in chat_history]
+        line_tokens = [self._count_tokens(line) for line in lines]
+
+        # Keep the most recent messages that fit in the budget.
+        first_kept, tokens = len(lines), 0
+        while first_kept > 0 and tokens + line_tokens[first_kept - 1] <= self._max_tokens:
+            first_kept -= 1
+            tokens += line_tokens[first_kept]
+
+        summary_line, summarized = None, 0
+        if self._chat is not None and first_kept > 0:
+            keys = prefix_keys(chat_history)
+            covered, summary = self._latest_summary(keys, first_kept)
+            if summary is not None:
+                summary_line = f"summary of earlier messages: {summary}"
+                summary_tokens = self._count_tokens(summary_line)
+                # Make room for the summary by dropping the oldest kept messages, unless it would not fit anyway.
+                if summary_tokens <= self._max_tokens:
+                    while tokens + summary_tokens > self._max_tokens:
+                        tokens -= line_tokens[first_kept]
+                        first_kept += 1
+                    tokens += summary_tokens
+                    summarized = covered
+                    self.summaries_used += 1
+                else:
+                    summary_line = None
+            if covered < first_kept:
+                self._schedule_summary(keys[first_kept - 1], summary or "", lines[covered:first_kept])
+
+        kept_lines = lines[first_kept:]
+        packed = PackedHistory(
+            text="\n".join([summary_line, *kept_lines] if summary_line else kept_lines),
+            kept=len(kept_lines),
+            dropped=first_kept,
+            summarized=summarized,
+            tokens=tokens,
+            unpacked_tokens=self._count_tokens(str(chat_history)) if chat_history else 0,
+        )
+        self.packs += 1
+        self.unpacked_tokens += packed.unpacked_tokens
+        self.packed_tokens += packed.tokens
+        self.dropped_messages += packed.dropped
+        return packed
+
+    def _schedule_summary(self, key: str, previous_summary: str, lines: list[str]) -> None:
+        if key in self._summaries or key in self._summarizing:
+            return
+        task = asyncio.create_task(self._summarize(key, previous_summary, "\n".join(lines)))
+        self._summarizing[key] = task
+        task.add_done_callback(lambda _: self._summarizing.pop(key, None))
+
+    async def _summarize(self, key: str, previous_summary: str, conversation: str) -> None:
+        assert self._chat is not None
+        chain = ChatPromptTemplate.from_template(SUMMARY_PROMPT) | self._chat.bind(temperature=0)
+        try:
+            response = await chain.ainvoke({"summary": previous_summary or "(none)", "conversation": conversation})
+        except Exception as error:
+            self.summary_failures += 1
+            logging.warning("Could not summarize the chat history: %s", error)
+            return
+        self._summaries[key] = str(response.content)
+        while len(self._summaries) > self._max_summaries:
+            self._summaries.popitem(last=False)
+        self.summaries_created += 1
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "packs": self.packs,
+            "max_tokens": self._max_tokens,
+            "unpacked_tokens": self.unpacked_tokens,
+            "packed_tokens": self.packed_tokens,
+            "saved_tokens": self.unpacked_tokens - self.packed_tokens,
+            "saved_tokens_avg": round((self.unpacked_tokens - self.packed_tokens) / self.packs, 1) if self.packs else 0,
+            "dropped_messages": self.dropped_messages,
+            "summaries_created": self.summaries_created,
+            "summaries_used": self.summaries_used,
+            "summary_failures": self.summary_failures,
+        }
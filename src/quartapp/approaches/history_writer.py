@@ -0,0 +1,156 @@
+import asyncio
+import contextlib
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from quartapp.approaches.async_collection import AsyncCollection
+
+
+@dataclass
+class HistoryMutation:
+    """Messages to append to one chat session, stamped with the time of the request that produced them."""
+
+    session_id: str
+    messages: list[dict[str, Any]]
+    at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))  # noqa: UP017
+
+
+def merge_mutations(mutations: list[HistoryMutation]) -> list[tuple[dict[str, Any], dict[str, Any]]]:
+    """
+    Fold queued mutations into one upsert (filter, update) per session.
+
+    Messages keep their enqueue order, `updated_at` takes the latest stamp and `created_at` is only written by the
+    upsert that creates the session document.
+    """
+    merged: dict[str, tuple[list[dict[str, Any]], datetime, datetime]] = {}
+    for mutation in mutations:
+        messages, first_at, _ = merged.get(mutation.session_id, ([], mutation.at, mutation.at))
+        merged[mutation.session_id] = (messages + mutation.messages, first_at, mutation.at)
+    return [
+        (
+            {"_id": session_id},
+            {
+                "$push": {"messages": {"$each": messages}},
+                "$set": {"updated_at": last_at},
+                "$setOnInsert": {"created_at": first_at},
+            },
+        )
+        for session_id, (messages, first_at, last_at) in merged.items()
+    ]
+
+
+class HistoryWriter:
+    """
+    Write-behind queue for chat history.
+
+    Requests enqueue their messages and return; a background worker merges whatever is queued per session and
+    flushes it with a single unordered `bulk_write` (an `update_one` when only one session is queued) once
+    `max_batch_size` mutations are waiting or `flush_interval_seconds` after the first one arrived. The queue holds
+    at most `max_queue_size` mutations, after which `enqueue` waits for the worker to catch up. Until `start` is
+    called (and after `stop`), mutations are written inline, so the writer also works outside of a running app.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncCollection,
+        max_queue_size: int = 1000,
+        max_batch_size: int = 100,
+        flush_interval_seconds: float = 0.05,
+    ):
+        self._collection = collection
+        self._max_batch_size = max_batch_size
+        self._flush_interval_seconds = flush_interval_seconds
+        self._queue: asyncio.Queue[HistoryMutation] = asyncio.Queue(maxsize=max_queue_size)
+        self._worker: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.inline_writes = 0
+
+    async def _write(self, mutations: list[HistoryMutation]) -> None:
+        updates = merge_mutations(mutations)
+        if len(updates) == 1:
+            await self._collection.update_one(*updates[0], upsert=True)
+            return
+        await self._collection.bulk_write(
+            [UpdateOne(filter, update, upsert=True) for filter, update in updates], ordered=False
+        )
+
+    async def enqueue(self, mutation: HistoryMutation) -> None:
+        if self._worker is None:
+            # Not running: write inline and let the caller see any error.
+            await self._write([mutation])
+            self.inline_writes += 1
+            self.written += 1
+            return
+        # Blocks while the queue is full, which throttles requests to the rate Cosmos accepts writes.
+        await self._queue.put(mutation)
+        self.enqueued += 1
+        if self._queue.qsize() >= self._max_batch_size - 1:
+            self._wake.set()
+
+    async def _next_batch(self) -> list[HistoryMutation]:
+        batch = [await self._queue.get()]
+        if not self._stopping and self._queue.qsize() < self._max_batch_size - 1:
+            # Give the batch time to fill up; enqueue and stop cut the wait short.
+            self._wake.clear()
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self._flush_interval_seconds)
+        while len(batch) < self._max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+                self.written += len(batch)
+                self.batches += 1
+            except PyMongoError as error:
+                self.failed += len(batch)
+                logging.warning("Could not write %d chat history updates: %s", len(batch), error)
+            except Exception:
+                self.failed += len(batch)
+                logging.exception("Unexpected error while writing chat history")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._worker is None:
+            return
+        # Drain what is already queued, without waiting for the flush interval, before stopping the worker.
+        self._stopping = True
+        self._wake.set()
+        await self._queue.join()
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._stopping = False
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "running": self._worker is not None,
+            "queued": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "inline_writes": self.inline_writes,
+        }
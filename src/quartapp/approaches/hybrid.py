@@ -0,0 +1,77 @@
+import asyncio
+
+from langchain_community.vectorstores import AzureCosmosDBVectorSearch
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_openai.chat_models.base import BaseChatOpenAI
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.base import ApproachesBase
+from quartapp.approaches.local_index import LocalVectorIndex
+from quartapp.approaches.schemas import LocalIndexMode
+from quartapp.approaches.utils import document_id
+from quartapp.approaches.vector_index import RecordedVectorIndex
+
+# Rank constant from the original reciprocal rank fusion paper; damps the weight of the very top ranks.
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: list[list[Document]], weights: list[float], k: int = RRF_K
+) -> list[tuple[Document, float]]:
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+    for ranked_list, weight in zip(ranked_lists, weights, strict=True):
+        for rank, document in enumerate(ranked_list, start=1):
+            key = document_id(document)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+    # sorted is stable, so ties keep the order the documents were first seen in.
+    return [(documents[key], score) for key, score in sorted(scores.items(), key=lambda item: -item[1])]
+
+
+class Hybrid(ApproachesBase):
+    def __init__(
+        self,
+        vector_store: AzureCosmosDBVectorSearch,
+        embedding: Embeddings,
+        chat: BaseChatOpenAI,
+        data_collection: AsyncCollection,
+        local_index: LocalVectorIndex | None = None,
+        local_index_mode: LocalIndexMode = LocalIndexMode.OFF,
+        vector_index: RecordedVectorIndex | None = None,
+        keyword_weight: float = 1.0,
+        vector_weight: float = 1.0,
+        rrf_k: int = RRF_K,
+    ):
+        super().__init__(vector_store, embedding, chat, data_collection, local_index, local_index_mode, vector_index)
+        self._keyword_weight = keyword_weight
+        self._vector_weight = vector_weight
+        self._rrf_k = rrf_k
+
+    async def search(self, query: str, limit: int, score_threshold: float) -> list[Document]:
+        # Both searches are in flight at once, so the latency is that of the slower one.
+        keyword_results, vector_results = await asyncio.gather(
+            self._text_search(query, limit),
+            self._similarity_search(query, limit, score_threshold),
+        )
+        fused = reciprocal_rank_fusion(
+            [keyword_results, vector_results], [self._keyword_weight, self._vector_weight], self._rrf_k
+        )
+        return [document for document, _ in fused[:limit]]
+
+    async def run(
+        self, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> tuple[list[Document], str]:
+        query = messages[-1]["content"]
+        hybrid_response = await self.search(query, limit, score_threshold)
+        documents_list: list[Document] = []
+
+        if hybrid_response:
+            for document in hybrid_response:
+                documents_list.append(
+                    Document(page_content=document.page_content, metadata={"source": document.metadata["source"]})
+                )
+            if documents_list:
+                return documents_list, documents_list[0].page_content
+        return [], ""
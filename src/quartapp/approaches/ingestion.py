@@ -0,0 +1,473 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections.abc import Awaitable, Callable, Iterable, Iterator
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Any, TextIO
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from openai import RateLimitError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.history_packer import TokenCounter, estimate_tokens
+
+# Field names used by the LangChain vector store the retrievers read from.
+TEXT_KEY = "textContent"
+EMBEDDING_KEY = "vectorContent"
+HASH_KEY = "contentHash"
+# Item fields that identify a menu item across ingestions.
+ID_FIELDS = ("category", "name")
+DELETE_BATCH_SIZE = 1000
+# Error code returned by Azure Cosmos DB for MongoDB when a request is rate limited.
+TOO_MANY_REQUESTS = 16500
+# Files with these extensions hold one JSON value per line, anything else a single JSON array.
+JSON_LINES_EXTENSIONS = (".jsonl", ".ndjson")
+READ_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = " \t\n\r"
+JSON_NUMBER_CHARS = "0123456789.eE+-"
+
+
+def is_throttled(error: BaseException) -> bool:
+    if isinstance(error, RateLimitError):
+        return True
+    if isinstance(error, OperationFailure):
+        return error.code == TOO_MANY_REQUESTS
+    return getattr(error, "status_code", None) == 429
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def stable_id(item: Any, page_content: str) -> str:
+    """`category/name` of a menu item (ignoring case and runs of whitespace), or the content hash of anything else."""
+    if isinstance(item, dict) and all(isinstance(item.get(key), str) for key in ID_FIELDS):
+        return "/".join(re.sub(r"\s+", " ", item[key]).strip().casefold() for key in ID_FIELDS)
+    return content_hash(page_content)
+
+
+def backoff_delay(attempt: int, base_seconds: float, max_seconds: float) -> float:
+    # Full jitter: concurrent batches throttled at the same time do not all retry at the same time.
+    return random.uniform(0, min(max_seconds, base_seconds * 2**attempt))
+
+
+def batched[T](items: Iterable[T], size: int) -> Iterator[list[T]]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def iter_json_array(file: TextIO, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Yield the items of the top-level JSON array in `file` one at a time.
+
+    The file is read `chunk_size` characters at a time and only the unparsed tail is kept, so memory depends on the
+    size of the largest item rather than the size of the file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    # What may come next: "[" to open the array, a "value" (or "]" when the array may still be empty) or a
+    # "separator" ("," or "]") after each item.
+    expect = "["
+    empty = True
+
+    def read_more() -> bool:
+        nonlocal buffer, position
+        chunk = file.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        return bool(chunk)
+
+    while True:
+        while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+            position += 1
+        if position == len(buffer):
+            if not read_more():
+                raise ValueError("expected a JSON array" if expect == "[" else "unexpected end of the JSON array")
+            continue
+        char = buffer[position]
+        if expect == "[":
+            if char != "[":
+                raise ValueError("expected a JSON array")
+            expect = "value"
+            position += 1
+        elif char == "]" and (expect == "separator" or empty):
+            return
+        elif expect == "separator":
+            if char != ",":
+                raise ValueError(f"expected ',' or ']' in the JSON array, found {char!r}")
+            expect = "value"
+            position += 1
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The item continues in the next chunk.
+                if not read_more():
+                    raise
+                continue
+            rest = end
+            while rest < len(buffer) and buffer[rest] in JSON_NUMBER_CHARS:
+                rest += 1
+            if rest == len(buffer) and read_more():
+                # A number cut by the end of the chunk decodes as a shorter one ("1" for "1.5", or for "1e5"), so
+                # the item is only complete once something other than number characters follows it.
+                continue
+            yield item
+            position = end
+            expect = "separator"
+            empty = False
+
+
+def iter_json_lines(file: TextIO) -> Iterator[Any]:
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as error:
+            raise ValueError(f"invalid JSON on line {line_number}: {error}") from error
+
+
+def read_documents(file_path: str) -> Iterator[Document]:
+    """Stream the items of a JSON array or JSON Lines file as documents with stable ids, numbered from 1."""
+    absolute_path = os.path.abspath(file_path)
+    with open(file_path) as file:
+        items = iter_json_lines(file) if file_path.endswith(JSON_LINES_EXTENSIONS) else iter_json_array(file)
+        for idx, item in enumerate(items):
+            page_content = json.dumps(item)
+            yield Document(
+                id=stable_id(item, page_content),
+                page_content=page_content,
+                metadata={"source": absolute_path, "seq_num": idx + 1},
+            )
+
+
+class CheckpointMismatchError(Exception):
+    """The checkpoint was written by an ingestion of another input, collection or embedding model."""
+
+
+class Checkpoint:
+    """
+    Progress of an ingestion, saved to a local JSON file after each written batch.
+
+    `offset` is the number of input documents that are all written: batches can finish out of order, so it only
+    moves past a batch once every batch before it is written too. A run can only be resumed with the same
+    `fingerprint` (embedding model and dimensions, input and collection), so vectors from different models are
+    never mixed in one collection.
+    """
+
+    def __init__(self, path: str, fingerprint: dict[str, Any], offset: int = 0):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.offset = offset
+
+    @classmethod
+    def resume(cls, path: str, fingerprint: dict[str, Any]) -> "Checkpoint":
+        """Load the checkpoint saved at `path`, or start from the beginning when there is none."""
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return cls(path, fingerprint)
+        changes = [
+            f"{key} was {saved['fingerprint'].get(key)!r}, now {fingerprint.get(key)!r}"
+            for key in sorted(saved["fingerprint"].keys() | fingerprint.keys())
+            if saved["fingerprint"].get(key) != fingerprint.get(key)
+        ]
+        if changes:
+            raise CheckpointMismatchError(f"Cannot resume from {path}: {'; '.join(changes)}")
+        return cls(path, fingerprint, saved["offset"])
+
+    def save(self, offset: int) -> None:
+        self.offset = offset
+        # Written to a temporary file first, so a crash while saving never leaves a truncated checkpoint.
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(
+                {
+                    "fingerprint": self.fingerprint,
+                    "offset": offset,
+                    "updated_at": datetime.now(timezone.utc).isoformat(),  # noqa: UP017
+                },
+                file,
+            )
+        os.replace(temporary_path, self.path)
+
+    def remove(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+@dataclass
+class IngestionStats:
+    """Progress of one ingestion run; documents and tokens are counted once their batch is written."""
+
+    documents: int = 0
+    resumed: int = 0
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+    deleted: int = 0
+    duplicates: int = 0
+    tokens: int = 0
+    batches: int = 0
+    throttled: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    def snapshot(self) -> dict[str, float]:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "documents": self.documents,
+            "resumed": self.resumed,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "skipped": self.skipped,
+            "deleted": self.deleted,
+            "duplicates": self.duplicates,
+            "tokens": self.tokens,
+            "batches": self.batches,
+            "throttled": self.throttled,
+            "elapsed_seconds": round(elapsed, 2),
+            "docs_per_second": round(self.documents / elapsed, 1) if elapsed else 0.0,
+            "tokens_per_second": round(self.tokens / elapsed, 1) if elapsed else 0.0,
+        }
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.inserted or self.updated or self.deleted)
+
+
+class IngestionPipeline:
+    """
+    Embeds documents in batches and writes them to the data collection.
+
+    Documents are pulled from the (possibly streamed) input in batches of `batch_size` as the `concurrency`
+    in-flight slots free up, so memory stays around `batch_size * concurrency` documents whatever the size of the
+    input. Documents are keyed on their stable id and stored with a hash of their content: the ones already stored
+    with the same hash are skipped, and the new or changed ones of a batch are embedded with a single
+    `aembed_documents` call and upserted with an unordered `bulk_write`, so the writes of one batch overlap the
+    embedding of the next ones. Once every batch is written, documents stored without a content hash (by earlier
+    versions of the pipeline) are deleted, since their re-ingested copies replace them; with `prune`, stored
+    documents missing from the input are deleted as well. With a `checkpoint`, the documents before its offset are
+    skipped and the offset is saved as batches are written, so a failed run can be resumed; the checkpoint is
+    removed once the run completes.
+
+    Throttled calls (HTTP 429 from the embeddings API, error 16500 from the database) are retried up to
+    `max_retries` times with jittered exponential backoff; any other error stops the run. Throughput is logged every
+    `report_seconds`.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncCollection,
+        embeddings: Embeddings,
+        batch_size: int = 128,
+        concurrency: int = 4,
+        max_retries: int = 6,
+        backoff_base_seconds: float = 1.0,
+        backoff_max_seconds: float = 60.0,
+        count_tokens: TokenCounter = estimate_tokens,
+        report_seconds: float = 5.0,
+    ):
+        self._collection = collection
+        self._embeddings = embeddings
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._max_retries = max_retries
+        self._backoff_base_seconds = backoff_base_seconds
+        self._backoff_max_seconds = backoff_max_seconds
+        self._count_tokens = count_tokens
+        self._report_seconds = report_seconds
+        self.stats = IngestionStats()
+        self._seen: set[str] = set()
+        # Input offset after each written batch, by batch number, until the batches before it are written too.
+        self._written: dict[int, int] = {}
+        self._next_batch = 0
+
+    async def _backoff(self, attempt: int, error: Exception) -> None:
+        if attempt >= self._max_retries:
+            raise error
+        delay = backoff_delay(attempt, self._backoff_base_seconds, self._backoff_max_seconds)
+        self.stats.throttled += 1
+        logging.warning("Throttled, retrying in %.1fs: %s", delay, error)
+        await asyncio.sleep(delay)
+
+    async def _retry[T](self, call: Callable[[], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except Exception as error:
+                if not is_throttled(error):
+                    raise
+                await self._backoff(attempt, error)
+                attempt += 1
+
+    async def _write(self, requests: list[UpdateOne]) -> None:
+        attempt = 0
+        while True:
+            try:
+                await self._collection.bulk_write(requests, ordered=False)
+                return
+            except BulkWriteError as error:
+                # An unordered bulk write applies everything it can, so only the throttled requests are sent again.
+                write_errors = error.details.get("writeErrors", [])
+                if not write_errors or any(e.get("code") != TOO_MANY_REQUESTS for e in write_errors):
+                    raise
+                requests = [requests[e["index"]] for e in write_errors]
+                await self._backoff(attempt, error)
+            except Exception as error:
+                if not is_throttled(error):
+                    raise
+                await self._backoff(attempt, error)
+            attempt += 1
+
+    async def _ingest_batch(self, batch: list[tuple[str, Document]]) -> None:
+        ids = [document_id for document_id, _ in batch]
+        stored = await self._retry(lambda: self._collection.find({"_id": {"$in": ids}}, {HASH_KEY: 1}))
+        stored_hashes = {record["_id"]: record.get(HASH_KEY) for record in stored}
+        hashes = {document_id: content_hash(document.page_content) for document_id, document in batch}
+        changed = [
+            (document_id, document)
+            for document_id, document in batch
+            if stored_hashes.get(document_id) != hashes[document_id]
+        ]
+        if changed:
+            texts = [document.page_content for _, document in changed]
+            vectors = await self._retry(lambda: self._embeddings.aembed_documents(texts))
+            await self._write(
+                [
+                    UpdateOne(
+                        {"_id": document_id},
+                        {
+                            "$set": {
+                                TEXT_KEY: document.page_content,
+                                EMBEDDING_KEY: vector,
+                                HASH_KEY: hashes[document_id],
+                                "metadata": document.metadata,
+                            }
+                        },
+                        upsert=True,
+                    )
+                    for (document_id, document), vector in zip(changed, vectors, strict=True)
+                ]
+            )
+            self.stats.tokens += sum(self._count_tokens(text) for text in texts)
+        updated = sum(document_id in stored_hashes for document_id, _ in changed)
+        self.stats.batches += 1
+        self.stats.documents += len(batch)
+        self.stats.updated += updated
+        self.stats.inserted += len(changed) - updated
+        self.stats.skipped += len(batch) - len(changed)
+
+    def _unique(self, documents: Iterable[Document], skip: int) -> Iterator[tuple[int, str, Document]]:
+        for position, document in enumerate(documents):
+            document_id = document.id or content_hash(document.page_content)
+            # Documents before the checkpoint are not ingested again, but still count as seen for pruning.
+            if document_id in self._seen:
+                if position >= skip:
+                    self.stats.duplicates += 1
+                    logging.warning("Skipping a duplicate of %s", document_id)
+                continue
+            self._seen.add(document_id)
+            if position >= skip:
+                yield position, document_id, document
+
+    async def _ingest_and_commit(
+        self, number: int, batch: list[tuple[int, str, Document]], checkpoint: Checkpoint | None
+    ) -> None:
+        await self._ingest_batch([(document_id, document) for _, document_id, document in batch])
+        self._written[number] = batch[-1][0] + 1
+        offset = None
+        while self._next_batch in self._written:
+            offset = self._written.pop(self._next_batch)
+            self._next_batch += 1
+        if checkpoint is not None and offset is not None:
+            checkpoint.save(offset)
+
+    async def _delete_legacy(self) -> None:
+        # Documents written before the pipeline stored content hashes have an ObjectId _id that no input item maps
+        # to, so they would stay next to their re-ingested copies.
+        legacy = {EMBEDDING_KEY: {"$exists": True}, HASH_KEY: {"$exists": False}}
+        result = await self._retry(lambda: self._collection.delete_many(legacy))
+        if result.deleted_count:
+            logging.info("Deleted %d documents stored without a content hash", result.deleted_count)
+        self.stats.deleted += result.deleted_count
+
+    async def _prune(self) -> None:
+        stored = await self._retry(lambda: self._collection.find({}, {"_id": 1}))
+        missing = [record["_id"] for record in stored if record["_id"] not in self._seen]
+        for ids in batched(missing, DELETE_BATCH_SIZE):
+            result = await self._retry(lambda: self._collection.delete_many({"_id": {"$in": ids}}))
+            self.stats.deleted += result.deleted_count
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self._report_seconds)
+            self._log_progress()
+
+    def _log_progress(self) -> None:
+        stats = self.stats.snapshot()
+        logging.info(
+            "Ingested %d documents in %d batches (%.1f docs/s, %.1f tokens/s, %d throttled)",
+            stats["documents"],
+            stats["batches"],
+            stats["docs_per_second"],
+            stats["tokens_per_second"],
+            stats["throttled"],
+        )
+
+    async def run(
+        self, documents: Iterable[Document], prune: bool = False, checkpoint: Checkpoint | None = None
+    ) -> IngestionStats:
+        skip = checkpoint.offset if checkpoint is not None else 0
+        if skip:
+            logging.info("Resuming after the first %d documents", skip)
+        self.stats = IngestionStats(resumed=skip)
+        self._seen = set()
+        self._written = {}
+        self._next_batch = 0
+        in_flight: set[asyncio.Task] = set()
+        reporter = asyncio.create_task(self._report())
+        try:
+            for number, batch in enumerate(batched(self._unique(documents, skip), self._batch_size)):
+                if len(in_flight) >= self._concurrency:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+                in_flight.add(asyncio.create_task(self._ingest_and_commit(number, batch, checkpoint)))
+            await asyncio.gather(*in_flight)
+            await self._delete_legacy()
+            if prune:
+                await self._prune()
+            if checkpoint is not None:
+                checkpoint.remove()
+        finally:
+            for task in (*in_flight, reporter):
+                task.cancel()
+            for task in (*in_flight, reporter):
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await task
+        self._log_progress()
+        logging.info(
+            "%d inserted, %d updated, %d skipped (unchanged), %d deleted, %d duplicates",
+            self.stats.inserted,
+            self.stats.updated,
+            self.stats.skipped,
+            self.stats.deleted,
+            self.stats.duplicates,
+        )
+        return self.stats
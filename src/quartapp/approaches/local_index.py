@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from pymongo.errors import OperationFailure, PyMongoError
+
+from quartapp.approaches.async_collection import AsyncCollection
+
+MISSING_SIMILARITY_INDEX_ERROR = "Similarity index was not found for a vector similarity search query."
+# Larger collections are not loaded: every worker would hold all of their vectors in memory.
+LOCAL_INDEX_MAX_DOCUMENTS = 100_000
+
+
+def is_missing_similarity_index_error(error: OperationFailure) -> bool:
+    return error.code == 2 and MISSING_SIMILARITY_INDEX_ERROR in str(error)
+
+
+@dataclass
+class _IndexSnapshot:
+    ids: list[Any] = field(default_factory=list)
+    # Content hashes written by the ingestion pipeline (None for documents stored without one).
+    hashes: list[Any] = field(default_factory=list)
+    texts: list[str] = field(default_factory=list)
+    metadata: list[dict[str, Any]] = field(default_factory=list)
+    # Row-normalized, so a matmul with a normalized query gives cosine similarities.
+    matrix: np.ndarray = field(default_factory=lambda: np.empty((0, 0), dtype=np.float32))
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class LocalVectorIndex:
+    """
+    In-process copy of the vector collection for exact cosine top-k search.
+
+    The text, metadata and embeddings written by `AzureCosmosDBVectorSearch` are held in a contiguous float32
+    matrix. `refresh` diffs the `_id`s and content hashes in the collection against the loaded ones and only
+    fetches added or re-ingested documents; documents stored without a hash and edited in place are picked up by
+    a full `load`. Searches return the same `(Document, score)` pairs as the Cosmos COS index.
+
+    A collection holding more than `max_documents` documents is not loaded (or is unloaded when a refresh finds
+    it has grown past the limit), and queries keep going to Cosmos.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncCollection,
+        max_documents: int = LOCAL_INDEX_MAX_DOCUMENTS,
+        text_key: str = "textContent",
+        embedding_key: str = "vectorContent",
+        hash_key: str = "contentHash",
+    ):
+        self._collection = collection
+        self._max_documents = max_documents
+        self._text_key = text_key
+        self._embedding_key = embedding_key
+        self._hash_key = hash_key
+        self._snapshot = _IndexSnapshot()
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: asyncio.Task | None = None
+        self.loaded = False
+        self.refreshed_at: float | None = None
+        self.queries = 0
+        self.fallbacks = 0
+
+    def __len__(self) -> int:
+        return len(self._snapshot.ids)
+
+    async def _fetch(self, filter: dict[str, Any]) -> list[dict[str, Any]]:
+        return await self._collection.find(
+            {**filter, self._embedding_key: {"$exists": True}},
+            {self._text_key: 1, self._embedding_key: 1, self._hash_key: 1, "metadata": 1},
+        )
+
+    def _build(self, snapshot: _IndexSnapshot, keep: list[int], documents: list[dict[str, Any]]) -> _IndexSnapshot:
+        rows = [snapshot.matrix[keep]] if keep else []
+        if documents:
+            rows.append(
+                _normalize_rows(np.asarray([document[self._embedding_key] for document in documents], np.float32))
+            )
+        return _IndexSnapshot(
+            ids=[snapshot.ids[i] for i in keep] + [document["_id"] for document in documents],
+            hashes=[snapshot.hashes[i] for i in keep] + [document.get(self._hash_key) for document in documents],
+            texts=[snapshot.texts[i] for i in keep] + [document.get(self._text_key, "") for document in documents],
+            metadata=[snapshot.metadata[i] for i in keep] + [document.get("metadata", {}) for document in documents],
+            matrix=np.ascontiguousarray(np.concatenate(rows)) if rows else _IndexSnapshot().matrix,
+        )
+
+    def _too_large(self, document_count: int) -> bool:
+        if document_count <= self._max_documents:
+            return False
+        logging.warning(
+            "Not loading the local vector index: the collection holds %d documents, more than the limit of %d",
+            document_count,
+            self._max_documents,
+        )
+        self._snapshot = _IndexSnapshot()
+        self.loaded = False
+        return True
+
+    async def load(self) -> None:
+        async with self._refresh_lock:
+            if self._too_large(await self._collection.count_documents({})):
+                return
+            self._snapshot = self._build(_IndexSnapshot(), [], await self._fetch({}))
+            self.loaded = True
+            self.refreshed_at = time.time()
+
+    async def refresh(self) -> None:
+        if not self.loaded:
+            await self.load()
+            return
+        async with self._refresh_lock:
+            current = {
+                document["_id"]: document.get(self._hash_key)
+                for document in await self._collection.find({}, {"_id": 1, self._hash_key: 1})
+            }
+            if self._too_large(len(current)):
+                return
+            snapshot = self._snapshot
+            known = dict(zip(snapshot.ids, snapshot.hashes, strict=True))
+            added_ids = current.keys() - known.keys()
+            # Documents re-ingested with other content since they were loaded are fetched again.
+            changed_ids = {
+                document_id
+                for document_id, content_hash in current.items()
+                if document_id in known and known[document_id] != content_hash
+            }
+            stale_ids = added_ids | changed_ids
+            fetched = await self._fetch({"_id": {"$in": list(stale_ids)}}) if stale_ids else []
+            if fetched or changed_ids or not known.keys() <= current.keys():
+                keep = [
+                    i
+                    for i, document_id in enumerate(snapshot.ids)
+                    if document_id in current and document_id not in changed_ids
+                ]
+                # Searches keep using the old snapshot until the new one is swapped in.
+                self._snapshot = self._build(snapshot, keep, fetched)
+            self.refreshed_at = time.time()
+
+    async def _refresh_periodically(self, interval_seconds: float) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except PyMongoError as error:
+                logging.warning("Could not refresh the local vector index: %s", error)
+            except Exception:
+                logging.exception("Unexpected error while refreshing the local vector index")
+            await asyncio.sleep(interval_seconds)
+
+    def start(self, interval_seconds: float) -> None:
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_periodically(interval_seconds))
+
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+    def search(self, embedding: list[float], k: int, score_threshold: float = 0.0) -> list[tuple[Document, float]]:
+        snapshot = self._snapshot
+        if not snapshot.ids or k <= 0:
+            return []
+        self.queries += 1
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm:
+            query = query / query_norm
+        scores = snapshot.matrix @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            (
+                Document(page_content=snapshot.texts[i], metadata={**snapshot.metadata[i], "_id": snapshot.ids[i]}),
+                float(scores[i]),
+            )
+            for i in top
+            if scores[i] >= score_threshold
+        ]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "documents": len(self),
+            "max_documents": self._max_documents,
+            "dimensions": int(self._snapshot.matrix.shape[1]) if len(self) else 0,
+            "refreshed_at": self.refreshed_at,
+            "queries": self.queries,
+            "fallbacks": self.fallbacks,
+        }
@@ -1,12 +1,153 @@
+import asyncio
 import json
-from collections.abc import AsyncIterator
+import re
+import time
+from collections.abc import AsyncIterator, Callable
+from dataclasses import dataclass
 
+from langchain_community.vectorstores import AzureCosmosDBVectorSearch
 from langchain_core.documents import Document
-from langchain_core.messages import BaseMessage
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import AIMessageChunk, BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+from langchain_openai.chat_models.base import BaseChatOpenAI
 
+from quartapp.approaches.answer_cache import AnswerCache, AnswerLookup
+from quartapp.approaches.async_collection import AsyncCollection
 from quartapp.approaches.base import ApproachesBase
-from quartapp.approaches.schemas import DataPoint
+from quartapp.approaches.history_packer import HistoryPacker
+from quartapp.approaches.hybrid import Hybrid
+from quartapp.approaches.local_index import LocalVectorIndex
+from quartapp.approaches.schemas import DataPoint, LocalIndexMode, RephrasePolicy, StreamStage
+from quartapp.approaches.utils import cosine_similarity
+from quartapp.approaches.vector_index import RecordedVectorIndex
+
+# Called as retrieval for a streamed answer progresses, with an optional detail (e.g. the rephrased question).
+StageCallback = Callable[[StreamStage, str | None], None]
+
+
+@dataclass
+class RephrasedQuestion:
+    """
+    Class to represent the question used for retrieval, how the rephrase policy produced it, and how the
+    retrieval and answer caches handled it.
+    """
+
+    content: str
+    decision: str
+    speculation: str | None = None
+    answer_cache: str | None = None
+    history: str | None = None
+
+
+@dataclass
+class SpeculationStats:
+    """
+    Running totals for speculative retrieval, shared by every request served by a RAG instance.
+    """
+
+    attempts: int = 0
+    hits: int = 0
+    saved_ms: float = 0.0
+
+    def record(self, hit: bool, saved_ms: float) -> None:
+        self.attempts += 1
+        self.hits += int(hit)
+        self.saved_ms += saved_ms
+
+    def snapshot(self) -> dict[str, float]:
+        return {
+            "attempts": self.attempts,
+            "hits": self.hits,
+            "misses": self.attempts - self.hits,
+            "hit_rate": self.hits / self.attempts if self.attempts else 0.0,
+            "saved_ms_total": round(self.saved_ms, 1),
+            "saved_ms_avg": round(self.saved_ms / self.attempts, 1) if self.attempts else 0.0,
+        }
+
+
+@dataclass
+class GenerationStats:
+    """
+    Running totals for streamed answers, shared by every request served by a RAG instance.
+
+    Chunks stand in for tokens, as the OpenAI API streams about one token per chunk. The tokens a cancelled
+    generation avoided are estimated from the average length of the answers that were streamed to the end.
+    """
+
+    completed: int = 0
+    completed_chunks: int = 0
+    cancelled: int = 0
+    cancelled_chunks: int = 0
+    tokens_avoided: float = 0.0
+
+    def record_completed(self, chunks: int) -> None:
+        self.completed += 1
+        self.completed_chunks += chunks
+
+    def record_cancelled(self, chunks: int) -> None:
+        self.cancelled += 1
+        self.cancelled_chunks += chunks
+        if self.completed:
+            self.tokens_avoided += max(0.0, self.completed_chunks / self.completed - chunks)
+
+    def snapshot(self) -> dict[str, float]:
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "streamed_tokens_completed": self.completed_chunks,
+            "streamed_tokens_cancelled": self.cancelled_chunks,
+            "tokens_avoided_estimate": round(self.tokens_avoided),
+        }
+
+
+async def close_stream(stream: AsyncIterator[BaseMessage]) -> None:
+    # Leaving an `async for` early does not close the iterator, which would keep the upstream request running
+    # until the generator is garbage collected.
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def track_generation(stats: GenerationStats, stream: AsyncIterator[BaseMessage]) -> AsyncIterator[BaseMessage]:
+    chunks = 0
+    try:
+        async for chunk in stream:
+            chunks += 1
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        stats.record_cancelled(chunks)
+        raise
+    finally:
+        await close_stream(stream)
+    stats.record_completed(chunks)
+
+
+def get_source_documents(documents: list[Document]) -> list[Document]:
+    return [
+        Document(page_content=document.page_content, metadata={"source": document.metadata["source"]})
+        for document in documents
+    ]
+
+
+async def replay_answer(answer: str) -> AsyncIterator[BaseMessage]:
+    yield AIMessageChunk(content=answer)
+
+
+async def store_when_complete(
+    answer_cache: AnswerCache, lookup: AnswerLookup, stream: AsyncIterator[BaseMessage]
+) -> AsyncIterator[BaseMessage]:
+    # Only answers that were streamed to the end are cached.
+    content = ""
+    try:
+        async for chunk in stream:
+            content += str(chunk.content)
+            yield chunk
+    finally:
+        await close_stream(stream)
+    answer_cache.store(lookup, content)
 
 
 def get_data_points(documents: list[Document]) -> list[DataPoint]:
@@ -23,6 +164,40 @@ def get_data_points(documents: list[Document]) -> list[DataPoint]:
     return data_points
 
 
+def format_answer(response: str, rephrased_question: RephrasedQuestion) -> str:
+    answer = {
+        "response": response,
+        "rephrased_response": rephrased_question.content,
+        "rephrase_decision": rephrased_question.decision,
+    }
+    if rephrased_question.speculation is not None:
+        answer["speculation"] = rephrased_question.speculation
+    if rephrased_question.answer_cache is not None:
+        answer["answer_cache"] = rephrased_question.answer_cache
+    if rephrased_question.history is not None:
+        answer["rephrase_history"] = rephrased_question.history
+    return json.dumps(answer)
+
+
+REPHRASE_TEMPERATURE = 0.3
+
+# Cosine similarity above which the rephrased question is considered to retrieve the same documents as the raw one
+SPECULATIVE_SIMILARITY_THRESHOLD = 0.95
+
+# Words that usually point back at an earlier turn ("is it vegan?", "anything cheaper than that one?")
+FOLLOW_UP_MARKERS = frozenset(
+    {
+        "it", "its", "that", "this", "those", "these", "them", "they", "their", "one", "ones",
+        "another", "other", "others", "else", "more", "same", "also", "too", "instead",
+    }
+)  # fmt: skip
+
+
+def is_standalone_question(question: str) -> bool:
+    words = re.findall(r"[a-z']+", question.lower())
+    return len(words) >= 4 and FOLLOW_UP_MARKERS.isdisjoint(words)
+
+
 REPHRASE_PROMPT = """\
 Given the following conversation and a follow up question, rephrase the follow up \
 question to be a standalone question.
@@ -62,93 +237,203 @@ Chatbot Response:"""
 
 
 class RAG(ApproachesBase):
-    async def run(
-        self, messages: list, temperature: float, limit: int, score_threshold: float
-    ) -> tuple[list[Document], str]:
-        # Create a vector store retriever
-        retriever = self._vector_store.as_retriever(
-            search_type="similarity", search_kwargs={"k": limit, "score_threshold": score_threshold}
-        )
-
-        self._chat.temperature = 0.3
+    def __init__(
+        self,
+        vector_store: AzureCosmosDBVectorSearch,
+        embedding: Embeddings,
+        chat: BaseChatOpenAI,
+        data_collection: AsyncCollection,
+        rephrase_policy: RephrasePolicy = RephrasePolicy.HISTORY,
+        speculative_retrieval: bool = False,
+        speculative_similarity_threshold: float = SPECULATIVE_SIMILARITY_THRESHOLD,
+        answer_cache: AnswerCache | None = None,
+        local_index: LocalVectorIndex | None = None,
+        local_index_mode: LocalIndexMode = LocalIndexMode.OFF,
+        vector_index: RecordedVectorIndex | None = None,
+        hybrid: Hybrid | None = None,
+        history_packer: HistoryPacker | None = None,
+    ):
+        super().__init__(vector_store, embedding, chat, data_collection, local_index, local_index_mode, vector_index)
+        self._rephrase_policy = rephrase_policy
+        self._speculative_retrieval = speculative_retrieval
+        self._speculative_similarity_threshold = speculative_similarity_threshold
+        self._speculation_stats = SpeculationStats()
+        self._generation_stats = GenerationStats()
+        self._answer_cache = answer_cache
+        # When set, the context comes from fused keyword and vector search (and speculation is not used).
+        self._hybrid = hybrid
+        self._history_packer = history_packer or HistoryPacker()
+
+    def speculation_stats(self) -> dict[str, float]:
+        return self._speculation_stats.snapshot()
+
+    def generation_stats(self) -> dict[str, float]:
+        return self._generation_stats.snapshot()
+
+    def answer_cache_stats(self) -> dict[str, float]:
+        return self._answer_cache.stats() if self._answer_cache else {}
+
+    def history_stats(self) -> dict[str, float]:
+        return self._history_packer.stats()
+
+    def _chat_with(self, temperature: float) -> Runnable[LanguageModelInput, BaseMessage]:
+        # The chat client is shared by every request, so generation settings are bound per call
+        # instead of being set on the client.
+        return self._chat.bind(temperature=temperature)
+
+    async def _rephrase(self, messages: list) -> RephrasedQuestion:
+        question = messages[-1]["content"]
+        chat_history = messages[:-1]
+
+        if self._rephrase_policy != RephrasePolicy.ALWAYS:
+            if not chat_history:
+                return RephrasedQuestion(content=question, decision="skipped: no chat history")
+            if self._rephrase_policy == RephrasePolicy.HEURISTIC and is_standalone_question(question):
+                return RephrasedQuestion(content=question, decision="skipped: follow-up is already standalone")
 
         # Create a vector context aware chat retriever
         rephrase_prompt_template = ChatPromptTemplate.from_template(REPHRASE_PROMPT)
-        rephrase_chain = rephrase_prompt_template | self._chat
+        rephrase_chain = rephrase_prompt_template | self._chat_with(temperature=REPHRASE_TEMPERATURE)
+
+        # Rephrase the question, with as much of the history as fits in the token budget
+        history = self._history_packer.pack(chat_history)
+        rephrased_question = await rephrase_chain.ainvoke({"chat_history": history.text, "question": question})
+        return RephrasedQuestion(
+            content=str(rephrased_question.content),
+            decision="rephrased",
+            history=history.describe() if chat_history else None,
+        )
 
-        # Rephrase the question
-        rephrased_question = await rephrase_chain.ainvoke({"chat_history": messages[:-1], "question": messages[-1]})
+    async def _rephrase_reporting(self, messages: list, on_stage: StageCallback | None) -> RephrasedQuestion:
+        if on_stage:
+            on_stage(StreamStage.REPHRASING, None)
+        rephrased_question = await self._rephrase(messages)
+        if on_stage:
+            on_stage(StreamStage.REPHRASED, rephrased_question.content)
+        return rephrased_question
 
-        print(rephrased_question.content)
-        # Perform vector search
-        vector_context = await retriever.ainvoke(str(rephrased_question.content))
-        data_points: list[DataPoint] = get_data_points(vector_context)
+    async def _retrieve(
+        self, messages: list, limit: int, score_threshold: float, on_stage: StageCallback | None = None
+    ) -> tuple[list[Document], RephrasedQuestion]:
+        if self._hybrid is not None:
+            rephrased_question = await self._rephrase_reporting(messages, on_stage)
+            return await self._hybrid.search(rephrased_question.content, limit, score_threshold), rephrased_question
 
-        # Create a vector context aware chat retriever
-        context_prompt_template = ChatPromptTemplate.from_template(CONTEXT_PROMPT)
-        self._chat.temperature = temperature
-        context_chain = context_prompt_template | self._chat
-        documents_list: list[Document] = []
-        if data_points:
-            # Perform RAG search
-            response = await context_chain.ainvoke(
-                {"context": [dp.to_dict() for dp in data_points], "input": rephrased_question.content}
-            )
-            for document in vector_context:
-                documents_list.append(
-                    Document(page_content=document.page_content, metadata={"source": document.metadata["source"]})
-                )
-            formatted_response = json.dumps(
-                {"response": str(response.content), "rephrased_response": str(rephrased_question.content)}
-            )
-            return documents_list, formatted_response
-
-        # Perform RAG search with no context
-        response = await context_chain.ainvoke({"context": [], "input": rephrased_question.content})
-        formatted_response = json.dumps(
-            {"response": str(response.content), "rephrased_response": str(rephrased_question.content)}
+        if self._speculative_retrieval:
+            return await self._retrieve_speculatively(messages, limit, score_threshold, on_stage)
+
+        rephrased_question = await self._rephrase_reporting(messages, on_stage)
+
+        # Perform vector search
+        vector_context = await self._similarity_search(rephrased_question.content, limit, score_threshold)
+        return vector_context, rephrased_question
+
+    async def _speculative_search(
+        self, question: str, limit: int, score_threshold: float
+    ) -> tuple[list[float], list[Document], float]:
+        embedding = await self._embed_query(question)
+        search_started = time.perf_counter()
+        documents = await self._search_by_vector(embedding, limit, score_threshold)
+        return embedding, documents, (time.perf_counter() - search_started) * 1000
+
+    async def _retrieve_speculatively(
+        self, messages: list, limit: int, score_threshold: float, on_stage: StageCallback | None = None
+    ) -> tuple[list[Document], RephrasedQuestion]:
+        # Embed and search with the raw question while the rephrase completion is in flight.
+        speculative_search = asyncio.create_task(
+            self._speculative_search(messages[-1]["content"], limit, score_threshold)
+        )
+        try:
+            rephrased_question = await self._rephrase_reporting(messages, on_stage)
+            waiting_started = time.perf_counter()
+            raw_embedding, speculative_context, search_ms = await speculative_search
+        finally:
+            speculative_search.cancel()
+        waited_ms = (time.perf_counter() - waiting_started) * 1000
+
+        if rephrased_question.decision != "rephrased":
+            # The question was used as is, so the speculative search is the search.
+            return speculative_context, rephrased_question
+
+        rephrased_embedding = await self._embed_query(rephrased_question.content)
+        similarity = cosine_similarity(raw_embedding, rephrased_embedding)
+        hit = similarity >= self._speculative_similarity_threshold
+        if hit:
+            vector_context = speculative_context
+            # The search overlapped the rephrase, except for the time spent waiting on it afterwards.
+            saved_ms = search_ms - waited_ms
+        else:
+            vector_context = await self._search_by_vector(rephrased_embedding, limit, score_threshold)
+            saved_ms = -waited_ms
+
+        self._speculation_stats.record(hit, saved_ms)
+        rephrased_question.speculation = (
+            f"{'hit' if hit else 'miss'} (similarity {similarity:.3f}, saved {saved_ms:.0f} ms)"
         )
-        return [], formatted_response
+        return vector_context, rephrased_question
+
+    async def _lookup_answer(
+        self, rephrased_question: RephrasedQuestion, vector_context: list[Document], temperature: float
+    ) -> AnswerLookup | None:
+        if self._answer_cache is None:
+            return None
+        embedding = await self._embed_query(rephrased_question.content)
+        lookup = await self._answer_cache.lookup(embedding, vector_context, temperature)
+        rephrased_question.answer_cache = lookup.describe()
+        return lookup
 
-    async def run_stream(
+    async def run(
         self, messages: list, temperature: float, limit: int, score_threshold: float
-    ) -> tuple[list[Document], AsyncIterator[BaseMessage]]:
-        # Create a vector store retriever
-        retriever = self._vector_store.as_retriever(
-            search_type="similarity", search_kwargs={"k": limit, "score_threshold": score_threshold}
-        )
+    ) -> tuple[list[Document], str]:
+        vector_context, rephrased_question = await self._retrieve(messages, limit, score_threshold)
+        data_points: list[DataPoint] = get_data_points(vector_context)
+        documents_list = get_source_documents(vector_context)
 
-        self._chat.temperature = 0.3
+        lookup = await self._lookup_answer(rephrased_question, vector_context, temperature)
+        if lookup and lookup.answer is not None:
+            return documents_list, format_answer(lookup.answer, rephrased_question)
 
         # Create a vector context aware chat retriever
-        rephrase_prompt_template = ChatPromptTemplate.from_template(REPHRASE_PROMPT)
-        rephrase_chain = rephrase_prompt_template | self._chat
+        context_prompt_template = ChatPromptTemplate.from_template(CONTEXT_PROMPT)
+        context_chain = context_prompt_template | self._chat_with(temperature=temperature)
 
-        # Rephrase the question
-        rephrased_question = await rephrase_chain.ainvoke({"chat_history": messages[:-1], "question": messages[-1]})
+        # Perform RAG search, with an empty context when nothing was retrieved
+        response = await context_chain.ainvoke(
+            {"context": [dp.to_dict() for dp in data_points], "input": rephrased_question.content}
+        )
+        if lookup and self._answer_cache:
+            self._answer_cache.store(lookup, str(response.content))
+        return documents_list, format_answer(str(response.content), rephrased_question)
 
-        print(rephrased_question.content)
-        # Perform vector search
-        vector_context = await retriever.ainvoke(str(rephrased_question.content))
+    async def run_stream(
+        self,
+        messages: list,
+        temperature: float,
+        limit: int,
+        score_threshold: float,
+        on_stage: StageCallback | None = None,
+    ) -> tuple[list[Document], AsyncIterator[BaseMessage], RephrasedQuestion]:
+        vector_context, rephrased_question = await self._retrieve(messages, limit, score_threshold, on_stage)
+        if on_stage:
+            on_stage(StreamStage.RETRIEVED, f"{len(vector_context)} documents")
         data_points: list[DataPoint] = get_data_points(vector_context)
+        documents_list = get_source_documents(vector_context)
+
+        lookup = await self._lookup_answer(rephrased_question, vector_context, temperature)
+        if lookup and lookup.answer is not None:
+            return documents_list, replay_answer(lookup.answer), rephrased_question
 
         # Create a vector context aware chat retriever
         context_prompt_template = ChatPromptTemplate.from_template(CONTEXT_PROMPT)
-        self._chat.temperature = temperature
-        context_chain = context_prompt_template | self._chat
-        documents_list: list[Document] = []
+        context_chain = context_prompt_template | self._chat_with(temperature=temperature)
 
-        if data_points:
-            # Perform RAG search
-            response = context_chain.astream(
+        # Perform RAG search, with an empty context when nothing was retrieved
+        response = track_generation(
+            self._generation_stats,
+            context_chain.astream(
                 {"context": [dp.to_dict() for dp in data_points], "input": rephrased_question.content}
-            )
-            for document in vector_context:
-                documents_list.append(
-                    Document(page_content=document.page_content, metadata={"source": document.metadata["source"]})
-                )
-            return documents_list, response
-
-        # Perform RAG search with no context
-        response = context_chain.astream({"context": [], "input": rephrased_question.content})
-        return [], response
+            ),
+        )
+        if lookup and self._answer_cache:
+            response = store_when_complete(self._answer_cache, lookup, response)
+        return documents_list, response, rephrased_question
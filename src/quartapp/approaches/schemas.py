@@ -1,5 +1,6 @@
 import enum
 from dataclasses import dataclass
+from typing import Any
 
 try:
     # Python 3.11+
@@ -17,11 +18,30 @@ class AIChatRoles(StrEnum):
 
 
 class RetrievalMode(StrEnum):
-    HYBRID = "rag"
+    RAG = "rag"
+    HYBRID = "hybrid"
     VECTOR = "vector"
     KEYWORD = "keyword"
 
 
+class RephrasePolicy(StrEnum):
+    ALWAYS = "always"
+    HISTORY = "history"
+    HEURISTIC = "heuristic"
+
+
+class StreamStage(StrEnum):
+    REPHRASING = "rephrasing"
+    REPHRASED = "rephrased"
+    RETRIEVED = "retrieved"
+
+
+class LocalIndexMode(StrEnum):
+    OFF = "off"
+    FALLBACK = "fallback"
+    PRIMARY = "primary"
+
+
 @dataclass
 class DataPoint:
     """
@@ -134,6 +154,26 @@ class RetrievalResponse:
         }
 
 
+@dataclass
+class StageEvent:
+    """
+    Class to represent the progress of a streamed answer before its first token.
+    """
+
+    name: StreamStage
+    elapsed_ms: float
+    detail: str | None = None
+
+    def to_dict(self) -> dict[str, str | float | None]:
+        """
+        Converts the object to a dictionary representation.
+
+        Returns:
+            A dictionary representation of the object.
+        """
+        return {"name": self.name, "elapsed_ms": self.elapsed_ms, "detail": self.detail}
+
+
 @dataclass
 class RetrievalResponseDelta:
     """
@@ -143,16 +183,21 @@ class RetrievalResponseDelta:
     context: Context | None = None
     delta: Message | None = None
     sessionState: str | None = None
+    stage: StageEvent | None = None
 
-    def to_dict(self) -> dict[str, dict[str, list[dict[str, str | None]]] | dict[str, str | None] | str | None]:
+    def to_dict(self) -> dict[str, Any]:
         """
         Converts the object to a dictionary representation.
 
         Returns:
-            A dictionary representation of the object.
+            A dictionary representation of the object. `stage` is only included when set, so clients that do not
+            know about stage events never see it.
         """
-        return {
+        result: dict[str, Any] = {
             "context": self.context.to_dict() if self.context else None,
             "delta": self.delta.to_dict() if self.delta else None,
             "sessionState": self.sessionState if self.sessionState else None,
         }
+        if self.stage:
+            result["stage"] = self.stage.to_dict()
+        return result
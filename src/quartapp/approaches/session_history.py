@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from typing import Any
+
+from quartapp.approaches.async_collection import AsyncCollection
+
+
+class SessionHistory:
+    """
+    In-memory LRU of recent conversations, backed by the Users collection.
+
+    Lets a client send only its newest message along with the `sessionState`: the previous messages are read from
+    memory, or with one `find_one` of the last `max_messages` messages when the session is not cached. Every answer
+    is appended here as it is handed to the history writer, so a session stays current even before its write-behind
+    flush. The cache is per process, so with several worker processes sessions should stick to one of them: a process
+    that did not serve the latest turns of a cached session would answer from stale history.
+    """
+
+    def __init__(self, collection: AsyncCollection, max_sessions: int = 1024, max_messages: int = 50):
+        self._collection = collection
+        self._max_sessions = max_sessions
+        self._max_messages = max_messages
+        self._sessions: OrderedDict[str, list[dict[str, Any]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, session_id: str, messages: list[dict[str, Any]]) -> None:
+        self._sessions[session_id] = messages[-self._max_messages :]
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self._max_sessions:
+            self._sessions.popitem(last=False)
+
+    async def get(self, session_id: str) -> list[dict[str, Any]]:
+        messages = self._sessions.get(session_id)
+        if messages is not None:
+            self.hits += 1
+            self._sessions.move_to_end(session_id)
+            return list(messages)
+
+        self.misses += 1
+        document = await self._collection.find_one({"_id": session_id}, {"messages": {"$slice": -self._max_messages}})
+        messages = document.get("messages", []) if document else []
+        self._put(session_id, messages)
+        return list(messages)
+
+    def append(self, session_id: str, messages: list[dict[str, Any]], new_session: bool) -> None:
+        if new_session:
+            self._put(session_id, list(messages))
+        elif session_id in self._sessions:
+            self._put(session_id, self._sessions[session_id] + messages)
+        # A follow-up to a session that is not cached only holds its last turn, so it is read back when needed.
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "sessions": len(self._sessions),
+            "max_sessions": self._max_sessions,
+        }
@@ -1,21 +1,37 @@
 from abc import ABC
+from typing import Any
 
 from langchain_community.vectorstores import AzureCosmosDBVectorSearch
 from langchain_core.embeddings import Embeddings
 from langchain_openai.chat_models.base import BaseChatOpenAI
 from pydantic import SecretStr
-from pymongo.collection import Collection
+from pymongo import MongoClient
 
+from quartapp.approaches.answer_cache import AnswerCache
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.embedding_batcher import BatchingEmbeddings
+from quartapp.approaches.embedding_cache import CachedEmbeddings
+from quartapp.approaches.history_packer import HistoryPacker, token_counter
+from quartapp.approaches.history_writer import HistoryWriter
+from quartapp.approaches.hybrid import RRF_K, Hybrid
 from quartapp.approaches.keyword import KeyWord
-from quartapp.approaches.rag import RAG
+from quartapp.approaches.local_index import LOCAL_INDEX_MAX_DOCUMENTS, LocalVectorIndex
+from quartapp.approaches.rag import RAG, SPECULATIVE_SIMILARITY_THRESHOLD
+from quartapp.approaches.schemas import LocalIndexMode, RephrasePolicy
+from quartapp.approaches.session_history import SessionHistory
+from quartapp.approaches.stream_replay import StreamReplay
 from quartapp.approaches.utils import (
+    ConnectionPoolStats,
     chat_api,
     embeddings_api,
+    mongo_client_api,
     setup_data_collection,
+    setup_metadata_collection,
     setup_users_collection,
     vector_store_api,
 )
 from quartapp.approaches.vector import Vector
+from quartapp.approaches.vector_index import DEFAULT_EF_SEARCH, RecordedVectorIndex
 
 
 class OpenAISetup(ABC):
@@ -36,8 +52,11 @@ class DatabaseSetup(ABC):
         collection_name: str,
         index_name: str,
         vector_store_api: AzureCosmosDBVectorSearch,
-        users_collection: Collection,
-        data_collection: Collection,
+        users_collection: AsyncCollection,
+        data_collection: AsyncCollection,
+        metadata_collection: AsyncCollection,
+        mongo_client: MongoClient,
+        pool_stats: ConnectionPoolStats | None = None,
     ):
         self._connection_string = connection_string
         self._database_name = database_name
@@ -46,6 +65,15 @@ class DatabaseSetup(ABC):
         self._vector_store_api = vector_store_api
         self._users_collection = users_collection
         self._data_collection = data_collection
+        self._metadata_collection = metadata_collection
+        self._mongo_client = mongo_client
+        self._pool_stats = pool_stats
+
+    def pool_stats(self) -> dict[str, int]:
+        return self._pool_stats.snapshot() if self._pool_stats else {}
+
+    def close(self) -> None:
+        self._mongo_client.close()
 
 
 class Setup(ABC):
@@ -68,17 +96,75 @@ class Setup(ABC):
         openai_chat_host: str = "azure",
         openai_embed_host: str = "azure",
         embedding_dimensions: int | None = None,
+        mongo_max_pool_size: int = 100,
+        mongo_max_idle_time_ms: int | None = None,
+        mongo_server_selection_timeout_ms: int = 1000,
+        rephrase_policy: RephrasePolicy = RephrasePolicy.HISTORY,
+        rag_speculative_retrieval: bool = False,
+        rag_speculative_similarity_threshold: float = SPECULATIVE_SIMILARITY_THRESHOLD,
+        embedding_cache_size: int = 1024,
+        embedding_cache_ttl_seconds: float | None = None,
+        embedding_cache_path: str | None = None,
+        embedding_batch_window_ms: float = 5,
+        embedding_batch_size: int = 16,
+        answer_cache_size: int = 0,
+        answer_cache_ttl_seconds: float | None = 3600,
+        answer_cache_max_distance: float = 0.05,
+        answer_cache_version_poll_seconds: float = 30,
+        local_index_mode: LocalIndexMode = LocalIndexMode.OFF,
+        local_index_refresh_seconds: float = 300,
+        local_index_max_documents: int = LOCAL_INDEX_MAX_DOCUMENTS,
+        hybrid_keyword_weight: float = 1.0,
+        hybrid_vector_weight: float = 1.0,
+        hybrid_rrf_k: int = RRF_K,
+        rag_hybrid_context: bool = False,
+        history_write_behind: bool = True,
+        history_queue_size: int = 1000,
+        history_batch_size: int = 100,
+        history_flush_seconds: float = 0.05,
+        session_cache_size: int = 1024,
+        session_history_max_messages: int = 50,
+        rag_history_max_tokens: int = 1000,
+        rag_history_summary: bool = False,
+        stream_persist_partial_answers: bool = True,
+        stream_coalesce_ms: float = 30,
+        stream_coalesce_chars: int = 64,
+        sse_replay_max_streams: int = 256,
+        sse_replay_max_events: int = 512,
+        sse_replay_ttl_seconds: float = 300,
+        vector_ef_search: int = DEFAULT_EF_SEARCH,
     ):
+        embeddings: Embeddings = embeddings_api(
+            openai_embeddings_model,
+            openai_embeddings_deployment,
+            embed_api_key,
+            embed_api_version,
+            embed_endpoint,
+            openai_embed_host=openai_embed_host,
+            embedding_dimensions=embedding_dimensions,
+        )
+        # Concurrent query embeddings are sent to the API in batches; a batch size of 1 or a window of 0 disables it.
+        self._embedding_batcher: BatchingEmbeddings | None = None
+        if embedding_batch_size > 1 and embedding_batch_window_ms > 0:
+            self._embedding_batcher = BatchingEmbeddings(
+                embeddings, max_batch_size=embedding_batch_size, window_ms=embedding_batch_window_ms
+            )
+            embeddings = self._embedding_batcher
+        # Query embeddings are cached in front of the batcher, so cache hits never wait for a batch; a cache size of 0
+        # disables it.
+        self._embedding_cache: CachedEmbeddings | None = None
+        if embedding_cache_size > 0:
+            self._embedding_cache = CachedEmbeddings(
+                embeddings,
+                model=openai_embeddings_model,
+                dimensions=embedding_dimensions,
+                max_size=embedding_cache_size,
+                ttl_seconds=embedding_cache_ttl_seconds,
+                path=embedding_cache_path,
+            )
+            embeddings = self._embedding_cache
         self._openai_setup = OpenAISetup(
-            embeddings_api=embeddings_api(
-                openai_embeddings_model,
-                openai_embeddings_deployment,
-                embed_api_key,
-                embed_api_version,
-                embed_endpoint,
-                openai_embed_host=openai_embed_host,
-                embedding_dimensions=embedding_dimensions,
-            ),
+            embeddings_api=embeddings,
             chat_api=chat_api(
                 openai_chat_model,
                 openai_chat_deployment,
@@ -88,20 +174,79 @@ class Setup(ABC):
                 openai_chat_host=openai_chat_host,
             ),
         )
+        # A single client (and so a single connection pool) is shared by the vector store, data and users collections.
+        pool_stats = ConnectionPoolStats()
+        mongo_client = mongo_client_api(
+            connection_string=connection_string,
+            max_pool_size=mongo_max_pool_size,
+            max_idle_time_ms=mongo_max_idle_time_ms,
+            server_selection_timeout_ms=mongo_server_selection_timeout_ms,
+            pool_stats=pool_stats,
+        )
         self._database_setup = DatabaseSetup(
             connection_string=connection_string,
             database_name=database_name,
             collection_name=collection_name,
             index_name=index_name,
             vector_store_api=vector_store_api(
-                connection_string=connection_string,
+                mongo_client=mongo_client,
                 namespace=f"{database_name}.{collection_name}",
                 embedding=self._openai_setup._embeddings_api,
             ),
-            users_collection=setup_users_collection(connection_string=connection_string, database_name=database_name),
+            users_collection=setup_users_collection(mongo_client=mongo_client, database_name=database_name),
             data_collection=setup_data_collection(
-                connection_string=connection_string, database_name=database_name, collection_name=collection_name
+                mongo_client=mongo_client, database_name=database_name, collection_name=collection_name
             ),
+            metadata_collection=setup_metadata_collection(mongo_client=mongo_client, database_name=database_name),
+            mongo_client=mongo_client,
+            pool_stats=pool_stats,
+        )
+
+        # Chat history is written behind the response by a background worker, or inline when that is disabled.
+        self.history_writer = HistoryWriter(
+            self._database_setup._users_collection,
+            max_queue_size=history_queue_size,
+            max_batch_size=history_batch_size,
+            flush_interval_seconds=history_flush_seconds,
+        )
+        self._history_write_behind = history_write_behind
+        # Whether the part of a streamed answer sent before the client disconnected is saved to the history
+        self.stream_persist_partial_answers = stream_persist_partial_answers
+        # Streamed tokens are merged into one NDJSON line per this many milliseconds or characters (0 turns it off)
+        self.stream_coalesce_ms = stream_coalesce_ms
+        self.stream_coalesce_chars = stream_coalesce_chars
+        # Answers streamed over SSE are buffered per session, so a client can reconnect and resume them
+        self.stream_replay = StreamReplay(
+            max_streams=sse_replay_max_streams, max_events=sse_replay_max_events, ttl_seconds=sse_replay_ttl_seconds
+        )
+        # Recent conversations, for clients that only send their newest message
+        self.session_history = SessionHistory(
+            self._database_setup._users_collection,
+            max_sessions=session_cache_size,
+            max_messages=session_history_max_messages,
+        )
+
+        # Answers to near-duplicate RAG questions are served from cache; a cache size of 0 disables it.
+        answer_cache: AnswerCache | None = None
+        if answer_cache_size > 0:
+            answer_cache = AnswerCache(
+                max_size=answer_cache_size,
+                ttl_seconds=answer_cache_ttl_seconds,
+                max_distance=answer_cache_max_distance,
+                metadata_collection=self._database_setup._metadata_collection,
+                collection_name=collection_name,
+                version_poll_seconds=answer_cache_version_poll_seconds,
+            )
+
+        # In-process copy of the vectors, used instead of Cosmos ("primary") or when its index is missing ("fallback")
+        self._local_index: LocalVectorIndex | None = None
+        if local_index_mode != LocalIndexMode.OFF:
+            self._local_index = LocalVectorIndex(self._database_setup._data_collection, local_index_max_documents)
+        self._local_index_refresh_seconds = local_index_refresh_seconds
+
+        # Kind of the Cosmos vector index as recorded by add_data/reindex, so queries use the matching pipeline
+        self._vector_index = RecordedVectorIndex(
+            self._database_setup._metadata_collection, collection_name, ef_search=vector_ef_search
         )
 
         self.vector_search = Vector(
@@ -109,12 +254,41 @@ class Setup(ABC):
             embedding=self._openai_setup._embeddings_api,
             chat=self._openai_setup._chat_api,
             data_collection=self._database_setup._data_collection,
+            local_index=self._local_index,
+            local_index_mode=local_index_mode,
+            vector_index=self._vector_index,
+        )
+        self.hybrid = Hybrid(
+            vector_store=self._database_setup._vector_store_api,
+            embedding=self._openai_setup._embeddings_api,
+            chat=self._openai_setup._chat_api,
+            data_collection=self._database_setup._data_collection,
+            local_index=self._local_index,
+            local_index_mode=local_index_mode,
+            vector_index=self._vector_index,
+            keyword_weight=hybrid_keyword_weight,
+            vector_weight=hybrid_vector_weight,
+            rrf_k=hybrid_rrf_k,
         )
         self.rag = RAG(
             vector_store=self._database_setup._vector_store_api,
             embedding=self._openai_setup._embeddings_api,
             chat=self._openai_setup._chat_api,
             data_collection=self._database_setup._data_collection,
+            rephrase_policy=rephrase_policy,
+            speculative_retrieval=rag_speculative_retrieval,
+            speculative_similarity_threshold=rag_speculative_similarity_threshold,
+            answer_cache=answer_cache,
+            local_index=self._local_index,
+            local_index_mode=local_index_mode,
+            vector_index=self._vector_index,
+            hybrid=self.hybrid if rag_hybrid_context else None,
+            # The rephrase prompt gets the most recent history that fits in the budget, optionally after a summary.
+            history_packer=HistoryPacker(
+                token_counter(openai_chat_model),
+                max_tokens=rag_history_max_tokens,
+                chat=self._openai_setup._chat_api if rag_history_summary else None,
+            ),
         )
         self.keyword = KeyWord(
             vector_store=self._database_setup._vector_store_api,
@@ -122,3 +296,29 @@ class Setup(ABC):
             chat=self._openai_setup._chat_api,
             data_collection=self._database_setup._data_collection,
         )
+
+    def embedding_cache_stats(self) -> dict[str, float]:
+        return self._embedding_cache.stats() if self._embedding_cache else {}
+
+    def embedding_batcher_stats(self) -> dict[str, float]:
+        return self._embedding_batcher.stats() if self._embedding_batcher else {}
+
+    def local_index_stats(self) -> dict[str, Any]:
+        return self._local_index.stats() if self._local_index else {}
+
+    def start(self) -> None:
+        if self._history_write_behind:
+            self.history_writer.start()
+        if self._local_index:
+            # Loads in the background, so serving starts right away (on Cosmos until the first load completes).
+            self._local_index.start(self._local_index_refresh_seconds)
+
+    async def close(self) -> None:
+        await self.stream_replay.close()
+        # Flush queued chat history while the client is still open.
+        await self.history_writer.stop()
+        if self._local_index:
+            await self._local_index.stop()
+        self._database_setup.close()
+        if self._embedding_cache:
+            self._embedding_cache.close()
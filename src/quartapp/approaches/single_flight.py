@@ -0,0 +1,48 @@
+import asyncio
+import re
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+
+def normalize_messages(messages: list[dict[str, Any]]) -> tuple[tuple[str, str], ...]:
+    """The conversation as (role, content) pairs, ignoring case and runs of whitespace."""
+    return tuple(
+        (str(message.get("role", "user")), re.sub(r"\s+", " ", str(message.get("content", ""))).strip().casefold())
+        for message in messages
+    )
+
+
+class SingleFlight:
+    """
+    Shares one computation between concurrent calls with the same key.
+
+    The first caller starts the computation and later callers with the same key wait for its result (or error)
+    instead of starting their own, until it completes; the next call after that starts a new one. The computation
+    runs as its own task, so a caller that is cancelled (e.g. a client disconnecting) does not cancel it for the
+    others.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is not None:
+            self.shared += 1
+        else:
+            call = asyncio.ensure_future(compute())
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+            self.started += 1
+        return await asyncio.shield(call)
+
+    def stats(self) -> dict[str, float]:
+        calls = self.started + self.shared
+        return {
+            "started": self.started,
+            "shared": self.shared,
+            "shared_rate": self.shared / calls if calls else 0.0,
+            "in_flight": len(self._calls),
+        }
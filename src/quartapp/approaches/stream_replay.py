@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import itertools
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncGenerator, AsyncIterator
+from typing import Any
+
+
+class ReplayGapError(Exception):
+    """The events after the requested id have already been dropped from the replay buffer."""
+
+
+class ReplayStream:
+    """
+    The serialized events of one streamed answer, numbered from 1.
+
+    The last `max_events` events are kept in a ring buffer, so a reader that reconnects can resume after the last
+    event it received while the answer is still being produced by a background task.
+    """
+
+    def __init__(self, max_events: int):
+        self._events: deque[tuple[int, str]] = deque(maxlen=max_events)
+        self._last_id = 0
+        self._appended = asyncio.Event()
+        self.finished = False
+        self.producer: asyncio.Task | None = None
+        self.updated_at = time.monotonic()
+
+    def append(self, data: str) -> None:
+        self._last_id += 1
+        self._events.append((self._last_id, data))
+        self.updated_at = time.monotonic()
+        # Wake up every reader waiting for this event, and give the next ones a fresh event to wait on.
+        self._appended.set()
+        self._appended = asyncio.Event()
+
+    def finish(self) -> None:
+        self.finished = True
+        self.updated_at = time.monotonic()
+        self._appended.set()
+
+    def can_resume(self, after: int) -> bool:
+        return not self._events or after >= self._events[0][0] - 1
+
+    async def follow(self, after: int = 0) -> AsyncIterator[tuple[int, str]]:
+        """Yield the events after the id `after`, then the new ones as they are appended, until the stream ends."""
+        if not self.can_resume(after):
+            raise ReplayGapError(f"events after {after} are no longer buffered")
+        while True:
+            appended = self._appended
+            first_id = self._events[0][0] if self._events else self._last_id + 1
+            for event_id, data in list(itertools.islice(self._events, max(after + 1 - first_id, 0), None)):
+                yield event_id, data
+                after = event_id
+            if self.finished:
+                return
+            await appended.wait()
+            if not self.can_resume(after):
+                raise ReplayGapError(f"events after {after} were dropped before they could be sent")
+
+
+class StreamReplay:
+    """
+    Replay buffers of streamed answers, one per session.
+
+    Each answer is produced by a background task that writes its events to the session's `ReplayStream`, and
+    connections only read from there: a client that drops the connection can reconnect with the id of the last
+    event it received and resume without a new completion. A new answer in a session replaces (and cancels) the
+    previous one. At most `max_streams` sessions are kept (the oldest answer is dropped, and cancelled if it is still
+    running, to make room) and finished streams expire `ttl_seconds` after their last event.
+    """
+
+    def __init__(self, max_streams: int = 256, max_events: int = 512, ttl_seconds: float = 300):
+        self._max_streams = max_streams
+        self._max_events = max_events
+        self._ttl_seconds = ttl_seconds
+        self._streams: OrderedDict[str, ReplayStream] = OrderedDict()
+        self.started = 0
+        self.resumed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _expire(self) -> None:
+        deadline = time.monotonic() - self._ttl_seconds
+        for key, stream in list(self._streams.items()):
+            if stream.finished and stream.updated_at < deadline:
+                del self._streams[key]
+                self.expired += 1
+
+    def _remove(self, key: str) -> None:
+        stream = self._streams.pop(key, None)
+        if stream is not None and stream.producer is not None:
+            stream.producer.cancel()
+
+    def start(self, key: str, lines: AsyncGenerator[str, None]) -> ReplayStream:
+        """Produce the `lines` of a new answer into the replay buffer of `key` in the background."""
+        self._expire()
+        self._remove(key)
+        while len(self._streams) >= self._max_streams:
+            self._remove(next(iter(self._streams)))
+            self.evicted += 1
+
+        stream = ReplayStream(self._max_events)
+        self._streams[key] = stream
+        stream.producer = asyncio.create_task(self._produce(stream, lines))
+        self.started += 1
+        return stream
+
+    async def _produce(self, stream: ReplayStream, lines: AsyncGenerator[str, None]) -> None:
+        try:
+            # Closing the lines when the producer is cancelled also stops the completion behind them.
+            async with contextlib.aclosing(lines):
+                async for line in lines:
+                    stream.append(line)
+        finally:
+            stream.finish()
+
+    def resume(self, key: str) -> ReplayStream | None:
+        self._expire()
+        stream = self._streams.get(key)
+        if stream is not None:
+            self.resumed += 1
+        return stream
+
+    async def close(self) -> None:
+        producers = [stream.producer for stream in self._streams.values() if stream.producer is not None]
+        for producer in producers:
+            producer.cancel()
+        for producer in producers:
+            with contextlib.suppress(asyncio.CancelledError):
+                await producer
+        self._streams.clear()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "streams": len(self._streams),
+            "running": sum(not stream.finished for stream in self._streams.values()),
+            "max_streams": self._max_streams,
+            "max_events": self._max_events,
+            "started": self.started,
+            "resumed": self.resumed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
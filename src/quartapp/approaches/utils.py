@@ -1,12 +1,24 @@
+import hashlib
+import math
+import threading
+from datetime import datetime, timezone
+from typing import Any
+
 from langchain_community.vectorstores import AzureCosmosDBVectorSearch
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings, ChatOpenAI, OpenAIEmbeddings
 from langchain_openai.chat_models.base import BaseChatOpenAI
 from pydantic import SecretStr
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 from pymongo.collection import Collection
 from pymongo.errors import ServerSelectionTimeoutError
 
+from quartapp.approaches.async_collection import AsyncCollection
+
+# One document per data collection, keyed by the collection name
+METADATA_COLLECTION_NAME = "Metadata"
+
 
 def embeddings_api(
     openai_embeddings_model: str,
@@ -102,27 +114,160 @@ def chat_api(
         )
 
 
-def vector_store_api(connection_string: str, namespace: str, embedding: Embeddings) -> AzureCosmosDBVectorSearch:
-    return AzureCosmosDBVectorSearch.from_connection_string(
-        connection_string=connection_string,
-        namespace=namespace,
+class ConnectionPoolStats(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener that keeps running counters, summed over the servers of the cluster.
+
+    pymongo publishes pool events from its own background threads, so every update is taken under a lock.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._servers: set[tuple[str, int | None]] = set()
+        self._counters = {"open": 0, "in_use": 0, "created": 0, "closed": 0, "checkout_failures": 0, "cleared": 0}
+
+    def _bump(self, address: tuple[str, int | None], **deltas: int) -> None:
+        with self._lock:
+            self._servers.add(address)
+            for name, delta in deltas.items():
+                self._counters[name] += delta
+
+    def snapshot(self) -> dict[str, int]:
+        # Only the number of servers is reported, not their addresses.
+        with self._lock:
+            return {"servers": len(self._servers), **self._counters}
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent) -> None:
+        self._bump(event.address)
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent) -> None:
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent) -> None:
+        self._bump(event.address, cleared=1)
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent) -> None:
+        pass
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent) -> None:
+        self._bump(event.address, open=1, created=1)
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent) -> None:
+        pass
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent) -> None:
+        self._bump(event.address, open=-1, closed=1)
+
+    def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent) -> None:
+        pass
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent) -> None:
+        self._bump(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent) -> None:
+        self._bump(event.address, in_use=1)
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent) -> None:
+        self._bump(event.address, in_use=-1)
+
+
+def mongo_client_api(
+    connection_string: str,
+    max_pool_size: int = 100,
+    max_idle_time_ms: int | None = None,
+    server_selection_timeout_ms: int = 1000,
+    pool_stats: ConnectionPoolStats | None = None,
+) -> MongoClient:
+    return MongoClient(
+        connection_string,
+        maxPoolSize=max_pool_size,
+        maxIdleTimeMS=max_idle_time_ms,
+        serverSelectionTimeoutMS=server_selection_timeout_ms,
+        event_listeners=[pool_stats] if pool_stats else [],
+    )
+
+
+# Fields the approaches read from a stored document; the embedding itself is never sent back.
+TEXT_SEARCH_PROJECTION = {"textContent": 1, "metadata": 1}
+# $text matches come back in no particular order, so keyword results are ranked by their relevance score.
+TEXT_SCORE = {"$meta": "textScore"}
+
+
+class ProjectedVectorSearch(AzureCosmosDBVectorSearch):
+    """
+    AzureCosmosDBVectorSearch whose search pipelines return only `_id`, the text and the metadata.
+
+    The stock pipelines project `$$ROOT`, which ships the full embedding array back with every hit only for it
+    to be discarded, so `with_embedding=True` searches are not supported.
+    """
+
+    def _project_stored_fields(self, pipeline: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        pipeline[-1] = {
+            "$project": {
+                "similarityScore": {"$meta": "searchScore"},
+                "document": {"_id": "$_id", self._text_key: f"${self._text_key}", "metadata": "$metadata"},
+            }
+        }
+        return pipeline
+
+    def _get_pipeline_vector_ivf(self, *args: Any, **kwargs: Any) -> list[dict[str, Any]]:
+        return self._project_stored_fields(super()._get_pipeline_vector_ivf(*args, **kwargs))
+
+    def _get_pipeline_vector_hnsw(self, *args: Any, **kwargs: Any) -> list[dict[str, Any]]:
+        return self._project_stored_fields(super()._get_pipeline_vector_hnsw(*args, **kwargs))
+
+    def _get_pipeline_vector_diskann(self, *args: Any, **kwargs: Any) -> list[dict[str, Any]]:
+        return self._project_stored_fields(super()._get_pipeline_vector_diskann(*args, **kwargs))
+
+
+def vector_store_api(mongo_client: MongoClient, namespace: str, embedding: Embeddings) -> AzureCosmosDBVectorSearch:
+    database_name, collection_name = namespace.split(".")
+    return ProjectedVectorSearch(
+        collection=mongo_client[database_name][collection_name],
         embedding=embedding,
     )
 
 
-def setup_users_collection(connection_string: str, database_name: str) -> Collection:
-    mongo_client: MongoClient = MongoClient(connection_string)
+def setup_users_collection(mongo_client: MongoClient, database_name: str) -> AsyncCollection:
     db = mongo_client[database_name]
     collection: Collection = db["Users"]
-    return collection
+    return AsyncCollection(collection)
 
 
-def setup_data_collection(connection_string: str, database_name: str, collection_name: str) -> Collection:
+def setup_metadata_collection(mongo_client: MongoClient, database_name: str) -> AsyncCollection:
+    db = mongo_client[database_name]
+    collection: Collection = db[METADATA_COLLECTION_NAME]
+    return AsyncCollection(collection)
+
+
+def bump_data_version(metadata_collection: Collection, collection_name: str) -> None:
+    # Anything derived from the data collection (e.g. cached answers) is stale once the version changes.
+    metadata_collection.update_one(
+        {"_id": collection_name},
+        {"$inc": {"data_version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},  # noqa: UP017
+        upsert=True,
+    )
+
+
+def setup_data_collection(mongo_client: MongoClient, database_name: str, collection_name: str) -> AsyncCollection:
     try:
-        mongo_client: MongoClient = MongoClient(connection_string, serverSelectionTimeoutMS=1000)
         db = mongo_client[database_name]
         collection: Collection = db[collection_name]
         collection.create_index({"textContent": "text"}, name="search_text_index")
-        return collection
+        return AsyncCollection(collection)
     except ServerSelectionTimeoutError:
         raise ServerSelectionTimeoutError
+
+
+def document_id(document: Document) -> str:
+    # Retrieved documents carry their Mongo _id; fall back to the content for anything that does not.
+    if "_id" in document.metadata:
+        return str(document.metadata["_id"])
+    return hashlib.sha256(document.page_content.encode()).hexdigest()
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    if not norm:
+        return 0.0
+    return sum(x * y for x, y in zip(a, b, strict=True)) / norm
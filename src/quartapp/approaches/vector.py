@@ -8,10 +8,7 @@ class Vector(ApproachesBase):
         self, messages: list, temperature: float, limit: int, score_threshold: float
     ) -> tuple[list[Document], str]:
         query = messages[-1]["content"]
-        retriever = self._vector_store.as_retriever(
-            search_type="similarity", search_kwargs={"k": limit, "score_threshold": score_threshold}
-        )
-        vector_response = await retriever.ainvoke(query)
+        vector_response = await self._similarity_search(query, limit, score_threshold)
         documents_list: list[Document] = []
 
         if vector_response:
@@ -0,0 +1,222 @@
+import logging
+import math
+import time
+from argparse import ArgumentParser, Namespace
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any
+
+from langchain_community.vectorstores.azure_cosmos_db import (
+    AzureCosmosDBVectorSearch,
+    CosmosDBSimilarityType,
+    CosmosDBVectorSearchType,
+)
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.ingestion import EMBEDDING_KEY
+
+# Collections below MID_SIZE_COLLECTION documents get an IVF index, an HNSW index up to LARGE_COLLECTION and an IVF
+# index again beyond, where building and holding the HNSW graph gets too expensive.
+MID_SIZE_COLLECTION = 50_000
+LARGE_COLLECTION = 1_000_000
+INDEX_KINDS = {
+    "ivf": CosmosDBVectorSearchType.VECTOR_IVF,
+    "hnsw": CosmosDBVectorSearchType.VECTOR_HNSW,
+    "diskann": CosmosDBVectorSearchType.VECTOR_DISKANN,
+}
+# Size of the candidate list of HNSW queries (the AzureCosmosDBVectorSearch default), raised to k for larger queries.
+DEFAULT_EF_SEARCH = 40
+# How often the app reads the recorded index options again, so it follows a reindex.
+INDEX_POLL_SECONDS = 60
+
+
+@dataclass(frozen=True)
+class VectorIndexParams:
+    """Options of the vector index; only the ones of its `kind` are sent to the database."""
+
+    kind: CosmosDBVectorSearchType
+    dimensions: int
+    similarity: CosmosDBSimilarityType = CosmosDBSimilarityType.COS
+    num_lists: int = 1
+    m: int = 16
+    ef_construction: int = 64
+    max_degree: int = 32
+    l_build: int = 50
+
+    def to_dict(self) -> dict[str, Any]:
+        options: dict[str, Any] = {
+            "kind": self.kind.value,
+            "dimensions": self.dimensions,
+            "similarity": self.similarity.value,
+        }
+        if self.kind == CosmosDBVectorSearchType.VECTOR_IVF:
+            options["num_lists"] = self.num_lists
+        elif self.kind == CosmosDBVectorSearchType.VECTOR_HNSW:
+            options.update(m=self.m, ef_construction=self.ef_construction)
+        else:
+            options.update(max_degree=self.max_degree, l_build=self.l_build)
+        return options
+
+
+def choose_index_params(
+    document_count: int,
+    dimensions: int,
+    kind: CosmosDBVectorSearchType | None = None,
+    num_lists: int | None = None,
+    m: int | None = None,
+    ef_construction: int | None = None,
+) -> VectorIndexParams:
+    """
+    Index options for a collection of `document_count` documents, any of which can be set explicitly instead.
+
+    IVF indexes get one list per 1000 documents up to LARGE_COLLECTION (so a small catalog is searched exactly in a
+    single list) and sqrt(document_count) lists beyond, as recommended for Azure Cosmos DB for MongoDB vCore.
+    """
+    if kind is None:
+        mid_size = MID_SIZE_COLLECTION <= document_count < LARGE_COLLECTION
+        kind = CosmosDBVectorSearchType.VECTOR_HNSW if mid_size else CosmosDBVectorSearchType.VECTOR_IVF
+    if num_lists is None:
+        num_lists = document_count // 1000 if document_count < LARGE_COLLECTION else round(math.sqrt(document_count))
+    params = VectorIndexParams(
+        kind=kind,
+        dimensions=dimensions,
+        num_lists=max(num_lists, 1),
+        m=m if m is not None else 16,
+        ef_construction=ef_construction if ef_construction is not None else 64,
+    )
+    if kind == CosmosDBVectorSearchType.VECTOR_HNSW and params.ef_construction < 2 * params.m:
+        raise ValueError(f"ef_construction ({params.ef_construction}) must be at least twice m ({params.m})")
+    return params
+
+
+def stored_dimensions(collection: Collection) -> int | None:
+    """The dimensions of the embeddings already stored in the collection, which the index has to match."""
+    document = collection.find_one({EMBEDDING_KEY: {"$exists": True}}, {EMBEDDING_KEY: 1})
+    return len(document[EMBEDDING_KEY]) if document else None
+
+
+def recorded_index(metadata_collection: Collection, collection_name: str) -> dict[str, Any] | None:
+    metadata = metadata_collection.find_one({"_id": collection_name}, {"vector_index": 1})
+    return metadata.get("vector_index") if metadata else None
+
+
+class RecordedVectorIndex:
+    """
+    The vector index options recorded by `ensure_vector_index`, read back by the app to query the index.
+
+    `AzureCosmosDBVectorSearch` builds a different search pipeline for each kind of index and assumes IVF unless told
+    otherwise, so an HNSW or DiskANN index has to be queried with its own kind. The record is read again every
+    `poll_seconds`; until one is found, or while it cannot be read, the last known kind (IVF at first) is used.
+    """
+
+    def __init__(
+        self,
+        metadata_collection: AsyncCollection,
+        collection_name: str,
+        ef_search: int = DEFAULT_EF_SEARCH,
+        poll_seconds: float = INDEX_POLL_SECONDS,
+    ):
+        self._metadata_collection = metadata_collection
+        self._collection_name = collection_name
+        self._ef_search = ef_search
+        self._poll_seconds = poll_seconds
+        self._kind = CosmosDBVectorSearchType.VECTOR_IVF
+        self._checked_at: float | None = None
+
+    async def _check_recorded_index(self) -> None:
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self._poll_seconds:
+            return
+        self._checked_at = now
+        try:
+            metadata = await self._metadata_collection.find_one({"_id": self._collection_name}, {"vector_index": 1})
+        except PyMongoError as error:
+            logging.warning("Could not read the vector index options, querying it as %s: %s", self._kind.value, error)
+            return
+        params = ((metadata or {}).get("vector_index") or {}).get("params") or {}
+        kinds = {kind.value: kind for kind in INDEX_KINDS.values()}
+        self._kind = kinds.get(params.get("kind", ""), CosmosDBVectorSearchType.VECTOR_IVF)
+
+    async def search_options(self, k: int) -> dict[str, Any]:
+        """Keyword arguments of `AzureCosmosDBVectorSearch._similarity_search_with_score` for a top-`k` query."""
+        await self._check_recorded_index()
+        return {"kind": self._kind, "ef_search": max(self._ef_search, k)}
+
+
+def ensure_vector_index(
+    vector_store: AzureCosmosDBVectorSearch,
+    metadata_collection: Collection,
+    collection_name: str,
+    params: VectorIndexParams,
+    document_count: int,
+    rebuild: bool = False,
+) -> bool:
+    """
+    Create the vector index with `params` and record them (with the document count) in the metadata collection.
+
+    An index already built with the same options is kept unless `rebuild` is set; one built with other options is
+    dropped first, since a collection cannot have two vector indexes on the same field. Returns whether the index
+    was (re)built.
+    """
+    recorded = recorded_index(metadata_collection, collection_name)
+    exists = vector_store.index_exists()
+    if exists and not rebuild and recorded is not None and recorded.get("params") == params.to_dict():
+        logging.info("The vector index is up to date: %s", recorded["params"])
+        return False
+    if exists:
+        vector_store.delete_index()
+    vector_store.create_index(
+        num_lists=params.num_lists,
+        dimensions=params.dimensions,
+        similarity=params.similarity,
+        kind=params.kind,
+        m=params.m,
+        ef_construction=params.ef_construction,
+        max_degree=params.max_degree,
+        l_build=params.l_build,
+    )
+    metadata_collection.update_one(
+        {"_id": collection_name},
+        {
+            "$set": {
+                "vector_index": {
+                    "params": params.to_dict(),
+                    "document_count": document_count,
+                    "created_at": datetime.now(timezone.utc),  # noqa: UP017
+                }
+            }
+        },
+        upsert=True,
+    )
+    return True
+
+
+def add_index_arguments(parser: ArgumentParser) -> None:
+    """Command line options overriding the index options chosen from the document count."""
+    parser.add_argument(
+        "--index-kind",
+        choices=["auto", *INDEX_KINDS],
+        default="auto",
+        help="kind of vector index, chosen from the number of documents by default",
+    )
+    parser.add_argument("--num-lists", type=int, default=None, help="number of lists of an IVF index")
+    parser.add_argument("--m", type=int, default=None, help="max connections per layer of an HNSW index")
+    parser.add_argument(
+        "--ef-construction",
+        type=int,
+        default=None,
+        help="candidate list size used to build an HNSW index (at least twice --m)",
+    )
+
+
+def index_params_from_args(input_args: Namespace, document_count: int, dimensions: int) -> VectorIndexParams:
+    return choose_index_params(
+        document_count,
+        dimensions,
+        kind=INDEX_KINDS.get(input_args.index_kind),
+        num_lists=input_args.num_lists,
+        m=input_args.m,
+        ef_construction=input_args.ef_construction,
+    )
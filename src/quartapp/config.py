@@ -1,52 +1,74 @@
+import asyncio
 import json
+import time
 from collections.abc import AsyncGenerator
 from uuid import uuid4
 
+from langchain_core.documents import Document
 from pymongo.errors import OperationFailure
 
+from quartapp.approaches.base import ApproachesBase
+from quartapp.approaches.local_index import (  # noqa: F401 (MISSING_SIMILARITY_INDEX_ERROR is re-exported)
+    MISSING_SIMILARITY_INDEX_ERROR,
+    is_missing_similarity_index_error,
+)
+from quartapp.approaches.rag import close_stream
 from quartapp.approaches.schemas import (
     AIChatRoles,
     Context,
     DataPoint,
     Message,
+    RetrievalMode,
     RetrievalResponse,
     RetrievalResponseDelta,
+    StageEvent,
+    StreamStage,
     Thought,
 )
+from quartapp.approaches.single_flight import normalize_messages
 from quartapp.config_base import AppConfigBase
 
-MISSING_SIMILARITY_INDEX_ERROR = "Similarity index was not found for a vector similarity search query."
-
-
-def is_missing_similarity_index_error(error: OperationFailure) -> bool:
-    return error.code == 2 and MISSING_SIMILARITY_INDEX_ERROR in str(error)
-
 
 class AppConfig(AppConfigBase):
     def _no_results_context(self) -> Context:
         return Context([DataPoint()], [Thought()])
 
-    def _no_results_response(self, session_state: str) -> RetrievalResponse:
+    async def _no_results_response(
+        self, session_state: str | None, new_session_state: str, messages: list, content: str = "No results found"
+    ) -> RetrievalResponse:
+        message = Message(content=content, role=AIChatRoles.ASSISTANT)
+
+        # Stored like any other answer, so the turn stays in the server-side history.
+        await self.add_to_cosmos(
+            old_messages=messages,
+            new_message=message.to_dict(),
+            session_state=session_state,
+            new_session_state=new_session_state,
+        )
+
         return RetrievalResponse(
-            sessionState=session_state,
+            sessionState=new_session_state,
             context=self._no_results_context(),
-            message=Message(content="No results found", role=AIChatRoles.ASSISTANT),
+            message=message,
         )
 
-    async def run_keyword(
-        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
-    ) -> RetrievalResponse:
-        new_session_state: str = session_state if session_state else str(uuid4())
-
-        try:
-            keyword_response, answer = await self.setup.keyword.run(messages, temperature, limit, score_threshold)
-        except OperationFailure:
-            return self._no_results_response(new_session_state)
-
-        if keyword_response is None or len(keyword_response) == 0:
-            return self._no_results_response(new_session_state)
+    async def _shared_run(
+        self,
+        mode: RetrievalMode,
+        approach: ApproachesBase,
+        messages: list,
+        temperature: float,
+        limit: int,
+        score_threshold: float,
+    ) -> tuple[list[Document], str]:
+        """Run the approach, sharing the run with identical requests already in flight."""
+        if self.single_flight is None:
+            return await approach.run(messages, temperature, limit, score_threshold)
+        key = (mode, normalize_messages(messages), limit, score_threshold, temperature)
+        return await self.single_flight.do(key, lambda: approach.run(messages, temperature, limit, score_threshold))
+
+    def _top_result_message(self, answer: str) -> Message:
         top_result = json.loads(answer)
-
         message_content = f"""
             Name: {top_result.get("name")}
             Description: {top_result.get("description")}
@@ -54,12 +76,38 @@ class AppConfig(AppConfigBase):
             Category: {top_result.get("category")}
             Collection: {self.setup._database_setup._collection_name}
         """
+        return Message(content=message_content, role=AIChatRoles.ASSISTANT)
+
+    async def _search_context(self, documents: list[Document], answer: str, query: str, title: str) -> Context:
+        context: Context = await self.get_context(documents)
+        context.thoughts.insert(0, Thought(description=answer, title=f"{title} Top Result"))
+        context.thoughts.insert(0, Thought(description=str(documents), title=f"{title} Result"))
+        context.thoughts.insert(0, Thought(description=query, title=f"{title} Query"))
+        return context
+
+    async def _run_search(
+        self,
+        mode: RetrievalMode,
+        approach: ApproachesBase,
+        title: str,
+        session_state: str | None,
+        messages: list,
+        temperature: float,
+        limit: int,
+        score_threshold: float,
+    ) -> RetrievalResponse:
+        new_session_state: str = session_state if session_state else str(uuid4())
 
-        context: Context = await self.get_context(keyword_response)
-        context.thoughts.insert(0, Thought(description=answer, title="Cosmos Text Search Top Result"))
-        context.thoughts.insert(0, Thought(description=str(keyword_response), title="Cosmos Text Search Result"))
-        context.thoughts.insert(0, Thought(description=messages[-1]["content"], title="Cosmos Text Search Query"))
-        message: Message = Message(content=message_content, role=AIChatRoles.ASSISTANT)
+        try:
+            documents, answer = await self._shared_run(mode, approach, messages, temperature, limit, score_threshold)
+        except OperationFailure:
+            return await self._no_results_response(session_state, new_session_state, messages)
+
+        if documents is None or len(documents) == 0:
+            return await self._no_results_response(session_state, new_session_state, messages)
+
+        context = await self._search_context(documents, answer, messages[-1]["content"], title)
+        message = self._top_result_message(answer)
 
         await self.add_to_cosmos(
             old_messages=messages,
@@ -70,42 +118,139 @@ class AppConfig(AppConfigBase):
 
         return RetrievalResponse(context, message, new_session_state)
 
-    async def run_vector(
-        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
-    ) -> RetrievalResponse:
+    async def _run_search_stream(
+        self,
+        mode: RetrievalMode,
+        approach: ApproachesBase,
+        title: str,
+        session_state: str | None,
+        messages: list,
+        temperature: float,
+        limit: int,
+        score_threshold: float,
+    ) -> AsyncGenerator[RetrievalResponseDelta, None]:
         new_session_state: str = session_state if session_state else str(uuid4())
 
         try:
-            vector_response, answer = await self.setup.vector_search.run(messages, temperature, limit, score_threshold)
+            documents, answer = await self._shared_run(mode, approach, messages, temperature, limit, score_threshold)
         except OperationFailure:
-            return self._no_results_response(new_session_state)
-
-        if vector_response is None or len(vector_response) == 0:
-            return self._no_results_response(new_session_state)
-        top_result = json.loads(answer)
+            documents, answer = [], ""
 
-        message_content = f"""
-            Name: {top_result.get("name")}
-            Description: {top_result.get("description")}
-            Price: {top_result.get("price")}
-            Category: {top_result.get("category")}
-            Collection: {self.setup._database_setup._collection_name}
-        """
+        if documents is None or len(documents) == 0:
+            no_results = Message(content="No results found", role=AIChatRoles.ASSISTANT)
+            yield RetrievalResponseDelta(context=self._no_results_context(), sessionState=new_session_state)
+            yield RetrievalResponseDelta(delta=no_results)
+            self.add_to_cosmos_later(
+                old_messages=messages,
+                new_message=no_results.to_dict(),
+                session_state=session_state,
+                new_session_state=new_session_state,
+            )
+            return
 
-        context: Context = await self.get_context(vector_response)
-        context.thoughts.insert(0, Thought(description=answer, title="Cosmos Vector Search Top Result"))
-        context.thoughts.insert(0, Thought(description=str(vector_response), title="Cosmos Vector Search Result"))
-        context.thoughts.insert(0, Thought(description=messages[-1]["content"], title="Cosmos Vector Search Query"))
-        message: Message = Message(content=message_content, role=AIChatRoles.ASSISTANT)
+        # The data points go out as soon as retrieval is done, then the answer line by line.
+        yield RetrievalResponseDelta(
+            context=await self._search_context(documents, answer, messages[-1]["content"], title),
+            sessionState=new_session_state,
+        )
+        message = self._top_result_message(answer)
+        for line in (message.content or "").splitlines(keepends=True):
+            yield RetrievalResponseDelta(delta=Message(content=line, role=AIChatRoles.ASSISTANT))
 
-        await self.add_to_cosmos(
+        # The answer is fully sent: the response ends now and the exchange is recorded after it.
+        self.add_to_cosmos_later(
             old_messages=messages,
             new_message=message.to_dict(),
             session_state=session_state,
             new_session_state=new_session_state,
         )
 
-        return RetrievalResponse(context, message, new_session_state)
+    async def run_keyword(
+        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> RetrievalResponse:
+        return await self._run_search(
+            RetrievalMode.KEYWORD,
+            self.setup.keyword,
+            "Cosmos Text Search",
+            session_state,
+            messages,
+            temperature,
+            limit,
+            score_threshold,
+        )
+
+    async def run_keyword_stream(
+        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        async for delta in self._run_search_stream(
+            RetrievalMode.KEYWORD,
+            self.setup.keyword,
+            "Cosmos Text Search",
+            session_state,
+            messages,
+            temperature,
+            limit,
+            score_threshold,
+        ):
+            yield delta
+
+    async def run_vector(
+        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> RetrievalResponse:
+        return await self._run_search(
+            RetrievalMode.VECTOR,
+            self.setup.vector_search,
+            "Cosmos Vector Search",
+            session_state,
+            messages,
+            temperature,
+            limit,
+            score_threshold,
+        )
+
+    async def run_vector_stream(
+        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        async for delta in self._run_search_stream(
+            RetrievalMode.VECTOR,
+            self.setup.vector_search,
+            "Cosmos Vector Search",
+            session_state,
+            messages,
+            temperature,
+            limit,
+            score_threshold,
+        ):
+            yield delta
+
+    async def run_hybrid(
+        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> RetrievalResponse:
+        return await self._run_search(
+            RetrievalMode.HYBRID,
+            self.setup.hybrid,
+            "Cosmos Hybrid Search",
+            session_state,
+            messages,
+            temperature,
+            limit,
+            score_threshold,
+        )
+
+    async def run_hybrid_stream(
+        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        async for delta in self._run_search_stream(
+            RetrievalMode.HYBRID,
+            self.setup.hybrid,
+            "Cosmos Hybrid Search",
+            session_state,
+            messages,
+            temperature,
+            limit,
+            score_threshold,
+        ):
+            yield delta
 
     async def run_rag(
         self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
@@ -113,23 +258,23 @@ class AppConfig(AppConfigBase):
         new_session_state: str = session_state if session_state else str(uuid4())
 
         try:
-            rag_response, answer = await self.setup.rag.run(messages, temperature, limit, score_threshold)
+            rag_response, answer = await self._shared_run(
+                RetrievalMode.RAG, self.setup.rag, messages, temperature, limit, score_threshold
+            )
         except OperationFailure as error:
             if not is_missing_similarity_index_error(error):
                 raise
-            return self._no_results_response(new_session_state)
+            return await self._no_results_response(session_state, new_session_state, messages)
 
         json_answer = json.loads(answer)
 
         if rag_response is None or len(rag_response) == 0:
             if answer:
-                return RetrievalResponse(
-                    sessionState=new_session_state,
-                    context=self._no_results_context(),
-                    message=Message(content=json_answer.get("response"), role=AIChatRoles.ASSISTANT),
+                return await self._no_results_response(
+                    session_state, new_session_state, messages, json_answer.get("response")
                 )
             else:
-                return self._no_results_response(new_session_state)
+                return await self._no_results_response(session_state, new_session_state, messages)
 
         context: Context = await self.get_context(rag_response)
         context.thoughts.insert(
@@ -138,9 +283,24 @@ class AppConfig(AppConfigBase):
         context.thoughts.insert(
             0, Thought(description=str(rag_response), title="Cosmos RAG Search Vector Search Result")
         )
+        if json_answer.get("answer_cache"):
+            context.thoughts.insert(
+                0, Thought(description=json_answer.get("answer_cache"), title="Cosmos RAG Answer Cache")
+            )
+        if json_answer.get("speculation"):
+            context.thoughts.insert(
+                0, Thought(description=json_answer.get("speculation"), title="Cosmos RAG Speculative Retrieval")
+            )
         context.thoughts.insert(
             0, Thought(description=json_answer.get("rephrased_response"), title="Cosmos RAG OpenAI Rephrased Query")
         )
+        if json_answer.get("rephrase_history"):
+            context.thoughts.insert(
+                0, Thought(description=json_answer.get("rephrase_history"), title="Cosmos RAG Rephrase History")
+            )
+        context.thoughts.insert(
+            0, Thought(description=json_answer.get("rephrase_decision"), title="Cosmos RAG Rephrase Policy")
+        )
         context.thoughts.insert(0, Thought(description=messages[-1]["content"], title="Cosmos RAG Query"))
         message: Message = Message(content=json_answer.get("response"), role=AIChatRoles.ASSISTANT)
 
@@ -158,30 +318,91 @@ class AppConfig(AppConfigBase):
     ) -> AsyncGenerator[RetrievalResponseDelta, None]:
         new_session_state: str = session_state if session_state else str(uuid4())
 
+        # Retrieval runs as a task so its stage events can be sent while it is still in flight.
+        started = time.perf_counter()
+        stages: asyncio.Queue[StageEvent] = asyncio.Queue()
+
+        def on_stage(name: StreamStage, detail: str | None) -> None:
+            stages.put_nowait(StageEvent(name, round((time.perf_counter() - started) * 1000, 1), detail))
+
+        retrieval = asyncio.ensure_future(
+            self.setup.rag.run_stream(messages, temperature, limit, score_threshold, on_stage=on_stage)
+        )
+        next_stage: asyncio.Future[StageEvent] | None = None
+        try:
+            while not retrieval.done() or not stages.empty():
+                next_stage = asyncio.ensure_future(stages.get())
+                await asyncio.wait({retrieval, next_stage}, return_when=asyncio.FIRST_COMPLETED)
+                if next_stage.done():
+                    yield RetrievalResponseDelta(stage=next_stage.result())
+                else:
+                    next_stage.cancel()
+        finally:
+            # No-ops once retrieval is done; otherwise the client went away before it finished.
+            retrieval.cancel()
+            if next_stage is not None:
+                next_stage.cancel()
+
         try:
-            rag_response, answer = await self.setup.rag.run_stream(messages, temperature, limit, score_threshold)
+            rag_response, answer, rephrased_question = await retrieval
         except OperationFailure as error:
             if not is_missing_similarity_index_error(error):
                 raise
 
+            message = Message(content="No results found", role=AIChatRoles.ASSISTANT)
             yield RetrievalResponseDelta(context=self._no_results_context(), sessionState=new_session_state)
-            yield RetrievalResponseDelta(delta=Message(content="No results found", role=AIChatRoles.ASSISTANT))
+            yield RetrievalResponseDelta(delta=message)
+            await self.add_to_cosmos(
+                old_messages=messages,
+                new_message=message.to_dict(),
+                session_state=session_state,
+                new_session_state=new_session_state,
+            )
             return
 
         context: Context = await self.get_context(rag_response)
         context.thoughts.insert(
             0, Thought(description=str(rag_response), title="Cosmos RAG Search Vector Search Result")
         )
+        if rephrased_question.answer_cache:
+            context.thoughts.insert(
+                0, Thought(description=rephrased_question.answer_cache, title="Cosmos RAG Answer Cache")
+            )
+        if rephrased_question.speculation:
+            context.thoughts.insert(
+                0, Thought(description=rephrased_question.speculation, title="Cosmos RAG Speculative Retrieval")
+            )
+        context.thoughts.insert(
+            0, Thought(description=rephrased_question.content, title="Cosmos RAG OpenAI Rephrased Query")
+        )
+        if rephrased_question.history:
+            context.thoughts.insert(
+                0, Thought(description=rephrased_question.history, title="Cosmos RAG Rephrase History")
+            )
+        context.thoughts.insert(0, Thought(description=rephrased_question.decision, title="Cosmos RAG Rephrase Policy"))
         context.thoughts.insert(0, Thought(description=messages[-1]["content"], title="Cosmos RAG Query"))
 
         yield RetrievalResponseDelta(context=context, sessionState=new_session_state)
 
         full_message_content = ""
-        async for message_chunk in answer:
-            chunk_content = str(message_chunk.content)
-            full_message_content += chunk_content
-            message = Message(content=chunk_content, role=AIChatRoles.ASSISTANT)
-            yield RetrievalResponseDelta(delta=message)
+        try:
+            async for message_chunk in answer:
+                chunk_content = str(message_chunk.content)
+                full_message_content += chunk_content
+                message = Message(content=chunk_content, role=AIChatRoles.ASSISTANT)
+                yield RetrievalResponseDelta(delta=message)
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client disconnected: stop the model stream now rather than when it is garbage collected.
+            await close_stream(answer)
+            if full_message_content and self.setup.stream_persist_partial_answers:
+                partial_message = Message(content=full_message_content, role=AIChatRoles.ASSISTANT)
+                await self.add_to_cosmos(
+                    old_messages=messages,
+                    new_message={**partial_message.to_dict(), "partial": True},
+                    session_state=session_state,
+                    new_session_state=new_session_state,
+                )
+            raise
 
         # Only save to Cosmos if we have content
         if full_message_content:
@@ -1,7 +1,8 @@
+import asyncio
 import json
 import os
 from abc import ABC, abstractmethod
-from datetime import datetime, timezone
+from typing import Any
 from urllib.parse import quote_plus
 
 from langchain_core.documents import Document
@@ -13,8 +14,14 @@ from pymongo.errors import (
     OperationFailure,
 )
 
-from quartapp.approaches.schemas import Context, DataPoint, RetrievalResponse, Thought
+from quartapp.approaches.history_writer import HistoryMutation
+from quartapp.approaches.hybrid import RRF_K
+from quartapp.approaches.local_index import LOCAL_INDEX_MAX_DOCUMENTS
+from quartapp.approaches.rag import SPECULATIVE_SIMILARITY_THRESHOLD
+from quartapp.approaches.schemas import Context, DataPoint, LocalIndexMode, RephrasePolicy, RetrievalResponse, Thought
 from quartapp.approaches.setup import Setup
+from quartapp.approaches.single_flight import SingleFlight
+from quartapp.approaches.vector_index import DEFAULT_EF_SEARCH
 
 
 def read_and_parse_connection_string() -> str:
@@ -29,18 +36,38 @@ def read_and_parse_connection_string() -> str:
 
 class AppConfigBase(ABC):
     @staticmethod
-    def _parse_embedding_dimensions(dimensions_str: str | None, env_var_name: str) -> int | None:
-        if dimensions_str is not None:
-            dimensions_str = dimensions_str.strip()
-            if dimensions_str:
+    def _parse_optional_int(value_str: str | None, env_var_name: str) -> int | None:
+        if value_str is not None:
+            value_str = value_str.strip()
+            if value_str:
                 try:
-                    return int(dimensions_str)
+                    return int(value_str)
                 except ValueError:
-                    raise ValueError(
-                        f"Invalid {env_var_name} value: {dimensions_str!r}. It must be an integer or unset."
-                    )
+                    raise ValueError(f"Invalid {env_var_name} value: {value_str!r}. It must be an integer or unset.")
         return None
 
+    @staticmethod
+    def _parse_optional_float(value_str: str | None, env_var_name: str) -> float | None:
+        if value_str is not None:
+            value_str = value_str.strip()
+            if value_str:
+                try:
+                    return float(value_str)
+                except ValueError:
+                    raise ValueError(f"Invalid {env_var_name} value: {value_str!r}. It must be a number or unset.")
+        return None
+
+    @staticmethod
+    def _parse_bool(value_str: str | None, env_var_name: str) -> bool:
+        if value_str is None or not value_str.strip():
+            return False
+        value = value_str.strip().lower()
+        if value in ("true", "1", "yes"):
+            return True
+        if value in ("false", "0", "no"):
+            return False
+        raise ValueError(f"Invalid {env_var_name} value: {value_str!r}. It must be 'true', 'false' or unset.")
+
     def __init__(self) -> None:
         openai_chat_host = os.getenv("CHAT_MODEL_HOST", "azure")
         openai_embed_host = os.getenv("EMBED_MODEL_HOST", "azure")
@@ -83,7 +110,7 @@ class AppConfigBase(ABC):
             embed_api_key = SecretStr(os.getenv("AZURE_OPENAI_KEY", ""))
             embed_api_version = os.getenv("AZURE_OPENAI_VERSION", "2024-10-21")
             embed_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT", "")
-            embedding_dimensions = self._parse_embedding_dimensions(
+            embedding_dimensions = self._parse_optional_int(
                 os.getenv("AZURE_OPENAI_EMBED_DIMENSIONS"), "AZURE_OPENAI_EMBED_DIMENSIONS"
             )
         elif openai_embed_host == "openai":
@@ -92,7 +119,7 @@ class AppConfigBase(ABC):
             embed_api_key = SecretStr(os.getenv("OPENAICOM_KEY", ""))
             embed_api_version = ""
             embed_endpoint = ""
-            embedding_dimensions = self._parse_embedding_dimensions(
+            embedding_dimensions = self._parse_optional_int(
                 os.getenv("OPENAICOM_EMBED_DIMENSIONS"), "OPENAICOM_EMBED_DIMENSIONS"
             )
         elif openai_embed_host == "github":
@@ -101,7 +128,7 @@ class AppConfigBase(ABC):
             embed_api_key = SecretStr(os.getenv("GITHUB_TOKEN", ""))
             embed_api_version = ""
             embed_endpoint = os.getenv("GITHUB_ENDPOINT", "https://models.github.ai/inference")
-            embedding_dimensions = self._parse_embedding_dimensions(
+            embedding_dimensions = self._parse_optional_int(
                 os.getenv("GITHUB_EMBED_DIMENSIONS"), "GITHUB_EMBED_DIMENSIONS"
             )
         elif openai_embed_host == "ollama":
@@ -110,7 +137,7 @@ class AppConfigBase(ABC):
             embed_api_key = SecretStr(os.getenv("OLLAMA_API_KEY", "nokeyneeded"))
             embed_api_version = ""
             embed_endpoint = os.getenv("OLLAMA_ENDPOINT", "http://localhost:11434/v1")
-            embedding_dimensions = self._parse_embedding_dimensions(
+            embedding_dimensions = self._parse_optional_int(
                 os.getenv("OLLAMA_EMBED_DIMENSIONS"), "OLLAMA_EMBED_DIMENSIONS"
             )
         else:
@@ -124,7 +151,126 @@ class AppConfigBase(ABC):
         collection_name = os.getenv("AZURE_COSMOS_COLLECTION_NAME", "<COSMOS-DB-NEW-UNIQUE-DATABASE-NAME>")
         index_name = os.getenv("AZURE_COSMOS_INDEX_NAME", "<COSMOS-DB-NEW-UNIQUE-INDEX-NAME>")
 
+        # Connection pool shared by the vector store, data and users collections
+        mongo_max_pool_size = self._parse_optional_int(
+            os.getenv("AZURE_COSMOS_MAX_POOL_SIZE"), "AZURE_COSMOS_MAX_POOL_SIZE"
+        )
+        mongo_max_idle_time_ms = self._parse_optional_int(
+            os.getenv("AZURE_COSMOS_MAX_IDLE_TIME_MS"), "AZURE_COSMOS_MAX_IDLE_TIME_MS"
+        )
+        mongo_server_selection_timeout_ms = self._parse_optional_int(
+            os.getenv("AZURE_COSMOS_SERVER_SELECTION_TIMEOUT_MS"), "AZURE_COSMOS_SERVER_SELECTION_TIMEOUT_MS"
+        )
+
+        rephrase_policy_value = os.getenv("RAG_REPHRASE_POLICY", RephrasePolicy.HISTORY)
+        try:
+            rephrase_policy = RephrasePolicy(rephrase_policy_value)
+        except ValueError:
+            raise ValueError(
+                f"Unsupported RAG_REPHRASE_POLICY '{rephrase_policy_value}'. "
+                "Supported values are: 'always', 'history', 'heuristic'."
+            )
+
+        # Embed and search with the raw question while the rephrase completion runs
+        rag_speculative_retrieval = self._parse_bool(
+            os.getenv("RAG_SPECULATIVE_RETRIEVAL"), "RAG_SPECULATIVE_RETRIEVAL"
+        )
+        rag_speculative_similarity_threshold = self._parse_optional_float(
+            os.getenv("RAG_SPECULATIVE_SIMILARITY_THRESHOLD"), "RAG_SPECULATIVE_SIMILARITY_THRESHOLD"
+        )
+
+        # Query embedding cache in front of the embeddings API
+        embedding_cache_size = self._parse_optional_int(os.getenv("EMBEDDING_CACHE_SIZE"), "EMBEDDING_CACHE_SIZE")
+        embedding_cache_ttl_seconds = self._parse_optional_float(
+            os.getenv("EMBEDDING_CACHE_TTL_SECONDS"), "EMBEDDING_CACHE_TTL_SECONDS"
+        )
+        embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH") or None
+
+        # Micro-batching of concurrent query embeddings behind the cache
+        embedding_batch_window_ms = self._parse_optional_float(
+            os.getenv("EMBEDDING_BATCH_WINDOW_MS"), "EMBEDDING_BATCH_WINDOW_MS"
+        )
+        embedding_batch_size = self._parse_optional_int(os.getenv("EMBEDDING_BATCH_SIZE"), "EMBEDDING_BATCH_SIZE")
+
+        # Semantic cache of RAG answers, disabled unless a size is set
+        answer_cache_size = self._parse_optional_int(os.getenv("ANSWER_CACHE_SIZE"), "ANSWER_CACHE_SIZE")
+        answer_cache_ttl_seconds = self._parse_optional_float(
+            os.getenv("ANSWER_CACHE_TTL_SECONDS"), "ANSWER_CACHE_TTL_SECONDS"
+        )
+        answer_cache_max_distance = self._parse_optional_float(
+            os.getenv("ANSWER_CACHE_MAX_DISTANCE"), "ANSWER_CACHE_MAX_DISTANCE"
+        )
+        answer_cache_version_poll_seconds = self._parse_optional_float(
+            os.getenv("ANSWER_CACHE_VERSION_POLL_SECONDS"), "ANSWER_CACHE_VERSION_POLL_SECONDS"
+        )
+
+        # In-process vector index, off by default since every worker loads the whole collection into memory
+        local_index_mode_value = os.getenv("LOCAL_VECTOR_INDEX", LocalIndexMode.OFF)
+        try:
+            local_index_mode = LocalIndexMode(local_index_mode_value)
+        except ValueError:
+            raise ValueError(
+                f"Unsupported LOCAL_VECTOR_INDEX '{local_index_mode_value}'. "
+                "Supported values are: 'off', 'fallback', 'primary'."
+            )
+        local_index_refresh_seconds = self._parse_optional_float(
+            os.getenv("LOCAL_VECTOR_INDEX_REFRESH_SECONDS"), "LOCAL_VECTOR_INDEX_REFRESH_SECONDS"
+        )
+        local_index_max_documents = self._parse_optional_int(
+            os.getenv("LOCAL_VECTOR_INDEX_MAX_DOCUMENTS"), "LOCAL_VECTOR_INDEX_MAX_DOCUMENTS"
+        )
+
+        # Reciprocal rank fusion of keyword and vector search, also usable as the RAG context
+        hybrid_keyword_weight = self._parse_optional_float(os.getenv("HYBRID_KEYWORD_WEIGHT"), "HYBRID_KEYWORD_WEIGHT")
+        hybrid_vector_weight = self._parse_optional_float(os.getenv("HYBRID_VECTOR_WEIGHT"), "HYBRID_VECTOR_WEIGHT")
+        hybrid_rrf_k = self._parse_optional_int(os.getenv("HYBRID_RRF_K"), "HYBRID_RRF_K")
+        rag_hybrid_context = self._parse_bool(os.getenv("RAG_HYBRID_CONTEXT"), "RAG_HYBRID_CONTEXT")
+
+        # Chat history is queued and flushed in batches by a background worker unless this is turned off
+        history_write_behind = self._parse_bool(os.getenv("HISTORY_WRITE_BEHIND", "true"), "HISTORY_WRITE_BEHIND")
+        history_queue_size = self._parse_optional_int(os.getenv("HISTORY_QUEUE_SIZE"), "HISTORY_QUEUE_SIZE")
+        history_batch_size = self._parse_optional_int(os.getenv("HISTORY_BATCH_SIZE"), "HISTORY_BATCH_SIZE")
+        history_flush_seconds = self._parse_optional_float(os.getenv("HISTORY_FLUSH_SECONDS"), "HISTORY_FLUSH_SECONDS")
+
+        # Recent conversations kept in memory for clients that only send their newest message
+        session_cache_size = self._parse_optional_int(os.getenv("SESSION_CACHE_SIZE"), "SESSION_CACHE_SIZE")
+        session_history_max_messages = self._parse_optional_int(
+            os.getenv("SESSION_HISTORY_MAX_MESSAGES"), "SESSION_HISTORY_MAX_MESSAGES"
+        )
+
+        # Token budget of the history in the RAG rephrase prompt, and whether older turns are summarized
+        rag_history_max_tokens = self._parse_optional_int(os.getenv("RAG_HISTORY_MAX_TOKENS"), "RAG_HISTORY_MAX_TOKENS")
+        rag_history_summary = self._parse_bool(os.getenv("RAG_HISTORY_SUMMARY"), "RAG_HISTORY_SUMMARY")
+
+        # Save the part of a streamed answer that was sent before the client disconnected
+        stream_persist_partial_answers = self._parse_bool(
+            os.getenv("STREAM_PERSIST_PARTIAL_ANSWERS", "true"), "STREAM_PERSIST_PARTIAL_ANSWERS"
+        )
+        # Merge streamed tokens into fewer NDJSON lines
+        stream_coalesce_ms = self._parse_optional_float(os.getenv("STREAM_COALESCE_MS"), "STREAM_COALESCE_MS")
+        stream_coalesce_chars = self._parse_optional_int(os.getenv("STREAM_COALESCE_CHARS"), "STREAM_COALESCE_CHARS")
+
+        # Share one run between identical requests that are in flight at the same time
+        single_flight = self._parse_bool(os.getenv("SINGLE_FLIGHT", "true"), "SINGLE_FLIGHT")
+
+        # Replay buffers of the answers streamed over SSE
+        sse_replay_max_streams = self._parse_optional_int(os.getenv("SSE_REPLAY_MAX_STREAMS"), "SSE_REPLAY_MAX_STREAMS")
+        sse_replay_max_events = self._parse_optional_int(os.getenv("SSE_REPLAY_MAX_EVENTS"), "SSE_REPLAY_MAX_EVENTS")
+        sse_replay_ttl_seconds = self._parse_optional_float(
+            os.getenv("SSE_REPLAY_TTL_SECONDS"), "SSE_REPLAY_TTL_SECONDS"
+        )
+
+        # Candidate list size of the queries to an HNSW vector index
+        vector_ef_search = self._parse_optional_int(os.getenv("VECTOR_EF_SEARCH"), "VECTOR_EF_SEARCH")
+
+        self.embedding_model = embed_model
         self.embedding_dimensions = embedding_dimensions
+        # Internal counters served on GET /stats, off by default since the route is not authenticated
+        self.stats_endpoint = self._parse_bool(os.getenv("STATS_ENDPOINT"), "STATS_ENDPOINT")
+        # Identical requests in flight at the same time share one retrieval and completion
+        self.single_flight = SingleFlight() if single_flight else None
+        # History writes scheduled by the streams, referenced until done since the event loop only holds weak ones
+        self._history_writes: set[asyncio.Task[bool]] = set()
         self.setup = Setup(
             openai_embeddings_model=embed_model,
             openai_embeddings_deployment=embed_deployment,
@@ -143,43 +289,112 @@ class AppConfigBase(ABC):
             openai_chat_host=openai_chat_host,
             openai_embed_host=openai_embed_host,
             embedding_dimensions=embedding_dimensions,
+            mongo_max_pool_size=mongo_max_pool_size if mongo_max_pool_size is not None else 100,
+            mongo_max_idle_time_ms=mongo_max_idle_time_ms,
+            mongo_server_selection_timeout_ms=(
+                mongo_server_selection_timeout_ms if mongo_server_selection_timeout_ms is not None else 1000
+            ),
+            rephrase_policy=rephrase_policy,
+            rag_speculative_retrieval=rag_speculative_retrieval,
+            rag_speculative_similarity_threshold=(
+                rag_speculative_similarity_threshold
+                if rag_speculative_similarity_threshold is not None
+                else SPECULATIVE_SIMILARITY_THRESHOLD
+            ),
+            embedding_cache_size=embedding_cache_size if embedding_cache_size is not None else 1024,
+            embedding_cache_ttl_seconds=embedding_cache_ttl_seconds,
+            embedding_cache_path=embedding_cache_path,
+            embedding_batch_window_ms=embedding_batch_window_ms if embedding_batch_window_ms is not None else 5,
+            embedding_batch_size=embedding_batch_size if embedding_batch_size is not None else 16,
+            answer_cache_size=answer_cache_size if answer_cache_size is not None else 0,
+            answer_cache_ttl_seconds=answer_cache_ttl_seconds if answer_cache_ttl_seconds is not None else 3600,
+            answer_cache_max_distance=answer_cache_max_distance if answer_cache_max_distance is not None else 0.05,
+            answer_cache_version_poll_seconds=(
+                answer_cache_version_poll_seconds if answer_cache_version_poll_seconds is not None else 30
+            ),
+            local_index_mode=local_index_mode,
+            local_index_refresh_seconds=local_index_refresh_seconds if local_index_refresh_seconds is not None else 300,
+            local_index_max_documents=(
+                local_index_max_documents if local_index_max_documents is not None else LOCAL_INDEX_MAX_DOCUMENTS
+            ),
+            hybrid_keyword_weight=hybrid_keyword_weight if hybrid_keyword_weight is not None else 1.0,
+            hybrid_vector_weight=hybrid_vector_weight if hybrid_vector_weight is not None else 1.0,
+            hybrid_rrf_k=hybrid_rrf_k if hybrid_rrf_k is not None else RRF_K,
+            rag_hybrid_context=rag_hybrid_context,
+            history_write_behind=history_write_behind,
+            history_queue_size=history_queue_size if history_queue_size is not None else 1000,
+            history_batch_size=history_batch_size if history_batch_size is not None else 100,
+            history_flush_seconds=history_flush_seconds if history_flush_seconds is not None else 0.05,
+            session_cache_size=session_cache_size if session_cache_size is not None else 1024,
+            session_history_max_messages=(
+                session_history_max_messages if session_history_max_messages is not None else 50
+            ),
+            rag_history_max_tokens=rag_history_max_tokens if rag_history_max_tokens is not None else 1000,
+            rag_history_summary=rag_history_summary,
+            stream_persist_partial_answers=stream_persist_partial_answers,
+            stream_coalesce_ms=stream_coalesce_ms if stream_coalesce_ms is not None else 30,
+            stream_coalesce_chars=stream_coalesce_chars if stream_coalesce_chars is not None else 64,
+            sse_replay_max_streams=sse_replay_max_streams if sse_replay_max_streams is not None else 256,
+            sse_replay_max_events=sse_replay_max_events if sse_replay_max_events is not None else 512,
+            sse_replay_ttl_seconds=sse_replay_ttl_seconds if sse_replay_ttl_seconds is not None else 300,
+            vector_ef_search=vector_ef_search if vector_ef_search is not None else DEFAULT_EF_SEARCH,
         )
 
     async def add_to_cosmos(
         self, old_messages: list, new_message: dict, session_state: str | None, new_session_state: str
     ) -> bool:
         is_first_message: bool = True if not session_state else False
-        if is_first_message:
-            try:
-                if len(old_messages) == 0 or len(new_message) == 0 or len(new_session_state) == 0:
-                    raise IndexError
-                old_messages.append(new_message)
-                self.setup._database_setup._users_collection.insert_one(
-                    {
-                        "_id": new_session_state,
-                        "messages": old_messages,
-                        "created_at": datetime.now(timezone.utc),  # noqa: UP017
-                        "updated_at": datetime.now(timezone.utc),  # noqa: UP017
-                    }
-                )
-                return True
-            except (AttributeError, ConfigurationError, InvalidName, InvalidOperation, OperationFailure, IndexError):
-                return False
-        else:
-            try:
-                if len(old_messages) == 0 or len(new_message) == 0 or len(new_session_state) == 0:
-                    raise IndexError
-                self.setup._database_setup._users_collection.update_one(
-                    {"_id": new_session_state},
-                    {"$push": {"messages": {"$each": [old_messages[-1], new_message]}}},  # noqa: UP017
-                )
-                self.setup._database_setup._users_collection.update_one(
-                    {"_id": new_session_state},
-                    {"$set": {"updated_at": datetime.now(timezone.utc)}},  # noqa: UP017
-                )
-                return True
-            except (AttributeError, ConfigurationError, InvalidName, InvalidOperation, OperationFailure, IndexError):
-                return False
+        try:
+            if len(old_messages) == 0 or len(new_message) == 0 or len(new_session_state) == 0:
+                raise IndexError
+            # A new session stores the whole conversation so far, a follow-up only the last question and answer.
+            messages = [*old_messages, new_message] if is_first_message else [old_messages[-1], new_message]
+            await self.setup.history_writer.enqueue(HistoryMutation(session_id=new_session_state, messages=messages))
+            self.setup.session_history.append(new_session_state, messages, new_session=is_first_message)
+            return True
+        except (AttributeError, ConfigurationError, InvalidName, InvalidOperation, OperationFailure, IndexError):
+            return False
+
+    def add_to_cosmos_later(
+        self, old_messages: list, new_message: dict, session_state: str | None, new_session_state: str
+    ) -> None:
+        """Record the exchange in a task, so a finished stream is not held open by a full or inline history writer."""
+        write = asyncio.create_task(
+            self.add_to_cosmos(
+                old_messages=old_messages,
+                new_message=new_message,
+                session_state=session_state,
+                new_session_state=new_session_state,
+            )
+        )
+        self._history_writes.add(write)
+        write.add_done_callback(self._history_writes.discard)
+
+    async def wait_for_history_writes(self) -> None:
+        """Wait for the writes scheduled by `add_to_cosmos_later`, so they reach the history writer before it stops."""
+        await asyncio.gather(*self._history_writes, return_exceptions=True)
+
+    async def with_server_history(self, session_state: str | None, messages: list) -> list:
+        """Prepend the stored conversation to the newest message(s) sent by the client."""
+        if not session_state:
+            return messages
+        return [*await self.setup.session_history.get(session_state), *messages]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "mongo_pool": self.setup._database_setup.pool_stats(),
+            "rag_speculation": self.setup.rag.speculation_stats(),
+            "embedding_cache": self.setup.embedding_cache_stats(),
+            "embedding_batcher": self.setup.embedding_batcher_stats(),
+            "answer_cache": self.setup.rag.answer_cache_stats(),
+            "local_index": self.setup.local_index_stats(),
+            "history_writer": self.setup.history_writer.stats(),
+            "session_history": self.setup.session_history.stats(),
+            "rag_history": self.setup.rag.history_stats(),
+            "rag_generation": self.setup.rag.generation_stats(),
+            "stream_replay": self.setup.stream_replay.stats(),
+            "single_flight": self.single_flight.stats() if self.single_flight else {},
+        }
 
     def _get_thoughts(self, documents: list[Document]) -> list[Thought]:
         thoughts: list[Thought] = []
@@ -219,3 +434,8 @@ class AppConfigBase(ABC):
     async def run_keyword(
         self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
     ) -> RetrievalResponse: ...
+
+    @abstractmethod
+    async def run_hybrid(
+        self, session_state: str | None, messages: list, temperature: float, limit: int, score_threshold: float
+    ) -> RetrievalResponse: ...
@@ -1,21 +1,23 @@
 #!/usr/bin/env python3
 
-import json
 import logging
 import os
 from argparse import ArgumentParser, Namespace
 
-from langchain_community.vectorstores.azure_cosmos_db import (
-    AzureCosmosDBVectorSearch,
-    CosmosDBSimilarityType,
-    CosmosDBVectorSearchType,
-)
-from langchain_core.documents import Document
-from langchain_core.embeddings import Embeddings
-from pymongo import MongoClient
+from langchain_community.vectorstores.azure_cosmos_db import AzureCosmosDBVectorSearch
 from pymongo.collection import Collection
 
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.history_packer import token_counter
+from quartapp.approaches.ingestion import Checkpoint, CheckpointMismatchError, IngestionPipeline, read_documents
 from quartapp.approaches.setup import Setup
+from quartapp.approaches.utils import METADATA_COLLECTION_NAME, bump_data_version
+from quartapp.approaches.vector_index import (
+    add_index_arguments,
+    ensure_vector_index,
+    index_params_from_args,
+    stored_dimensions,
+)
 from quartapp.config import AppConfig
 
 _app_config = AppConfig()
@@ -29,42 +31,12 @@ logging.basicConfig(
 )
 
 
-def read_data(file_path: str) -> list[Document]:
-    # Load JSON file
-    with open(file_path) as file:
-        json_data = json.load(file)
-
-    documents = []
-    absolute_path = os.path.abspath(file_path)
-    # Process each item in the JSON data
-    for idx, item in enumerate(json_data):
-        documents.append(
-            Document(page_content=json.dumps(item), metadata={"source": absolute_path, "seq_num": idx + 1})
-        )
-    return documents
-
-
-async def generate_embeddings_and_add_data(
-    documents: list[Document],
-    collection: Collection,
-    index_name: str,
-    embeddings: Embeddings,
-) -> AzureCosmosDBVectorSearch:
-    # Create embeddings from the data, save to the database and return a connection to Azure DocumentDB
-    return await AzureCosmosDBVectorSearch.afrom_documents(
-        documents=documents,
-        embedding=embeddings,
-        collection=collection,
-        index_name=index_name,
-    )
-
-
 async def add_data(input_args: Namespace) -> None:
-    documents = read_data(input_args.file)
-
-    logging.info("✨ Successfully Read the data...")
+    # Items are streamed from the file into the pipeline, so the whole file is never loaded at once
+    documents = read_documents(input_args.file)
 
-    mongo_client: MongoClient = MongoClient(setup._database_setup._connection_string)
+    # Reuse the client (and connection pool) owned by the database setup
+    mongo_client = setup._database_setup._mongo_client
 
     # Create the database
     db = mongo_client[setup._database_setup._database_name]
@@ -72,27 +44,60 @@ async def add_data(input_args: Namespace) -> None:
     # Create the collection
     collection: Collection = db[setup._database_setup._collection_name]
 
-    vector_store = await generate_embeddings_and_add_data(
-        documents=documents,
+    # Progress is saved after each written batch, so a failed run can be resumed with --resume
+    checkpoint_path = input_args.checkpoint or f"{input_args.file}.checkpoint.json"
+    fingerprint = {
+        "model": _app_config.embedding_model,
+        "dimensions": _app_config.embedding_dimensions,
+        "source": os.path.abspath(input_args.file),
+        "collection": f"{setup._database_setup._database_name}.{setup._database_setup._collection_name}",
+    }
+    if input_args.resume:
+        try:
+            checkpoint = Checkpoint.resume(checkpoint_path, fingerprint)
+        except CheckpointMismatchError as error:
+            logging.error(f"❌ {error}. Run again without --resume to start over.")
+            raise SystemExit(1) from error
+    else:
+        if os.path.exists(checkpoint_path):
+            logging.info(f"Starting over, ignoring the checkpoint at {checkpoint_path} (use --resume to continue it)")
+        checkpoint = Checkpoint(checkpoint_path, fingerprint)
+
+    # Create embeddings for the new and changed items in batches and save them to the database
+    pipeline = IngestionPipeline(
+        AsyncCollection(collection),
+        setup._openai_setup._embeddings_api,
+        batch_size=input_args.batch_size,
+        concurrency=input_args.concurrency,
+        max_retries=input_args.max_retries,
+        count_tokens=token_counter(_app_config.embedding_model),
+    )
+    stats = await pipeline.run(documents, prune=input_args.prune, checkpoint=checkpoint)
+
+    logging.info("✨ Successfully Read the data, Created the Embeddings and Added the Data the Collection...")
+
+    # A connection to Azure DocumentDB over the collection, used to create the vector index
+    vector_store = AzureCosmosDBVectorSearch(
         collection=collection,
+        embedding=setup._openai_setup._embeddings_api,
         index_name=setup._database_setup._index_name,
-        embeddings=setup._openai_setup._embeddings_api,
     )
 
-    logging.info("✨ Successfully Created the Collection, Embeddings and Added the Data the Collection...")
+    # Let running apps know the data changed, so cached answers are dropped
+    if stats.changed:
+        bump_data_version(db[METADATA_COLLECTION_NAME], setup._database_setup._collection_name)
 
+    # The index options are chosen from the number of documents unless set on the command line.
     # Read more about these variables in detail here. https://learn.microsoft.com/azure/documentdb/vector-search
-    num_lists = 100
-    dimensions = _app_config.embedding_dimensions if _app_config.embedding_dimensions is not None else 1536
-    similarity_algorithm = CosmosDBSimilarityType.COS
-    kind = CosmosDBVectorSearchType.VECTOR_IVF
-    m = 16
-    ef_construction = 64
-
-    # Create the index overt the collection
-    index_creation = vector_store.create_index(num_lists, dimensions, similarity_algorithm, kind, m, ef_construction)
-
-    logging.info(f"✨ Successfully Created the IVF Index Over the data...{index_creation}")
+    document_count = collection.count_documents({})
+    dimensions = stored_dimensions(collection) or _app_config.embedding_dimensions or 1536
+    params = index_params_from_args(input_args, document_count, dimensions)
+
+    # Create the index over the collection, unless it was already built with the same options
+    if ensure_vector_index(
+        vector_store, db[METADATA_COLLECTION_NAME], setup._database_setup._collection_name, params, document_count
+    ):
+        logging.info(f"✨ Successfully Created the Vector Index Over the data...{params.to_dict()}")
     logging.info("✅✅ Done! ✅✅")
 
 
@@ -105,8 +110,44 @@ def get_input_args() -> Namespace:
         "--file",
         type=str,
         default="./data/food_items.json",
-        help="path to the JSON file containing the data",
+        help="path to the file containing the data, a JSON array or JSON Lines (.jsonl, .ndjson)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=128,
+        help="number of documents embedded with one embeddings API call and written with one insert",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="number of batches being embedded or written at the same time",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=6,
+        help="number of times a throttled embeddings call or write is retried before giving up",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="delete the items of the collection that are no longer in the file",
     )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="path of the file the progress is saved to (defaults to the data file path with .checkpoint.json)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue from the checkpoint of a failed run, if it used the same file, collection and embedding model",
+    )
+
+    add_index_arguments(parser)
 
     return parser.parse_args()
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Measure how much MongoDB round-trips stall the event loop.
+
+Runs a burst of concurrent keyword searches and chat-history writes against a collection that sleeps for a
+fixed simulated network latency, once calling the synchronous pymongo API directly from the coroutine (the old
+behaviour) and once through AsyncCollection. A heartbeat task records how late the event loop wakes it up.
+
+    uv run --active ./scripts/benchmarks/event_loop_lag.py --requests 50 --latency-ms 20
+"""
+
+import asyncio
+import statistics
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Any
+
+from quartapp.approaches.async_collection import AsyncCollection
+
+
+class SlowCollection:
+    """Stand-in for a pymongo Collection whose every call costs one network round-trip."""
+
+    def __init__(self, latency: float):
+        self._latency = latency
+
+    def find(self, filter: Any, projection: Any = None, sort: Any = None) -> "SlowCollection":
+        return self
+
+    def limit(self, limit: int) -> list[dict[str, Any]]:
+        time.sleep(self._latency)
+        return [{"textContent": "{}", "metadata": {"source": "bench"}}]
+
+    def find_one(self, filter: Any, projection: Any = None) -> None:
+        time.sleep(self._latency)
+
+    def insert_one(self, document: Any) -> None:
+        time.sleep(self._latency)
+
+    def update_one(self, filter: Any, update: Any, upsert: bool = False) -> None:
+        time.sleep(self._latency)
+
+
+class BlockingCollection(AsyncCollection):
+    """Reproduces the previous behaviour: the driver call runs on the event loop thread."""
+
+    async def find(self, filter: Any, projection: Any = None, limit: int = 0, sort: Any = None) -> list[dict[str, Any]]:
+        return self._find(filter, projection, limit, sort)
+
+    async def insert_one(self, document: Any) -> Any:
+        return self._collection.insert_one(document)
+
+    async def update_one(self, filter: Any, update: Any, upsert: bool = False) -> Any:
+        return self._collection.update_one(filter, update, upsert)
+
+
+async def heartbeat(interval: float, lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(time.perf_counter() - expected, 0.0))
+
+
+async def simulated_request(collection: AsyncCollection) -> None:
+    await collection.find({"$text": {"$search": "vegan"}}, limit=3)
+    await collection.update_one({"_id": "session"}, {"$push": {"messages": {"$each": []}}})
+
+
+async def measure(collection: AsyncCollection, requests: int, interval: float) -> dict[str, float]:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(heartbeat(interval, lags, stop))
+    await asyncio.sleep(interval)
+    started = time.perf_counter()
+    await asyncio.gather(*(simulated_request(collection) for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    return {
+        "wall_s": elapsed,
+        "max_lag_ms": max(lags) * 1000,
+        "p50_lag_ms": statistics.median(lags) * 1000,
+    }
+
+
+async def main(input_args: Namespace) -> None:
+    slow = SlowCollection(input_args.latency_ms / 1000)
+    interval = 0.005
+    for label, collection in (
+        ("blocking pymongo (before)", BlockingCollection(slow)),  # type: ignore[arg-type]
+        ("AsyncCollection (after)", AsyncCollection(slow)),  # type: ignore[arg-type]
+    ):
+        result = await measure(collection, input_args.requests, interval)
+        print(
+            f"{label:<28} wall={result['wall_s']:.3f}s "
+            f"max_lag={result['max_lag_ms']:.1f}ms p50_lag={result['p50_lag_ms']:.1f}ms"
+        )
+
+
+def get_input_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50, help="number of concurrent simulated requests")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated round-trip latency")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(get_input_args()))
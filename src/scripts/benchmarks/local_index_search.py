@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Measure top-k query latency of the in-process LocalVectorIndex.
+
+Loads a catalog of random embeddings into the index and times exact cosine top-k searches. Compare against the
+p50 of a Cosmos vector search (one network round-trip plus the IVF probe) to pick LOCAL_VECTOR_INDEX.
+
+    uv run --active ./scripts/benchmarks/local_index_search.py --documents 5000 --dimensions 1536
+"""
+
+import asyncio
+import statistics
+import time
+from argparse import ArgumentParser, Namespace
+
+import mongomock
+import numpy as np
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.local_index import LocalVectorIndex
+
+
+async def main(input_args: Namespace) -> None:
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((input_args.documents, input_args.dimensions), dtype=np.float32)
+    collection: mongomock.Collection = mongomock.MongoClient().db.collection
+    collection.insert_many(
+        [
+            {"_id": i, "textContent": f"item {i}", "vectorContent": vector.tolist(), "metadata": {"source": "bench"}}
+            for i, vector in enumerate(vectors)
+        ]
+    )
+
+    local_index = LocalVectorIndex(AsyncCollection(collection))
+    started = time.perf_counter()
+    await local_index.load()
+    load_ms = (time.perf_counter() - started) * 1000
+
+    queries = rng.standard_normal((input_args.queries, input_args.dimensions), dtype=np.float32).tolist()
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        local_index.search(query, input_args.top)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    timings.sort()
+    matrix_mb = local_index._snapshot.matrix.nbytes / 1024 / 1024
+    print(f"{input_args.documents} documents x {input_args.dimensions} dimensions ({matrix_mb:.1f} MiB)")
+    print(f"load            : {load_ms:8.1f} ms")
+    print(f"search p50      : {statistics.median(timings):8.3f} ms")
+    print(f"search p99      : {timings[int(len(timings) * 0.99) - 1]:8.3f} ms")
+
+
+def get_input_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument("--documents", type=int, default=5000, help="number of indexed documents")
+    parser.add_argument("--dimensions", type=int, default=1536, help="embedding dimensions")
+    parser.add_argument("--queries", type=int, default=200, help="number of timed searches")
+    parser.add_argument("--top", type=int, default=3, help="k for each search")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(get_input_args()))
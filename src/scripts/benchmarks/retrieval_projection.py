@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Measure the reply size and BSON decode time of retrieval queries with and without field projections.
+
+Builds the result batches the $text keyword search and the vector search pipeline return for one query, once
+with whole documents (the old behaviour, embedding included) and once with the projections the approaches use
+now, then times how long pymongo's BSON decoder takes per reply. Wire bytes are the encoded BSON sizes.
+
+    uv run --active ./scripts/benchmarks/retrieval_projection.py --top 3 --dimensions 1536
+"""
+
+import random
+import statistics
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Any
+
+import bson
+
+
+def stored_document(i: int, dimensions: int) -> dict[str, Any]:
+    """A menu item as written by AzureCosmosDBVectorSearch."""
+    return {
+        "_id": bson.ObjectId(),
+        "textContent": (
+            f'{{"name": "Dish {i}", "description": "Seasonal vegetables with a house dressing and toasted seeds", '
+            f'"price": "{i % 20 + 5}.0USD", "category": "Main"}}'
+        ),
+        "vectorContent": [random.uniform(-1, 1) for _ in range(dimensions)],
+        "metadata": {"source": "menu_items.json", "seq_num": i},
+    }
+
+
+def keyword_reply(documents: list[dict[str, Any]], projected: bool) -> list[dict[str, Any]]:
+    if not projected:
+        return documents
+    return [{key: document[key] for key in ("_id", "textContent", "metadata")} for document in documents]
+
+
+def vector_reply(documents: list[dict[str, Any]], projected: bool) -> list[dict[str, Any]]:
+    return [{"similarityScore": 0.9, "document": keyword_reply([document], projected)[0]} for document in documents]
+
+
+def measure(reply: list[dict[str, Any]], iterations: int) -> tuple[int, float]:
+    encoded = b"".join(bson.encode(document) for document in reply)
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        bson.decode_all(encoded)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    return len(encoded), statistics.median(timings)
+
+
+def main(input_args: Namespace) -> None:
+    random.seed(0)
+    documents = [stored_document(i, input_args.dimensions) for i in range(input_args.top)]
+    print(f"top {input_args.top} results, {input_args.dimensions}-dimension embeddings")
+    print(f"{'query':<10}{'projection':<12}{'bytes':>10}{'decode p50 (us)':>18}")
+    for name, build_reply in (("keyword", keyword_reply), ("vector", vector_reply)):
+        for projected in (False, True):
+            size, decode_us = measure(build_reply(documents, projected), input_args.iterations)
+            print(f"{name:<10}{'yes' if projected else 'no':<12}{size:>10}{decode_us:>18.1f}")
+
+
+def get_input_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument("--top", type=int, default=3, help="number of documents returned per query")
+    parser.add_argument("--dimensions", type=int, default=1536, help="embedding dimensions")
+    parser.add_argument("--iterations", type=int, default=1000, help="number of timed decodes per reply")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(get_input_args())
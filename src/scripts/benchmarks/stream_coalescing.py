@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Measure the CPU cost of writing streamed RAG answers as NDJSON.
+
+Streams simulated answers of one delta per model token through format_as_ndjson, once as before (every delta
+serialized through `to_dict` and written on its own line), once with the pre-built serialization of message
+deltas only, and once with coalescing. Reports deltas per CPU second, the lines (HTTP chunks) written per answer
+and the CPU time per answer. A token interval simulates the model's pace, so time-based flushes can happen.
+
+    uv run --active ./scripts/benchmarks/stream_coalescing.py --answers 200 --tokens 120 --token-interval-ms 0
+"""
+
+import asyncio
+import time
+from argparse import ArgumentParser, Namespace
+from collections.abc import AsyncGenerator
+from json import dumps
+
+from quartapp.app import format_as_ndjson
+from quartapp.approaches.schemas import AIChatRoles, Context, DataPoint, Message, RetrievalResponseDelta, Thought
+
+WORDS = "Our crispy tofu bowl comes with brown rice, pickled vegetables and a sesame ginger dressing".split()
+
+
+async def simulated_answer(tokens: int, token_interval: float) -> AsyncGenerator[RetrievalResponseDelta, None]:
+    yield RetrievalResponseDelta(
+        context=Context([DataPoint(name="Tofu bowl", price="12.0USD")], [Thought(title="Source")]), sessionState="s"
+    )
+    for i in range(tokens):
+        if token_interval:
+            await asyncio.sleep(token_interval)
+        yield RetrievalResponseDelta(delta=Message(content=f" {WORDS[i % len(WORDS)]}", role=AIChatRoles.ASSISTANT))
+
+
+async def legacy_format_as_ndjson(r: AsyncGenerator[RetrievalResponseDelta, None]) -> AsyncGenerator[str, None]:
+    """format_as_ndjson before message deltas had their own serialization and could be merged."""
+    async for event in r:
+        yield dumps(event.to_dict(), ensure_ascii=False) + "\n"
+
+
+async def measure(mode: str, input_args: Namespace) -> dict[str, float]:
+    lines = 0
+    cpu_started = time.process_time()
+    for _ in range(input_args.answers):
+        answer = simulated_answer(input_args.tokens, input_args.token_interval_ms / 1000)
+        if mode == "legacy":
+            formatted = legacy_format_as_ndjson(answer)
+        elif mode == "fast path":
+            formatted = format_as_ndjson(answer)
+        else:
+            formatted = format_as_ndjson(answer, input_args.coalesce_ms, input_args.coalesce_chars)
+        async for _line in formatted:
+            lines += 1
+    cpu = time.process_time() - cpu_started
+    deltas = input_args.answers * (input_args.tokens + 1)
+    return {
+        "deltas_per_cpu_s": deltas / cpu,
+        "lines_per_answer": lines / input_args.answers,
+        "cpu_ms_per_answer": cpu * 1000 / input_args.answers,
+    }
+
+
+async def main(input_args: Namespace) -> None:
+    print(
+        f"{input_args.answers} answers of {input_args.tokens} tokens, {input_args.token_interval_ms} ms between "
+        f"tokens, coalescing {input_args.coalesce_ms} ms / {input_args.coalesce_chars} chars"
+    )
+    print(f"{'mode':<12}{'deltas/cpu s':>14}{'lines/answer':>14}{'cpu ms/answer':>15}")
+    for mode in ("legacy", "fast path", "coalesced"):
+        result = await measure(mode, input_args)
+        print(
+            f"{mode:<12}{result['deltas_per_cpu_s']:>14.0f}{result['lines_per_answer']:>14.1f}"
+            f"{result['cpu_ms_per_answer']:>15.3f}"
+        )
+
+
+def get_input_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument("--answers", type=int, default=200, help="number of streamed answers per mode")
+    parser.add_argument("--tokens", type=int, default=120, help="tokens (message deltas) per answer")
+    parser.add_argument("--token-interval-ms", type=float, default=0, help="simulated time between tokens")
+    parser.add_argument("--coalesce-ms", type=float, default=30, help="STREAM_COALESCE_MS")
+    parser.add_argument("--coalesce-chars", type=int, default=64, help="STREAM_COALESCE_CHARS")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(get_input_args()))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import logging
+from argparse import ArgumentParser, Namespace
+
+from langchain_community.vectorstores.azure_cosmos_db import AzureCosmosDBVectorSearch
+from pymongo.collection import Collection
+
+from quartapp.approaches.setup import Setup
+from quartapp.approaches.utils import METADATA_COLLECTION_NAME
+from quartapp.approaches.vector_index import (
+    add_index_arguments,
+    ensure_vector_index,
+    index_params_from_args,
+    recorded_index,
+    stored_dimensions,
+)
+from quartapp.config import AppConfig
+
+_app_config = AppConfig()
+setup: Setup = _app_config.setup
+
+
+logging.basicConfig(
+    handlers=[logging.StreamHandler()],
+    format="[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+
+def reindex(input_args: Namespace) -> None:
+    # Reuse the client (and connection pool) owned by the database setup
+    mongo_client = setup._database_setup._mongo_client
+    db = mongo_client[setup._database_setup._database_name]
+    collection_name = setup._database_setup._collection_name
+    collection: Collection = db[collection_name]
+
+    # The index is rebuilt over the embeddings already stored, so it has to match their dimensions
+    dimensions = stored_dimensions(collection)
+    if dimensions is None:
+        logging.error(f"❌ The collection {collection_name} has no embeddings, run add_data.py first.")
+        raise SystemExit(1)
+    document_count = collection.count_documents({})
+    params = index_params_from_args(input_args, document_count, dimensions)
+    previous = recorded_index(db[METADATA_COLLECTION_NAME], collection_name)
+    logging.info(f"Previous vector index: {previous['params'] if previous else 'not recorded'}")
+
+    vector_store = AzureCosmosDBVectorSearch(
+        collection=collection,
+        embedding=setup._openai_setup._embeddings_api,
+        index_name=setup._database_setup._index_name,
+    )
+    ensure_vector_index(
+        vector_store, db[METADATA_COLLECTION_NAME], collection_name, params, document_count, rebuild=True
+    )
+
+    logging.info(f"✨ Successfully Rebuilt the Vector Index Over {document_count} documents...{params.to_dict()}")
+    logging.info("✅✅ Done! ✅✅")
+
+
+def get_input_args() -> Namespace:
+    # Parse using ArgumentParser
+    parser = ArgumentParser(description="Rebuild the vector index over the stored embeddings, without re-embedding.")
+
+    add_index_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    input_args = get_input_args()
+    reindex(input_args)
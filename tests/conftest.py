@@ -21,9 +21,13 @@ from pydantic import SecretStr
 
 import quartapp
 from quartapp.app import create_app
+from quartapp.approaches.async_collection import AsyncCollection
 from quartapp.approaches.base import ApproachesBase
+from quartapp.approaches.history_writer import HistoryWriter
+from quartapp.approaches.hybrid import Hybrid
 from quartapp.approaches.keyword import KeyWord
 from quartapp.approaches.rag import RAG
+from quartapp.approaches.session_history import SessionHistory
 from quartapp.approaches.setup import DatabaseSetup, Setup
 from quartapp.approaches.vector import Vector
 from quartapp.config import AppConfig
@@ -62,6 +66,8 @@ def mock_session_env(monkeypatch_session):
         monkeypatch_session.setenv("AZURE_OPENAI_EMBED_DEPLOYMENT", "text-embedding-3-small")
         monkeypatch_session.setenv("AZURE_OPENAI_EMBED_DIMENSIONS", "1536")
         monkeypatch_session.setenv("AZURE_OPENAI_KEY", "fakekey")
+        # Local vector index (would otherwise load from the database in the background)
+        monkeypatch_session.setenv("LOCAL_VECTOR_INDEX", "off")
         # Allowed Origin
         monkeypatch_session.setenv("ALLOWED_ORIGIN", "https://frontend.com")
 
@@ -77,6 +83,7 @@ def approaches_base_mock():
 
     # Mock Embedding
     mock_embedding = MagicMock()
+    mock_embedding.aembed_query = AsyncMock(return_value=[1.0, 0.0])
 
     # Mock Vector Store
     mock_vector_store = MagicMock()
@@ -84,7 +91,7 @@ def approaches_base_mock():
         page_content='{"name": "test", "description": "test", "price": "5.0USD", "category": "test"}',
         metadata={"source": "test"},
     )
-    mock_vector_store.as_retriever.return_value.ainvoke = AsyncMock(return_value=[mock_document])
+    mock_vector_store._similarity_search_with_score = MagicMock(return_value=[(mock_document, 1.0)])
 
     # Mock Chat
     mock_chat = MagicMock()
@@ -95,7 +102,9 @@ def approaches_base_mock():
     mock_data_collection.find = MagicMock()
     mock_data_collection.find.return_value.limit = MagicMock(return_value=[mock_mongo_document])
 
-    return ApproachesBase(mock_vector_store, mock_embedding, mock_chat, mock_data_collection)  # type: ignore [abstract]
+    return ApproachesBase(  # type: ignore [abstract]
+        mock_vector_store, mock_embedding, mock_chat, AsyncCollection(mock_data_collection)
+    )
 
 
 @pytest.fixture
@@ -120,6 +129,17 @@ def vector_mock(approaches_base_mock):
     )
 
 
+@pytest.fixture
+def hybrid_mock(approaches_base_mock):
+    """Mock quartapp.approaches.hybrid.Hybrid."""
+    return Hybrid(
+        approaches_base_mock._vector_store,
+        approaches_base_mock._embedding,
+        approaches_base_mock._chat,
+        approaches_base_mock._data_collection,
+    )
+
+
 @pytest.fixture
 def rag_mock(approaches_base_mock):
     """Mock quartapp.approaches.rag.RAG."""
@@ -135,7 +155,8 @@ def rag_mock(approaches_base_mock):
 def database_mock(approaches_base_mock):
     """Mock quartapp.approaches.setup.DatabaseSetup."""
 
-    mock_collection: mongomock.Collection = mongomock.MongoClient().db.collection
+    mock_client: mongomock.MongoClient = mongomock.MongoClient()
+    mock_collection: mongomock.Collection = mock_client.db.collection
 
     database_setup = DatabaseSetup(
         connection_string="connection_string",
@@ -143,15 +164,17 @@ def database_mock(approaches_base_mock):
         collection_name="collection_name",
         index_name="index_name",
         vector_store_api=approaches_base_mock._vector_store,
-        users_collection=mock_collection,
+        users_collection=AsyncCollection(mock_collection),
         data_collection=approaches_base_mock._data_collection,
+        metadata_collection=AsyncCollection(mock_client.db.Metadata),
+        mongo_client=mock_client,
     )
 
     return database_setup
 
 
 @pytest.fixture
-def setup_mock(rag_mock, vector_mock, database_mock, keyword_mock):
+def setup_mock(rag_mock, vector_mock, database_mock, keyword_mock, hybrid_mock):
     """Mock quartapp.approaches.setup.Setup."""
     setup = Setup(
         openai_embeddings_model="openai_embeddings_model",
@@ -173,9 +196,12 @@ def setup_mock(rag_mock, vector_mock, database_mock, keyword_mock):
     )
 
     setup._database_setup = database_mock
+    setup.history_writer = HistoryWriter(database_mock._users_collection)
+    setup.session_history = SessionHistory(database_mock._users_collection)
     setup.vector_search = vector_mock
     setup.rag = rag_mock
     setup.keyword = keyword_mock
+    setup.hybrid = hybrid_mock
     return setup
 
 
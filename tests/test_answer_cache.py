@@ -0,0 +1,117 @@
+"""Tests for quartapp.approaches.answer_cache module."""
+
+from unittest.mock import patch
+
+import mongomock
+import pytest
+from langchain_core.documents import Document
+
+from quartapp.approaches.answer_cache import AnswerCache, document_ids
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.utils import bump_data_version
+
+SMOOTHIE = Document(page_content='{"name": "smoothie"}', metadata={"_id": "1", "source": "menu"})
+SALAD = Document(page_content='{"name": "salad"}', metadata={"_id": "2", "source": "menu"})
+
+
+def test_document_ids():
+    """Test that documents are identified by _id, or by content when there is none."""
+    without_id = Document(page_content="tofu", metadata={"source": "menu"})
+
+    ids = document_ids([SMOOTHIE, without_id])
+
+    assert ids[0] == "1"
+    assert ids[1] == document_ids([Document(page_content="tofu")])[0]
+
+
+@pytest.mark.asyncio
+async def test_hit_within_distance():
+    """Test that a close question retrieving the same documents is answered from cache."""
+    cache = AnswerCache(max_distance=0.05)
+    cache.store(await cache.lookup([1.0, 0.0], [SMOOTHIE, SALAD], 0.3), "We have a mango smoothie.")
+
+    close = await cache.lookup([0.99, 0.05], [SMOOTHIE, SALAD], 0.3)
+    far = await cache.lookup([0.5, 0.5], [SMOOTHIE, SALAD], 0.3)
+
+    assert close.answer == "We have a mango smoothie."
+    assert close.describe().startswith("hit (distance 0.001")
+    assert far.answer is None
+    assert far.describe() == "miss"
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3, "size": 1, "max_size": 256, "invalidations": 0}
+
+
+@pytest.mark.asyncio
+async def test_miss_for_other_documents_or_temperature():
+    """Test that the retrieved documents and the temperature are part of the key."""
+    cache = AnswerCache()
+    cache.store(await cache.lookup([1.0, 0.0], [SMOOTHIE, SALAD], 0.3), "answer")
+
+    assert (await cache.lookup([1.0, 0.0], [SALAD, SMOOTHIE], 0.3)).answer is None
+    assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer is None
+    assert (await cache.lookup([1.0, 0.0], [SMOOTHIE, SALAD], 0.8)).answer is None
+    assert (await cache.lookup([1.0, 0.0], [SMOOTHIE, SALAD], 0.3)).answer == "answer"
+
+
+@pytest.mark.asyncio
+async def test_ttl_expiry():
+    """Test that expired answers are dropped."""
+    cache = AnswerCache(ttl_seconds=60)
+    with patch("quartapp.approaches.answer_cache.time.monotonic", return_value=1000.0):
+        cache.store(await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3), "answer")
+
+    with patch("quartapp.approaches.answer_cache.time.monotonic", return_value=1050.0):
+        assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer == "answer"
+    with patch("quartapp.approaches.answer_cache.time.monotonic", return_value=1070.0):
+        assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer is None
+
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_size_bound_evicts_least_recently_used():
+    """Test that the least recently used documents lose their answers first."""
+    cache = AnswerCache(max_size=2)
+    cache.store(await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3), "smoothie")
+    cache.store(await cache.lookup([1.0, 0.0], [SALAD], 0.3), "salad")
+    await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)
+
+    cache.store(await cache.lookup([0.0, 1.0], [SMOOTHIE], 0.3), "another smoothie")
+
+    assert cache.stats()["size"] == 2
+    assert (await cache.lookup([1.0, 0.0], [SALAD], 0.3)).answer is None
+    assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer == "smoothie"
+    assert (await cache.lookup([0.0, 1.0], [SMOOTHIE], 0.3)).answer == "another smoothie"
+
+
+@pytest.mark.asyncio
+async def test_data_version_change_invalidates():
+    """Test that bumping the data version (as add_data does) clears the cache."""
+    metadata_collection: mongomock.Collection = mongomock.MongoClient().db.Metadata
+    cache = AnswerCache(
+        metadata_collection=AsyncCollection(metadata_collection), collection_name="menu", version_poll_seconds=0
+    )
+    cache.store(await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3), "answer")
+    assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer == "answer"
+
+    bump_data_version(metadata_collection, "menu")
+
+    assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer is None
+    assert cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_data_version_is_polled():
+    """Test that the data version is read at most once per poll interval."""
+    metadata_collection: mongomock.Collection = mongomock.MongoClient().db.Metadata
+    cache = AnswerCache(
+        metadata_collection=AsyncCollection(metadata_collection), collection_name="menu", version_poll_seconds=30
+    )
+    with patch("quartapp.approaches.answer_cache.time.monotonic", return_value=1000.0):
+        cache.store(await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3), "answer")
+
+    bump_data_version(metadata_collection, "menu")
+
+    with patch("quartapp.approaches.answer_cache.time.monotonic", return_value=1010.0):
+        assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer == "answer"
+    with patch("quartapp.approaches.answer_cache.time.monotonic", return_value=1031.0):
+        assert (await cache.lookup([1.0, 0.0], [SMOOTHIE], 0.3)).answer is None
@@ -1,10 +1,12 @@
+import asyncio
 from unittest.mock import AsyncMock
 
 import pytest
 from pymongo.errors import OperationFailure
 
 from quartapp.app import create_app
-from quartapp.approaches.schemas import AIChatRoles
+from quartapp.approaches.rag import RephrasedQuestion
+from quartapp.approaches.schemas import AIChatRoles, StreamStage, Thought
 
 
 def test_config(mock_session_env) -> None:
@@ -67,6 +69,123 @@ async def test_run_vector_operation_failure_returns_no_results(app_config_mock):
     assert result.context.data_points[0].name is None
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "approach, run_stream, title",
+    [
+        ("keyword", "run_keyword_stream", "Cosmos Text Search"),
+        ("vector_search", "run_vector_stream", "Cosmos Vector Search"),
+        ("hybrid", "run_hybrid_stream", "Cosmos Hybrid Search"),
+    ],
+)
+async def test_run_search_stream(app_config_mock, approach, run_stream, title):
+    """Test that the search streams send the context first, then the top result line by line."""
+    from langchain_core.documents import Document
+
+    answer = '{"name": "test", "description": "test", "price": "5.0USD", "category": "test"}'
+    mock_document = Document(page_content=answer, metadata={"source": "test"})
+    setattr(getattr(app_config_mock.setup, approach), "run", AsyncMock(return_value=([mock_document], answer)))
+    app_config_mock.add_to_cosmos = AsyncMock()
+    messages = [{"content": "test", "role": "user"}]
+
+    deltas = [delta async for delta in getattr(app_config_mock, run_stream)("test-session", messages, 0.3, 1, 0.0)]
+
+    assert deltas[0].sessionState == "test-session"
+    assert deltas[0].delta is None
+    assert [thought.title for thought in deltas[0].context.thoughts[:3]] == [
+        f"{title} Query",
+        f"{title} Result",
+        f"{title} Top Result",
+    ]
+    assert all(delta.context is None and delta.delta.role == AIChatRoles.ASSISTANT for delta in deltas[1:])
+    content = "".join(delta.delta.content for delta in deltas[1:])
+    assert "Name: test" in content
+    assert (
+        content
+        == (
+            await getattr(app_config_mock, run_stream.removesuffix("_stream"))("s", messages, 0.3, 1, 0.0)
+        ).message.content
+    )
+    await app_config_mock.wait_for_history_writes()
+    assert app_config_mock.add_to_cosmos.await_args_list[0].kwargs["new_message"]["content"] == content
+
+
+@pytest.mark.asyncio
+async def test_run_search_stream_does_not_wait_for_history(app_config_mock):
+    """Test that the search stream ends once the answer is sent, while the history write is still pending."""
+    from langchain_core.documents import Document
+
+    answer = '{"name": "test", "description": "test", "price": "5.0USD", "category": "test"}'
+    app_config_mock.setup.vector_search.run = AsyncMock(
+        return_value=([Document(page_content=answer, metadata={"source": "test"})], answer)
+    )
+    release = asyncio.Event()
+    recorded = []
+
+    async def add_to_cosmos(old_messages, new_message, session_state, new_session_state):
+        await release.wait()
+        recorded.append(new_message["content"])
+        return True
+
+    app_config_mock.add_to_cosmos = add_to_cosmos
+
+    deltas = [delta async for delta in app_config_mock.run_vector_stream(None, [{"content": "test"}], 0.3, 1, 0.0)]
+
+    assert recorded == []
+    release.set()
+    await app_config_mock.wait_for_history_writes()
+    assert recorded == ["".join(delta.delta.content for delta in deltas[1:])]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("run_stream", ["run_keyword_stream", "run_vector_stream", "run_hybrid_stream"])
+@pytest.mark.parametrize("run_result", [AsyncMock(return_value=([], "")), AsyncMock(side_effect=OperationFailure("x"))])
+async def test_run_search_stream_no_results(app_config_mock, run_stream, run_result):
+    """Test that the search streams send and record a no-results message when retrieval finds nothing."""
+    for approach in ("keyword", "vector_search", "hybrid"):
+        setattr(getattr(app_config_mock.setup, approach), "run", run_result)
+
+    deltas = [delta async for delta in getattr(app_config_mock, run_stream)(None, [{"content": "test"}], 0.3, 1, 0.0)]
+    await app_config_mock.wait_for_history_writes()
+
+    assert len(deltas) == 2
+    assert deltas[0].sessionState is not None
+    assert deltas[0].context.data_points[0].name is None
+    assert deltas[1].delta.content == "No results found"
+    history = await app_config_mock.with_server_history(deltas[0].sessionState, [])
+    assert [message["content"] for message in history] == ["test", "No results found"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_requests_share_one_run(app_config_mock):
+    """Test that identical requests in flight together run the approach once, with a session each."""
+    from langchain_core.documents import Document
+
+    answer = '{"name": "special", "description": "test", "price": "5.0USD", "category": "test"}'
+    release = asyncio.Event()
+
+    async def run(messages, temperature, limit, score_threshold):
+        await release.wait()
+        return [Document(page_content=answer, metadata={"source": "test"})], answer
+
+    app_config_mock.setup.vector_search.run = AsyncMock(side_effect=run)
+    app_config_mock.add_to_cosmos = AsyncMock()
+
+    requests = [
+        asyncio.create_task(app_config_mock.run_vector(None, [{"content": question}], 0.3, 3, 0.0))
+        for question in ("What's today's special?", "what's today's  special?", "What's tomorrow's special?")
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    responses = await asyncio.gather(*requests)
+
+    assert app_config_mock.setup.vector_search.run.await_count == 2
+    assert all("Name: special" in response.message.content for response in responses)
+    assert len({response.sessionState for response in responses}) == 3
+    assert app_config_mock.add_to_cosmos.await_count == 3
+    assert app_config_mock.stats()["single_flight"]["shared"] == 1
+
+
 @pytest.mark.asyncio
 async def test_run_rag_no_results_with_answer(app_config_mock):
     """Test run_rag with no results but with answer returned."""
@@ -111,6 +230,7 @@ async def test_run_rag_no_results_truly_empty_answer(app_config_mock):
             return ([], "")  # Empty results and empty answer
 
         mock_setup.rag.run = mock_rag_run
+        mock_setup.history_writer.enqueue = AsyncMock()
 
         # Override the json.loads call to handle empty string
         with patch("json.loads") as mock_json_loads:
@@ -187,7 +307,9 @@ async def test_run_rag_stream(app_config_mock):
         yield MockChunk("!")
 
     # Mock the rag approach's run_stream method
-    app_config_mock.setup.rag.run_stream = AsyncMock(return_value=([mock_document], mock_stream()))
+    app_config_mock.setup.rag.run_stream = AsyncMock(
+        return_value=([mock_document], mock_stream(), RephrasedQuestion("test", "skipped: no chat history"))
+    )
 
     # Test the stream
     result_deltas = []
@@ -201,6 +323,9 @@ async def test_run_rag_stream(app_config_mock):
     assert result_deltas[0].context is not None
     assert result_deltas[0].sessionState == "test-session"
     assert result_deltas[0].delta is None
+    assert result_deltas[0].context.thoughts[1] == Thought(
+        title="Cosmos RAG Rephrase Policy", description="skipped: no chat history"
+    )
 
     # Subsequent deltas should have message content
     assert result_deltas[1].delta.content == "Hello"
@@ -208,6 +333,101 @@ async def test_run_rag_stream(app_config_mock):
     assert result_deltas[3].delta.content == "!"
 
 
+@pytest.mark.asyncio
+async def test_run_rag_stream_stage_events(app_config_mock):
+    """Test that run_rag_stream sends the stages of retrieval before the context."""
+    from langchain_core.documents import Document
+    from langchain_core.messages import AIMessageChunk
+
+    mock_document = Document(page_content='{"name": "test"}', metadata={"source": "test"})
+    rephrased = asyncio.Event()
+
+    async def mock_stream():
+        yield AIMessageChunk(content="Hi")
+
+    async def run_stream(messages, temperature, limit, score_threshold, on_stage):
+        on_stage(StreamStage.REPHRASING, None)
+        await rephrased.wait()
+        on_stage(StreamStage.REPHRASED, "vegan dishes")
+        on_stage(StreamStage.RETRIEVED, "1 documents")
+        return [mock_document], mock_stream(), RephrasedQuestion("vegan dishes", "rephrased")
+
+    app_config_mock.setup.rag.run_stream = run_stream
+    stream = app_config_mock.run_rag_stream("s", [{"content": "test"}], 0.3, 1, 0.0)
+
+    # The first stage is sent while retrieval is still waiting on the rephrase.
+    first = await anext(stream)
+    assert first.stage.name == StreamStage.REPHRASING
+    assert first.context is None and first.delta is None
+    rephrased.set()
+    deltas = [first] + [delta async for delta in stream]
+
+    assert [delta.stage.name for delta in deltas[:3]] == list(StreamStage)
+    assert deltas[1].stage.detail == "vegan dishes"
+    assert all(delta.stage.elapsed_ms >= 0 for delta in deltas[:3])
+    assert deltas[3].context is not None and deltas[3].stage is None
+    assert deltas[4].delta.content == "Hi"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("persist_partial", [True, False])
+async def test_run_rag_stream_client_disconnect(app_config_mock, persist_partial):
+    """Test that closing the stream early closes the model stream and saves the partial answer when enabled."""
+    from langchain_core.documents import Document
+    from langchain_core.messages import AIMessageChunk
+
+    mock_document = Document(page_content='{"name": "test"}', metadata={"source": "test"})
+    closed = asyncio.Event()
+
+    async def mock_stream():
+        try:
+            yield AIMessageChunk(content="We have ")
+            yield AIMessageChunk(content="tofu.")
+        finally:
+            closed.set()
+
+    app_config_mock.setup.rag.run_stream = AsyncMock(
+        return_value=([mock_document], mock_stream(), RephrasedQuestion("tofu", "skipped: no chat history"))
+    )
+    app_config_mock.setup.stream_persist_partial_answers = persist_partial
+    app_config_mock.add_to_cosmos = AsyncMock()
+
+    stream = app_config_mock.run_rag_stream(None, [{"content": "tofu", "role": "user"}], 0.3, 1, 0.0)
+    assert (await anext(stream)).context is not None
+    assert (await anext(stream)).delta.content == "We have "
+    await stream.aclose()
+
+    assert closed.is_set()
+    if persist_partial:
+        new_message = app_config_mock.add_to_cosmos.await_args.kwargs["new_message"]
+        assert new_message == {"content": "We have ", "role": AIChatRoles.ASSISTANT, "partial": True}
+    else:
+        app_config_mock.add_to_cosmos.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_run_rag_stream_reports_rephrase_history(app_config_mock):
+    """Test that the packed rephrase history is reported right after the rephrase policy."""
+    from langchain_core.documents import Document
+
+    mock_document = Document(page_content='{"name": "test"}', metadata={"source": "test"})
+
+    async def mock_stream():
+        return
+        yield
+
+    rephrased_question = RephrasedQuestion("test", "rephrased", history="kept 2 of 4 messages, 30 tokens (saved 90)")
+    app_config_mock.setup.rag.run_stream = AsyncMock(return_value=([mock_document], mock_stream(), rephrased_question))
+
+    deltas = [delta async for delta in app_config_mock.run_rag_stream("s", [{"content": "test"}], 0.3, 1, 0.0)]
+
+    assert [thought.title for thought in deltas[0].context.thoughts[1:3]] == [
+        "Cosmos RAG Rephrase Policy",
+        "Cosmos RAG Rephrase History",
+    ]
+    assert deltas[0].context.thoughts[2].description == "kept 2 of 4 messages, 30 tokens (saved 90)"
+
+
 @pytest.mark.asyncio
 async def test_run_rag_stream_without_session_state(app_config_mock):
     """Test run_rag_stream method without session state (new session)."""
@@ -228,7 +448,9 @@ async def test_run_rag_stream_without_session_state(app_config_mock):
         yield MockChunk("Test content")
 
     # Mock the rag approach's run_stream method
-    app_config_mock.setup.rag.run_stream = AsyncMock(return_value=([mock_document], mock_stream()))
+    app_config_mock.setup.rag.run_stream = AsyncMock(
+        return_value=([mock_document], mock_stream(), RephrasedQuestion("test", "skipped: no chat history"))
+    )
 
     # Test the stream without session state
     result_deltas = []
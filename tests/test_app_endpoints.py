@@ -1,11 +1,21 @@
+import asyncio
 import json
 import os
 
 import pytest
 from quart import Response
 
-from quartapp.app import format_as_ndjson
-from quartapp.approaches.schemas import AIChatRoles, Context, DataPoint, Message, RetrievalResponseDelta, Thought
+from quartapp.app import create_app, delta_line, format_as_ndjson
+from quartapp.approaches.schemas import (
+    AIChatRoles,
+    Context,
+    DataPoint,
+    Message,
+    RetrievalResponse,
+    RetrievalResponseDelta,
+    Thought,
+)
+from quartapp.config import AppConfig
 
 
 @pytest.mark.asyncio
@@ -115,6 +125,57 @@ async def test_chat_not_implemented_501(client_mock):
     assert b'{"error":"Not Implemented!"}' in await response.data
 
 
+@pytest.mark.asyncio
+async def test_chat_server_history(monkeypatch, mock_session_env):
+    """Test that server_history rebuilds the conversation from the session before running the approach."""
+    calls = []
+
+    async def with_server_history(self, session_state, messages):
+        return [{"content": "stored"}, *messages]
+
+    async def run_keyword(self, session_state, messages, temperature, limit, score_threshold):
+        calls.append((session_state, messages))
+        return RetrievalResponse(Context([DataPoint()], [Thought()]), Message(content="ok"), session_state)
+
+    monkeypatch.setattr(AppConfig, "with_server_history", with_server_history)
+    monkeypatch.setattr(AppConfig, "run_keyword", run_keyword)
+    client = create_app().test_client()
+
+    body = {"sessionState": "s", "messages": [{"content": "newest"}]}
+    overrides = {"retrieval_mode": "keyword"}
+    await client.post("/chat", json={**body, "context": {"overrides": {**overrides, "server_history": True}}})
+    await client.post("/chat", json={**body, "context": {"overrides": overrides}})
+
+    assert calls == [
+        ("s", [{"content": "stored"}, {"content": "newest"}]),
+        ("s", [{"content": "newest"}]),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", ["/chat/stream", "/chat/sse"])
+async def test_chat_stream_server_history_error_500(monkeypatch, mock_session_env, path):
+    """Test that a failure loading the server-side history is returned as an error by the streaming routes."""
+
+    async def with_server_history(self, session_state, messages):
+        raise RuntimeError("history unavailable")
+
+    monkeypatch.setattr(AppConfig, "with_server_history", with_server_history)
+    client = create_app().test_client()
+
+    response: Response = await client.post(
+        path,
+        json={
+            "sessionState": "s",
+            "messages": [{"content": "newest"}],
+            "context": {"overrides": {"retrieval_mode": "rag", "server_history": True}},
+        },
+    )
+
+    assert response.status_code == 500
+    assert await response.get_json() == {"error": "history unavailable"}
+
+
 @pytest.mark.asyncio
 async def test_chat_stream_non_json_415(client_mock):
     """test the chat route with a non-json request"""
@@ -155,6 +216,85 @@ async def test_chat_stream_not_implemented_501(client_mock):
     assert b'{"error":"Not Implemented!"}' in await response.data
 
 
+@pytest.mark.asyncio
+async def test_chat_stream_keyword(monkeypatch, mock_session_env):
+    """Test that the search modes stream as NDJSON too."""
+
+    async def run_keyword_stream(self, session_state, messages, temperature, limit, score_threshold):
+        yield RetrievalResponseDelta(context=Context([DataPoint()], [Thought()]), sessionState="s")
+        yield RetrievalResponseDelta(delta=Message(content="Name: test"))
+
+    monkeypatch.setattr(AppConfig, "run_keyword_stream", run_keyword_stream)
+    client = create_app().test_client()
+
+    response: Response = await client.post(
+        "/chat/stream",
+        json={"messages": [{"content": "test"}], "context": {"overrides": {"retrieval_mode": "keyword"}}},
+    )
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert lines[0]["sessionState"] == "s"
+    assert lines[1]["delta"]["content"] == "Name: test"
+
+
+def _sse_events(data: str) -> list[dict]:
+    events = []
+    for block in data.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append({"id": fields.get("id"), "data": json.loads(fields["data"])})
+    return events
+
+
+@pytest.mark.asyncio
+async def test_chat_sse_resume(monkeypatch, mock_session_env):
+    """Test that an SSE client can resume an answer with Last-Event-ID without running the question again."""
+    calls = []
+
+    async def run_keyword_stream(self, session_state, messages, temperature, limit, score_threshold):
+        calls.append(session_state)
+        yield RetrievalResponseDelta(context=Context([DataPoint()], [Thought()]), sessionState="s")
+        yield RetrievalResponseDelta(sessionState="s", delta=Message(content="Name: test"))
+        yield RetrievalResponseDelta(sessionState="s", delta=Message(content="Price: 5.0USD"))
+
+    monkeypatch.setattr(AppConfig, "run_keyword_stream", run_keyword_stream)
+    client = create_app().test_client()
+
+    response: Response = await client.post(
+        "/chat/sse",
+        json={
+            "sessionState": "s",
+            "messages": [{"content": "test"}],
+            "context": {"overrides": {"retrieval_mode": "keyword"}},
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = _sse_events(await response.get_data(as_text=True))
+    assert [event["id"] for event in events] == ["s:1", "s:2", "s:3"]
+    assert events[1]["data"]["delta"]["content"] == "Name: test"
+
+    resumed: Response = await client.get("/chat/sse", headers={"Last-Event-ID": "s:1"})
+
+    assert resumed.status_code == 200
+    assert _sse_events(await resumed.get_data(as_text=True)) == events[1:]
+    assert calls == ["s"]
+
+
+@pytest.mark.asyncio
+async def test_chat_sse_resume_errors(client_mock):
+    """Test resuming a stream that is not buffered, and a GET without Last-Event-ID."""
+    missing: Response = await client_mock.get("/chat/sse", headers={"Last-Event-ID": "unknown:3"})
+    malformed: Response = await client_mock.get("/chat/sse", headers={"Last-Event-ID": "unknown"})
+    without_id: Response = await client_mock.get("/chat/sse")
+
+    assert missing.status_code == 404
+    assert malformed.status_code == 404
+    assert without_id.status_code == 400
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson_success():
     """Test the format_as_ndjson function with successful stream."""
@@ -180,6 +320,26 @@ async def test_format_as_ndjson_success():
     assert parsed["sessionState"] == "test-session"
 
 
+@pytest.mark.asyncio
+async def test_format_as_ndjson_closes_stream():
+    """Test that closing the NDJSON response closes the stream it formats."""
+    closed = False
+
+    async def mock_stream():
+        nonlocal closed
+        try:
+            yield RetrievalResponseDelta(sessionState="test")
+            yield RetrievalResponseDelta(sessionState="test")
+        finally:
+            closed = True
+
+    lines = format_as_ndjson(mock_stream())
+    await anext(lines)
+    await lines.aclose()
+
+    assert closed
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson_exception():
     """Test the format_as_ndjson function with exception in stream."""
@@ -203,6 +363,91 @@ async def test_format_as_ndjson_exception():
     assert "Test error" in parsed_error["error"]
 
 
+@pytest.mark.parametrize("content", ["Hi", ' "quoted" \\ and\nnewline', "caf\u00e9 \U0001f35c", "", None])
+def test_delta_line(content):
+    """Test that the message delta fast path serializes like the generic path."""
+    message = Message(content=content, role=AIChatRoles.ASSISTANT)
+
+    assert delta_line(message) == json.dumps(RetrievalResponseDelta(delta=message).to_dict(), ensure_ascii=False) + "\n"
+
+
+def _token_deltas(*tokens):
+    return [RetrievalResponseDelta(delta=Message(content=token)) for token in tokens]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesces_by_size():
+    """Test that consecutive message deltas are merged into lines of at least the given size."""
+
+    async def mock_stream():
+        yield RetrievalResponseDelta(context=Context([DataPoint()], [Thought()]), sessionState="s")
+        for delta in _token_deltas("We", " have", " tofu", " and", " tempeh", "."):
+            yield delta
+
+    lines = [json.loads(line) async for line in format_as_ndjson(mock_stream(), coalesce_chars=8)]
+
+    assert lines[0]["sessionState"] == "s"
+    assert [line["delta"]["content"] for line in lines[1:]] == ["We have tofu", " and tempeh", "."]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesces_by_time():
+    """Test that merged deltas are written once they are due, even while the stream is waiting on a token."""
+    next_token = asyncio.Event()
+
+    async def mock_stream():
+        yield RetrievalResponseDelta(delta=Message(content="We"))
+        yield RetrievalResponseDelta(delta=Message(content=" have"))
+        await next_token.wait()
+        yield RetrievalResponseDelta(delta=Message(content=" tofu"))
+        yield RetrievalResponseDelta(sessionState="s")
+        yield RetrievalResponseDelta(delta=Message(content="."))
+
+    lines = format_as_ndjson(mock_stream(), coalesce_ms=10, coalesce_chars=1000)
+
+    assert json.loads(await asyncio.wait_for(anext(lines), timeout=1))["delta"]["content"] == "We have"
+    next_token.set()
+    rest = [json.loads(line) async for line in lines]
+    assert [line["delta"]["content"] if line["delta"] else line["sessionState"] for line in rest] == [" tofu", "s", "."]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesced_error():
+    """Test that merged deltas are written before the error that ended the stream."""
+
+    async def mock_stream():
+        for delta in _token_deltas("We", " have"):
+            yield delta
+        raise ValueError("Test error")
+
+    lines = [json.loads(line) async for line in format_as_ndjson(mock_stream(), coalesce_ms=1000, coalesce_chars=64)]
+
+    assert lines == [
+        {"context": None, "delta": {"content": "We have", "role": "assistant"}, "sessionState": None},
+        {"error": "Test error"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalescing_closes_stream():
+    """Test that closing the response while a token is awaited closes the stream."""
+    closed = asyncio.Event()
+
+    async def mock_stream():
+        try:
+            yield RetrievalResponseDelta(delta=Message(content="We"))
+            await asyncio.sleep(10)
+            yield RetrievalResponseDelta(delta=Message(content=" have"))
+        finally:
+            closed.set()
+
+    lines = format_as_ndjson(mock_stream(), coalesce_ms=10)
+    assert json.loads(await anext(lines))["delta"]["content"] == "We"
+    await lines.aclose()
+
+    assert closed.is_set()
+
+
 @pytest.mark.asyncio
 async def test_chat_with_empty_messages_list(client_mock):
     """Test the chat route with empty messages list."""
@@ -227,3 +472,24 @@ async def test_chat_stream_with_empty_messages_list(client_mock):
     assert response.status_code == 400
     data = await response.get_json()
     assert data["error"] == "request must have a message"
+
+
+@pytest.mark.asyncio
+async def test_stats_disabled_by_default(client_mock):
+    """Test the stats route is not served unless it is enabled."""
+    response: Response = await client_mock.get("/stats")
+
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_stats(monkeypatch, mock_session_env):
+    """Test the stats route exposes the shared connection pool counters once enabled."""
+    monkeypatch.setenv("STATS_ENDPOINT", "true")
+    client = create_app().test_client()
+
+    response: Response = await client.get("/stats")
+
+    assert response.status_code == 200
+    data = await response.get_json()
+    assert set(data["mongo_pool"]) == {"servers", "open", "in_use", "created", "closed", "checkout_failures", "cleared"}
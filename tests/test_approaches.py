@@ -1,9 +1,47 @@
-from unittest.mock import AsyncMock, MagicMock, patch
+import asyncio
+import json
+import random
+import time
+from unittest.mock import AsyncMock, MagicMock, call, patch
 
+import mongomock
 import pytest
+from langchain_community.vectorstores.azure_cosmos_db import CosmosDBVectorSearchType
 from langchain_core.documents import Document
-
-from quartapp.approaches.schemas import AIChatRoles, Context, DataPoint, Message, RetrievalResponse, Thought
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable
+from pymongo.errors import OperationFailure
+
+from quartapp.approaches.answer_cache import AnswerCache
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.embedding_batcher import BatchingEmbeddings
+from quartapp.approaches.embedding_cache import CachedEmbeddings
+from quartapp.approaches.hybrid import reciprocal_rank_fusion
+from quartapp.approaches.local_index import MISSING_SIMILARITY_INDEX_ERROR, LocalVectorIndex
+from quartapp.approaches.rag import (
+    GenerationStats,
+    RephrasedQuestion,
+    close_stream,
+    is_standalone_question,
+    track_generation,
+)
+from quartapp.approaches.schemas import (
+    AIChatRoles,
+    Context,
+    DataPoint,
+    LocalIndexMode,
+    Message,
+    RephrasePolicy,
+    RetrievalResponse,
+    StreamStage,
+    Thought,
+)
+from quartapp.approaches.vector_index import RecordedVectorIndex, choose_index_params
+
+# Captured at import time, before the autouse fixture in conftest replaces it with a mock.
+RUNNABLE_OR = Runnable.__or__
 
 
 @pytest.mark.asyncio
@@ -44,6 +82,57 @@ async def test_keyword_run(keyword_mock):
     )
 
 
+@pytest.mark.asyncio
+async def test_keyword_projects_away_the_embedding(keyword_mock):
+    """Test that the $text search only asks for the fields the approaches read, best matches first."""
+    await keyword_mock.run([{"content": "test"}], 0.0, 3, 0.0)
+
+    keyword_mock._data_collection.collection.find.assert_called_once_with(
+        {"$text": {"$search": "test"}},
+        {"textContent": 1, "metadata": 1, "score": {"$meta": "textScore"}},
+        sort=[("score", {"$meta": "textScore"})],
+    )
+
+
+class TextSearchCollection:
+    """Stand-in for the data collection that scores $text matches by the number of query words they contain."""
+
+    def __init__(self, documents):
+        self._documents = documents
+
+    def find(self, filter, projection, sort=None):
+        words = filter["$text"]["$search"].lower().split()
+        matches = [
+            {**document, "score": float(sum(word in document["textContent"].lower() for word in words))}
+            for document in self._documents
+        ]
+        matches = [match for match in matches if match["score"]]
+        if sort is not None:
+            matches.sort(key=lambda match: -match["score"])
+        cursor = MagicMock()
+        cursor.limit = lambda limit: matches[:limit] if limit else matches
+        return cursor
+
+
+@pytest.mark.asyncio
+async def test_keyword_returns_best_matches_first(keyword_mock):
+    """Test that keyword results are ranked by text score, so the limit keeps the best matches."""
+    keyword_mock._data_collection = AsyncCollection(
+        TextSearchCollection(  # type: ignore[arg-type]
+            [
+                {"_id": "lassi", "textContent": "mango lassi", "metadata": {"source": "lassi"}},
+                {"_id": "bowl", "textContent": "vegan mango smoothie bowl", "metadata": {"source": "bowl"}},
+                {"_id": "green", "textContent": "green smoothie", "metadata": {"source": "green"}},
+            ]
+        )
+    )
+
+    documents, answer = await keyword_mock.run([{"content": "vegan mango smoothie"}], 0.0, 2, 0.0)
+
+    assert answer == "vegan mango smoothie bowl"
+    assert [document.metadata["source"] for document in documents] == ["bowl", "lassi"]
+
+
 @pytest.mark.asyncio
 async def test_vector_no_messages(vector_mock):
     """Test the Vector class."""
@@ -70,6 +159,186 @@ async def test_vector_run(vector_mock):
     )
 
 
+@pytest.mark.asyncio
+async def test_vector_run_batches_concurrent_query_embeddings(vector_mock):
+    """Test that concurrent vector searches embed their queries with a single batched call."""
+    embeddings = MagicMock()
+    embeddings.aembed_documents = AsyncMock(side_effect=lambda texts: [[float(len(text)), 0.5] for text in texts])
+    vector_mock._embedding = BatchingEmbeddings(embeddings, max_batch_size=8, window_ms=10)
+
+    await asyncio.gather(*(vector_mock.run([{"content": query}], 0.0, 1, 0.0) for query in ("vegan", "spicy", "tea")))
+
+    embeddings.aembed_documents.assert_awaited_once_with(["vegan", "spicy", "tea"])
+    embeddings.embed_query.assert_not_called()
+    searches = vector_mock._vector_store._similarity_search_with_score.call_args_list
+    assert sorted(search.args[0] for search in searches) == [[3.0, 0.5], [5.0, 0.5], [5.0, 0.5]]
+
+
+@pytest.mark.asyncio
+async def test_vector_run_queries_hnsw_index_with_its_pipeline(vector_mock):
+    """Test that an HNSW index recorded in the metadata is queried as HNSW, with an efSearch, not through IVF."""
+    metadata_collection: mongomock.Collection = mongomock.MongoClient().db.Metadata
+    hnsw = choose_index_params(500_000, 2)
+    metadata_collection.insert_one({"_id": "collection", "vector_index": {"params": hnsw.to_dict()}})
+    vector_mock._vector_index = RecordedVectorIndex(AsyncCollection(metadata_collection), "collection")
+
+    await vector_mock.run([{"content": "test"}], 0.0, 3, 0.0)
+
+    search = vector_mock._vector_store._similarity_search_with_score.call_args
+    assert (search.kwargs["kind"], search.kwargs["ef_search"], search.kwargs["k"]) == (
+        CosmosDBVectorSearchType.VECTOR_HNSW,
+        40,
+        3,
+    )
+
+
+async def _loaded_local_index() -> LocalVectorIndex:
+    collection: mongomock.Collection = mongomock.MongoClient().db.collection
+    collection.insert_one(
+        {
+            "_id": "local",
+            "textContent": '{"name": "local", "description": "local", "price": "1.0USD", "category": "local"}',
+            "vectorContent": [1.0, 0.0],
+            "metadata": {"source": "local"},
+        }
+    )
+    local_index = LocalVectorIndex(AsyncCollection(collection))
+    await local_index.load()
+    return local_index
+
+
+@pytest.mark.asyncio
+async def test_vector_falls_back_to_local_index(vector_mock):
+    """Test that a missing Cosmos vector index is served from the local vector index."""
+    vector_mock._local_index = await _loaded_local_index()
+    vector_mock._local_index_mode = LocalIndexMode.FALLBACK
+    vector_mock._embedding.aembed_query = AsyncMock(return_value=[1.0, 0.0])
+    vector_mock._vector_store._similarity_search_with_score = MagicMock(
+        side_effect=OperationFailure(MISSING_SIMILARITY_INDEX_ERROR, code=2)
+    )
+
+    documents, answer = await vector_mock.run([{"content": "local"}], 0.0, 1, 0.0)
+
+    assert documents == [Document(page_content=answer, metadata={"source": "local"})]
+    assert vector_mock._local_index.stats()["fallbacks"] == 1
+
+
+@pytest.mark.asyncio
+async def test_vector_reraises_other_operation_failures(vector_mock):
+    """Test that only the missing index error falls back to the local vector index."""
+    vector_mock._local_index = await _loaded_local_index()
+    vector_mock._local_index_mode = LocalIndexMode.FALLBACK
+    vector_mock._vector_store._similarity_search_with_score = MagicMock(
+        side_effect=OperationFailure("Unauthorized", code=13)
+    )
+
+    with pytest.raises(OperationFailure, match="Unauthorized"):
+        await vector_mock.run([{"content": "local"}], 0.0, 1, 0.0)
+
+
+@pytest.mark.asyncio
+async def test_rag_uses_primary_local_index(rag_mock):
+    """Test that the primary local index serves RAG retrieval, including speculative searches."""
+    rag_mock._local_index = await _loaded_local_index()
+    rag_mock._local_index_mode = LocalIndexMode.PRIMARY
+    rag_mock._embedding.aembed_query = AsyncMock(return_value=[1.0, 0.0])
+
+    documents, _ = await rag_mock.run([{"content": "local"}], 0.0, 1, 0.0)
+    rag_mock._speculative_retrieval = True
+    speculative_documents, _ = await rag_mock.run([{"content": "local"}], 0.0, 1, 0.0)
+
+    assert (
+        documents
+        == speculative_documents
+        == [Document(page_content=documents[0].page_content, metadata={"source": "local"})]
+    )
+    rag_mock._vector_store._similarity_search_with_score.assert_not_called()
+    assert rag_mock._local_index.stats()["queries"] == 2
+
+
+def test_reciprocal_rank_fusion():
+    """Test that reciprocal rank fusion weights ranks and deduplicates on document id."""
+    mango = Document(page_content="mango", metadata={"_id": "1"})
+    berry = Document(page_content="berry", metadata={"_id": "2"})
+    salad = Document(page_content="salad", metadata={"_id": "3"})
+    mango_from_vector = Document(page_content="mango", metadata={"_id": "1", "extra": True})
+
+    fused = reciprocal_rank_fusion([[mango, berry], [salad, mango_from_vector]], [1.0, 1.0], k=60)
+
+    assert [document.page_content for document, _ in fused] == ["mango", "salad", "berry"]
+    assert fused[0][0] is mango
+    assert fused[0][1] == pytest.approx(1 / 61 + 1 / 62)
+
+    keyword_only = reciprocal_rank_fusion([[mango, berry], [salad, mango_from_vector]], [1.0, 0.0], k=60)
+    assert [document.page_content for document, _ in keyword_only] == ["mango", "berry", "salad"]
+
+
+@pytest.mark.asyncio
+async def test_hybrid_run(hybrid_mock):
+    """Test the Hybrid class run method fuses keyword and vector results."""
+    result = await hybrid_mock.run([{"content": "test"}], 0.0, 3, 0.0)
+
+    # The keyword and vector mocks return the same document, so it is only returned once.
+    assert result == (
+        [
+            Document(
+                metadata={"source": "test"},
+                page_content='{"name": "test", "description": "test", "price": "5.0USD", "category": "test"}',
+            )
+        ],
+        '{"name": "test", "description": "test", "price": "5.0USD", "category": "test"}',
+    )
+
+
+@pytest.mark.asyncio
+async def test_hybrid_searches_run_concurrently(hybrid_mock):
+    """Test that the keyword and vector searches overlap instead of running one after the other."""
+
+    async def slow_text_search(query, limit):
+        await asyncio.sleep(0.2)
+        return [Document(page_content="keyword", metadata={"_id": "1", "source": "test"})]
+
+    async def slow_similarity_search(query, limit, score_threshold):
+        await asyncio.sleep(0.2)
+        return [Document(page_content="vector", metadata={"_id": "2", "source": "test"})]
+
+    hybrid_mock._text_search = slow_text_search
+    hybrid_mock._similarity_search = slow_similarity_search
+
+    started = time.perf_counter()
+    documents = await hybrid_mock.search("test", 3, 0.0)
+
+    assert time.perf_counter() - started < 0.35
+    assert [document.page_content for document in documents] == ["keyword", "vector"]
+
+
+@pytest.mark.asyncio
+async def test_hybrid_search_respects_limit(hybrid_mock):
+    """Test that the fused results are cut down to the requested number of documents."""
+    hybrid_mock._text_search = AsyncMock(
+        return_value=[Document(page_content=str(i), metadata={"_id": f"k{i}"}) for i in range(3)]
+    )
+    hybrid_mock._similarity_search = AsyncMock(
+        return_value=[Document(page_content=str(i), metadata={"_id": f"v{i}"}) for i in range(3)]
+    )
+
+    assert len(await hybrid_mock.search("test", 2, 0.0)) == 2
+
+
+@pytest.mark.asyncio
+async def test_rag_uses_hybrid_context(rag_mock, hybrid_mock):
+    """Test that the RAG context can come from hybrid retrieval."""
+    hybrid_document = Document(page_content='{"name": "hybrid"}', metadata={"_id": "1", "source": "hybrid"})
+    hybrid_mock.search = AsyncMock(return_value=[hybrid_document])
+    rag_mock._hybrid = hybrid_mock
+
+    documents, _ = await rag_mock.run([{"content": "test"}], 0.0, 3, 0.0)
+
+    hybrid_mock.search.assert_awaited_once_with("test", 3, 0.0)
+    rag_mock._vector_store._similarity_search_with_score.assert_not_called()
+    assert documents == [Document(page_content='{"name": "hybrid"}', metadata={"source": "hybrid"})]
+
+
 @pytest.mark.asyncio
 async def test_rag_no_messages(rag_mock):
     """Test the RAG class."""
@@ -92,8 +361,231 @@ async def test_rag_run(rag_mock):
                 page_content='{"name": "test", "description": "test", "price": "5.0USD", "category": "test"}',
             )
         ],
-        '{"response": "content", "rephrased_response": "content"}',
+        '{"response": "content", "rephrased_response": "test", "rephrase_decision": "skipped: no chat history"}',
+    )
+
+
+@pytest.mark.asyncio
+async def test_rag_run_with_history_rephrases(rag_mock):
+    """Test the RAG class run method rephrases follow-up questions."""
+    messages = [{"content": "vegan dishes"}, {"content": "We have tofu."}, {"content": "is it spicy?"}]
+    _, answer = await rag_mock.run(messages, 0.0, 0, 0.0)
+    assert json.loads(answer) == {
+        "response": "content",
+        "rephrased_response": "content",
+        "rephrase_decision": "rephrased",
+        "rephrase_history": "kept 2 of 2 messages, 10 tokens (saved 5)",
+    }
+
+
+@pytest.mark.asyncio
+async def test_rag_rephrase_policy_always(rag_mock):
+    """Test the always policy rephrases even the first question."""
+    rag_mock._rephrase_policy = RephrasePolicy.ALWAYS
+    rephrased_question = await rag_mock._rephrase([{"content": "test"}])
+    assert rephrased_question == RephrasedQuestion(content="content", decision="rephrased")
+
+
+@pytest.mark.asyncio
+async def test_rag_rephrase_policy_heuristic(rag_mock):
+    """Test the heuristic policy skips follow-ups that do not refer back to the conversation."""
+    rag_mock._rephrase_policy = RephrasePolicy.HEURISTIC
+    history = [{"content": "vegan dishes"}, {"content": "We have tofu."}]
+
+    standalone = await rag_mock._rephrase([*history, {"content": "Do you have any gluten free desserts?"}])
+    follow_up = await rag_mock._rephrase([*history, {"content": "How much does that one cost?"}])
+
+    assert standalone == RephrasedQuestion(
+        content="Do you have any gluten free desserts?", decision="skipped: follow-up is already standalone"
+    )
+    assert follow_up == RephrasedQuestion(
+        content="content", decision="rephrased", history="kept 2 of 2 messages, 10 tokens (saved 5)"
+    )
+
+
+def _speculative_rag(rag_mock, embeddings: dict[str, list[float]]):
+    rag_mock._speculative_retrieval = True
+    rag_mock._embedding.aembed_query = AsyncMock(side_effect=lambda text: embeddings[text])
+    rephrased_document = Document(page_content='{"name": "rephrased"}', metadata={"source": "rephrased"})
+    raw_document = Document(page_content='{"name": "raw"}', metadata={"source": "raw"})
+    rag_mock._vector_store._similarity_search_with_score = MagicMock(
+        side_effect=lambda embedding, **kwargs: [
+            (raw_document if embedding == embeddings["is it spicy?"] else rephrased_document, 0.9)
+        ]
     )
+    return raw_document, rephrased_document
+
+
+@pytest.mark.asyncio
+async def test_rag_speculative_retrieval_hit(rag_mock):
+    """Test that speculative results are reused when the rephrased question embeds close to the raw one."""
+    raw_document, _ = _speculative_rag(rag_mock, {"is it spicy?": [1.0, 0.0], "content": [0.99, 0.05]})
+    messages = [{"content": "vegan dishes"}, {"content": "We have tofu."}, {"content": "is it spicy?"}]
+
+    vector_context, rephrased_question = await rag_mock._retrieve(messages, 3, 0.5)
+
+    assert vector_context == [raw_document]
+    assert rephrased_question.speculation.startswith("hit (similarity 0.999")
+    assert rag_mock._vector_store._similarity_search_with_score.call_count == 1
+    assert rag_mock._vector_store._similarity_search_with_score.call_args == call([1.0, 0.0], k=3, score_threshold=0.5)
+    assert rag_mock.speculation_stats()["hits"] == 1
+    assert rag_mock.speculation_stats()["hit_rate"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_rag_speculative_retrieval_miss(rag_mock):
+    """Test that speculative results are discarded when the rephrased question drifts from the raw one."""
+    _, rephrased_document = _speculative_rag(rag_mock, {"is it spicy?": [1.0, 0.0], "content": [0.0, 1.0]})
+    messages = [{"content": "vegan dishes"}, {"content": "We have tofu."}, {"content": "is it spicy?"}]
+
+    vector_context, rephrased_question = await rag_mock._retrieve(messages, 3, 0.5)
+
+    assert vector_context == [rephrased_document]
+    assert rephrased_question.speculation.startswith("miss (similarity 0.000")
+    assert rag_mock._vector_store._similarity_search_with_score.call_count == 2
+    assert rag_mock.speculation_stats() == {
+        "attempts": 1,
+        "hits": 0,
+        "misses": 1,
+        "hit_rate": 0.0,
+        "saved_ms_total": rag_mock.speculation_stats()["saved_ms_total"],
+        "saved_ms_avg": rag_mock.speculation_stats()["saved_ms_avg"],
+    }
+    assert rag_mock.speculation_stats()["saved_ms_total"] <= 0
+
+
+@pytest.mark.asyncio
+async def test_rag_speculative_retrieval_without_rephrase(rag_mock):
+    """Test that a skipped rephrase uses the speculative search without counting it as a speculation."""
+    raw_document, _ = _speculative_rag(rag_mock, {"is it spicy?": [1.0, 0.0]})
+
+    answer = json.loads((await rag_mock.run([{"content": "is it spicy?"}], 0.0, 3, 0.5))[1])
+
+    assert "speculation" not in answer
+    assert rag_mock._embedding.aembed_query.await_count == 1
+    assert rag_mock.speculation_stats()["attempts"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rag_speculative_search_cancelled_with_rephrase(rag_mock):
+    """Test that the speculative search does not outlive a failed rephrase."""
+    rag_mock._speculative_retrieval = True
+    cancelled = asyncio.Event()
+
+    async def slow_embed(text):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def failing_rephrase(messages):
+        await asyncio.sleep(0)
+        raise RuntimeError("rephrase failed")
+
+    rag_mock._embedding.aembed_query = slow_embed
+    rag_mock._rephrase = failing_rephrase
+
+    with pytest.raises(RuntimeError, match="rephrase failed"):
+        await rag_mock._retrieve([{"content": "is it spicy?"}], 3, 0.5)
+
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_rag_answer_cache(rag_mock, mock_runnable_or):
+    """Test that a repeated RAG question is answered from the answer cache."""
+    rag_mock._answer_cache = AnswerCache()
+    rag_mock._embedding.aembed_query = AsyncMock(return_value=[1.0, 0.0])
+
+    first = json.loads((await rag_mock.run([{"content": "vegan options"}], 0.3, 3, 0.0))[1])
+    documents, second = await rag_mock.run([{"content": "Vegan options"}], 0.3, 3, 0.0)
+
+    assert first["answer_cache"] == "miss"
+    assert json.loads(second)["answer_cache"].startswith("hit")
+    assert json.loads(second)["response"] == "content"
+    assert documents == [Document(page_content=documents[0].page_content, metadata={"source": "test"})]
+    assert mock_runnable_or.return_value.ainvoke.await_count == 1
+    assert rag_mock.answer_cache_stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_rag_stream_answer_cache(rag_mock, mock_runnable_or):
+    """Test that a fully streamed RAG answer is replayed from the answer cache."""
+    rag_mock._answer_cache = AnswerCache()
+    rag_mock._embedding.aembed_query = AsyncMock(return_value=[1.0, 0.0])
+
+    async def stream():
+        yield AIMessageChunk(content="We have ")
+        yield AIMessageChunk(content="tofu.")
+
+    mock_runnable_or.return_value.astream = MagicMock(return_value=stream())
+
+    _, first_stream, first_question = await rag_mock.run_stream([{"content": "tofu"}], 0.3, 3, 0.0)
+    first_chunks = [chunk.content async for chunk in first_stream]
+    _, second_stream, second_question = await rag_mock.run_stream([{"content": "tofu"}], 0.3, 3, 0.0)
+    second_chunks = [chunk.content async for chunk in second_stream]
+
+    assert first_chunks == ["We have ", "tofu."]
+    assert first_question.answer_cache == "miss"
+    assert second_chunks == ["We have tofu."]
+    assert second_question.answer_cache.startswith("hit")
+    assert mock_runnable_or.return_value.astream.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_rag_stream_reports_stages(rag_mock, mock_runnable_or):
+    """Test that run_stream reports the rephrase and retrieval stages as they happen."""
+    rag_mock._similarity_search = AsyncMock(
+        return_value=[Document(page_content='{"name": "tofu"}', metadata={"source": "test"})]
+    )
+    stages = []
+    messages = [{"content": "hi", "role": "user"}, {"content": "anything with it?", "role": "user"}]
+
+    await rag_mock.run_stream(messages, 0.3, 3, 0.0, on_stage=lambda *stage: stages.append(stage))
+
+    assert stages == [
+        (StreamStage.REPHRASING, None),
+        (StreamStage.REPHRASED, "content"),
+        (StreamStage.RETRIEVED, "1 documents"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_track_generation():
+    """Test that streamed answers are counted and cancelled ones estimate the tokens they avoided."""
+    closed = []
+
+    async def stream(chunks):
+        try:
+            for chunk in chunks:
+                yield AIMessageChunk(content=chunk)
+        finally:
+            closed.append(len(chunks))
+
+    stats = GenerationStats()
+    assert [chunk.content async for chunk in track_generation(stats, stream(["a", "b", "c", "d"]))] == list("abcd")
+
+    cancelled = track_generation(stats, stream(["a", "b", "c", "d"]))
+    await anext(cancelled)
+    await close_stream(cancelled)
+
+    assert closed == [4, 4]
+    assert stats.snapshot() == {
+        "completed": 1,
+        "cancelled": 1,
+        "streamed_tokens_completed": 4,
+        "streamed_tokens_cancelled": 1,
+        "tokens_avoided_estimate": 3,
+    }
+
+
+def test_is_standalone_question():
+    """Test the standalone question heuristic."""
+    assert is_standalone_question("Which smoothies cost less than six dollars?")
+    assert not is_standalone_question("Is it vegan?")
+    assert not is_standalone_question("Show me more")
+    assert not is_standalone_question("Do you have anything cheaper than those?")
 
 
 @pytest.mark.asyncio
@@ -104,6 +596,10 @@ async def test_app_setup(setup_mock):
     assert setup_mock.vector_search
     assert setup_mock.rag
     assert setup_mock.keyword
+    assert isinstance(setup_mock._openai_setup._embeddings_api, CachedEmbeddings)
+    assert setup_mock.embedding_cache_stats()["hits"] == 0
+    assert isinstance(setup_mock._openai_setup._embeddings_api.embeddings, BatchingEmbeddings)
+    assert setup_mock.embedding_batcher_stats()["batches"] == 0
 
 
 @pytest.mark.asyncio
@@ -221,9 +717,13 @@ async def test_app_config_run_rag(app_config_mock):
                     title="Cosmos RAG Query",
                     description="test",
                 ),
+                Thought(
+                    title="Cosmos RAG Rephrase Policy",
+                    description="skipped: no chat history",
+                ),
                 Thought(
                     title="Cosmos RAG OpenAI Rephrased Query",
-                    description="content",
+                    description="test",
                 ),
                 Thought(
                     title="Cosmos RAG Search Vector Search Result",
@@ -243,6 +743,51 @@ async def test_app_config_run_rag(app_config_mock):
     )
 
 
+@pytest.mark.asyncio
+async def test_app_config_run_rag_reports_speculation(app_config_mock):
+    """Test the AppConfig class run_rag method reports the speculative retrieval outcome."""
+    app_config_mock.setup.rag.run = AsyncMock(
+        return_value=(
+            [Document(page_content='{"name": "test"}', metadata={"source": "test"})],
+            '{"response": "content", "rephrased_response": "test", "rephrase_decision": "rephrased", '
+            '"speculation": "hit (similarity 0.990, saved 120 ms)"}',
+        )
+    )
+
+    result = await app_config_mock.run_rag("test", [{"content": "test"}], 0.3, 1, 0.0)
+
+    assert result.context.thoughts[3] == Thought(
+        title="Cosmos RAG Speculative Retrieval", description="hit (similarity 0.990, saved 120 ms)"
+    )
+
+
+@pytest.mark.asyncio
+async def test_app_config_run_hybrid(app_config_mock):
+    """Test the AppConfig class run_hybrid method."""
+    result = await app_config_mock.run_hybrid("test", [{"content": "test"}], 0.3, 1, 0.0)
+
+    assert [thought.title for thought in result.context.thoughts] == [
+        "Cosmos Hybrid Search Query",
+        "Cosmos Hybrid Search Result",
+        "Cosmos Hybrid Search Top Result",
+        "Source",
+    ]
+    assert result.context.data_points == [
+        DataPoint(name="test", description="test", price="5.0USD", category="test", collection="collection_name")
+    ]
+    assert result.sessionState == "test"
+
+
+@pytest.mark.asyncio
+async def test_app_config_run_hybrid_no_results(app_config_mock):
+    """Test the AppConfig class run_hybrid method without results."""
+    app_config_mock.setup.hybrid.search = AsyncMock(return_value=[])
+
+    result = await app_config_mock.run_hybrid("test", [{"content": "test"}], 0.3, 1, 0.0)
+
+    assert result.message == Message(content="No results found", role=AIChatRoles.ASSISTANT)
+
+
 @pytest.mark.asyncio
 async def test_app_config_run_keyword_no_message(app_config_mock):
     """Test the AppConfig class run_keyword method without messages."""
@@ -324,12 +869,73 @@ async def test_add_to_cosmos_with_id_and_without_messages(app_config_mock):
     assert is_added is False
 
 
+@pytest.mark.asyncio
+async def test_add_to_cosmos_writes_one_upsert_per_message(app_config_mock):
+    """Test that a new session stores the conversation and a follow-up appends its question and answer."""
+    users_collection = app_config_mock.setup._database_setup._users_collection
+    await app_config_mock.add_to_cosmos(
+        old_messages=[{"content": "vegan?"}], new_message={"content": "tofu"}, session_state=None, new_session_state="s"
+    )
+    await app_config_mock.add_to_cosmos(
+        old_messages=[{"content": "vegan?"}, {"content": "tofu"}, {"content": "spicy?"}],
+        new_message={"content": "no"},
+        session_state="s",
+        new_session_state="s",
+    )
+
+    document = await users_collection.find_one({"_id": "s"})
+    assert [message["content"] for message in document["messages"]] == ["vegan?", "tofu", "spicy?", "no"]
+    assert document["created_at"] <= document["updated_at"]
+    assert app_config_mock.setup.history_writer.stats()["inline_writes"] == 2
+
+
+@pytest.mark.asyncio
+async def test_with_server_history(app_config_mock):
+    """Test that stored turns are prepended to the newest message of a known session."""
+    await app_config_mock.add_to_cosmos(
+        old_messages=[{"content": "vegan?"}], new_message={"content": "tofu"}, session_state=None, new_session_state="s"
+    )
+
+    assert await app_config_mock.with_server_history("s", [{"content": "spicy?"}]) == [
+        {"content": "vegan?"},
+        {"content": "tofu"},
+        {"content": "spicy?"},
+    ]
+    assert await app_config_mock.with_server_history(None, [{"content": "hi"}]) == [{"content": "hi"}]
+
+
+@pytest.mark.asyncio
+async def test_no_results_turn_is_kept_in_server_history(app_config_mock):
+    """Test that a turn answered with no results is stored, so server_history clients keep the whole conversation."""
+    app_config_mock.setup.keyword.run = AsyncMock(return_value=([], ""))
+    app_config_mock.setup.rag.run = AsyncMock(return_value=([], '{"response": "Try the menu"}'))
+
+    first = await app_config_mock.run_keyword(None, [{"content": "pizza?"}], 0.3, 1, 0.0)
+    await app_config_mock.run_rag(first.sessionState, [{"content": "pasta?"}], 0.3, 1, 0.0)
+
+    history = await app_config_mock.with_server_history(first.sessionState, [])
+    assert [message["content"] for message in history] == ["pizza?", "No results found", "pasta?", "Try the menu"]
+
+
+@pytest.mark.asyncio
+async def test_no_results_stream_turn_is_kept_in_server_history(app_config_mock):
+    """Test that a streamed turn answered with no results is stored as well."""
+    app_config_mock.setup.rag.run_stream = AsyncMock(
+        side_effect=OperationFailure(MISSING_SIMILARITY_INDEX_ERROR, code=2)
+    )
+
+    [_ async for _ in app_config_mock.run_rag_stream("s", [{"content": "pizza?"}], 0.3, 1, 0.0)]
+
+    history = await app_config_mock.with_server_history("s", [])
+    assert [message["content"] for message in history] == ["pizza?", "No results found"]
+
+
 # RAG additional tests
 @pytest.mark.asyncio
 async def test_rag_run_no_data_points(rag_mock):
     """Test RAG run method when no data points are found."""
     # Mock the retriever to return no documents
-    rag_mock._vector_store.as_retriever.return_value.ainvoke = AsyncMock(return_value=[])
+    rag_mock._vector_store._similarity_search_with_score = MagicMock(return_value=[])
 
     # Mock the chat response
     mock_response = MagicMock()
@@ -354,7 +960,7 @@ async def test_rag_run_no_data_points(rag_mock):
 async def test_rag_temperature_setting(rag_mock):
     """Test that RAG properly sets temperature values."""
     # Mock the retriever and responses
-    rag_mock._vector_store.as_retriever.return_value.ainvoke = AsyncMock(return_value=[])
+    rag_mock._vector_store._similarity_search_with_score = MagicMock(return_value=[])
 
     mock_rephrase_response = MagicMock()
     mock_rephrase_response.content = "test"
@@ -370,8 +976,47 @@ async def test_rag_temperature_setting(rag_mock):
         mock_template.from_template.return_value = MagicMock()
         mock_template.from_template.return_value.__or__ = MagicMock(return_value=mock_chain)
 
-        # Test with specific temperature
-        await rag_mock.run([{"content": "test"}], 0.8, 1, 0.0)
+        # Test with specific temperature on a follow-up question
+        await rag_mock.run([{"content": "vegan"}, {"content": "tofu"}, {"content": "test"}], 0.8, 1, 0.0)
+
+        # Should bind temperature 0.3 for rephrase, then the specified temperature, without touching the client
+        assert rag_mock._chat.bind.call_args_list == [call(temperature=0.3), call(temperature=0.8)]
+        assert not isinstance(rag_mock._chat.temperature, float)
+
+
+class TemperatureEchoChat(BaseChatModel):
+    """Chat model that answers with the temperature in effect once a random network delay has passed."""
+
+    temperature: float = 0.7
 
-        # Should set temperature to 0.3 for rephrase, then to specified temperature
-        assert rag_mock._chat.temperature == 0.8
+    @property
+    def _llm_type(self) -> str:
+        return "temperature-echo"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(random.random() / 100)
+        message = AIMessage(content=f"temperature={kwargs.get('temperature', self.temperature)}")
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+@pytest.mark.asyncio
+async def test_rag_concurrent_requests_keep_their_temperature(monkeypatch, rag_mock):
+    """Test that concurrent RAG requests sharing one chat client never see each other's temperature."""
+    monkeypatch.setattr(Runnable, "__or__", RUNNABLE_OR)
+    rag_mock._chat = TemperatureEchoChat()
+    temperatures = [round(step / 10, 1) for step in range(11)] * 3
+
+    messages = [{"content": "vegan"}, {"content": "tofu"}, {"content": "test"}]
+
+    results = await asyncio.gather(*(rag_mock.run(messages, temperature, 1, 0.0) for temperature in temperatures))
+
+    for temperature, (_, answer) in zip(temperatures, results):
+        assert json.loads(answer) == {
+            "response": f"temperature={temperature}",
+            "rephrased_response": "temperature=0.3",
+            "rephrase_decision": "rephrased",
+            "rephrase_history": "kept 2 of 2 messages, 6 tokens (saved 5)",
+        }
@@ -0,0 +1,51 @@
+"""Tests for quartapp.approaches.async_collection module."""
+
+import asyncio
+import threading
+
+import mongomock
+import pytest
+
+from quartapp.approaches.async_collection import AsyncCollection
+
+
+@pytest.fixture
+def async_collection():
+    return AsyncCollection(mongomock.MongoClient().db.collection)
+
+
+@pytest.mark.asyncio
+async def test_insert_and_find(async_collection):
+    """Test that documents written through the adapter can be read back."""
+    await async_collection.insert_one({"_id": "a", "textContent": "vegan smoothie"})
+    await async_collection.insert_one({"_id": "b", "textContent": "cheese burger"})
+
+    assert await async_collection.find({}, limit=1) == [{"_id": "a", "textContent": "vegan smoothie"}]
+    assert len(await async_collection.find({})) == 2
+    assert await async_collection.find_one({"_id": "b"}, {"_id": 1}) == {"_id": "b"}
+
+
+@pytest.mark.asyncio
+async def test_update_one_upsert(async_collection):
+    """Test update_one forwards the upsert flag."""
+    await async_collection.update_one({"_id": "s"}, {"$set": {"messages": []}}, upsert=True)
+    await async_collection.update_one({"_id": "s"}, {"$push": {"messages": "hi"}})
+
+    assert await async_collection.find_one({"_id": "s"}) == {"_id": "s", "messages": ["hi"]}
+
+
+@pytest.mark.asyncio
+async def test_round_trips_run_off_the_event_loop():
+    """Test that the blocking driver call never runs on the event loop thread."""
+    loop_thread = threading.get_ident()
+    seen_threads = []
+
+    class RecordingCollection:
+        def find_one(self, filter, projection):
+            seen_threads.append(threading.get_ident())
+            return None
+
+    await asyncio.gather(*(AsyncCollection(RecordingCollection()).find_one({}) for _ in range(3)))  # type: ignore[arg-type]
+
+    assert len(seen_threads) == 3
+    assert loop_thread not in seen_threads
@@ -7,6 +7,7 @@ from unittest.mock import MagicMock, patch
 import pytest
 from pydantic import SecretStr
 
+from quartapp.approaches.schemas import LocalIndexMode, RephrasePolicy
 from quartapp.config import AppConfig
 
 # Common database env vars needed by all providers
@@ -254,3 +255,357 @@ def test_embedding_dimensions_invalid():
     with mock.patch.dict(os.environ, env, clear=True):
         with pytest.raises(ValueError, match="Invalid AZURE_OPENAI_EMBED_DIMENSIONS"):
             AppConfig()
+
+
+def test_mongo_pool_env_routing(_patch_setup):
+    """Test that the shared connection pool settings are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "AZURE_COSMOS_MAX_POOL_SIZE": "25",
+            "AZURE_COSMOS_MAX_IDLE_TIME_MS": "60000",
+            "AZURE_COSMOS_SERVER_SELECTION_TIMEOUT_MS": "5000",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["mongo_max_pool_size"] == 25
+    assert kwargs["mongo_max_idle_time_ms"] == 60000
+    assert kwargs["mongo_server_selection_timeout_ms"] == 5000
+
+
+def test_mongo_pool_env_defaults(_patch_setup):
+    """Test the shared connection pool defaults when the env vars are unset."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["mongo_max_pool_size"] == 100
+    assert kwargs["mongo_max_idle_time_ms"] is None
+    assert kwargs["mongo_server_selection_timeout_ms"] == 1000
+
+
+def test_rephrase_policy_env_routing(_patch_setup):
+    """Test that the RAG rephrase policy is read from the environment."""
+    with mock.patch.dict(
+        os.environ, _make_env({"AZURE_OPENAI_KEY": "key", "RAG_REPHRASE_POLICY": "heuristic"}), clear=True
+    ):
+        AppConfig()
+
+    assert _patch_setup.call_args.kwargs["rephrase_policy"] == RephrasePolicy.HEURISTIC
+
+
+def test_unsupported_rephrase_policy():
+    """Test that an unsupported RAG_REPHRASE_POLICY raises ValueError."""
+    with mock.patch.dict(
+        os.environ, _make_env({"AZURE_OPENAI_KEY": "key", "RAG_REPHRASE_POLICY": "never"}), clear=True
+    ):
+        with pytest.raises(ValueError, match="Unsupported RAG_REPHRASE_POLICY 'never'"):
+            AppConfig()
+
+
+def test_speculative_retrieval_env_routing(_patch_setup):
+    """Test that speculative retrieval settings are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "RAG_SPECULATIVE_RETRIEVAL": "true",
+            "RAG_SPECULATIVE_SIMILARITY_THRESHOLD": "0.9",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["rag_speculative_retrieval"] is True
+    assert kwargs["rag_speculative_similarity_threshold"] == 0.9
+
+
+def test_speculative_retrieval_env_defaults(_patch_setup):
+    """Test that speculative retrieval is off by default."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["rag_speculative_retrieval"] is False
+    assert kwargs["rag_speculative_similarity_threshold"] == 0.95
+
+
+def test_invalid_speculative_retrieval_flag():
+    """Test that a non-boolean RAG_SPECULATIVE_RETRIEVAL raises ValueError."""
+    with mock.patch.dict(
+        os.environ, _make_env({"AZURE_OPENAI_KEY": "key", "RAG_SPECULATIVE_RETRIEVAL": "sometimes"}), clear=True
+    ):
+        with pytest.raises(ValueError, match="Invalid RAG_SPECULATIVE_RETRIEVAL value"):
+            AppConfig()
+
+
+def test_embedding_cache_env_routing(_patch_setup):
+    """Test that embedding cache settings are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "EMBEDDING_CACHE_SIZE": "0",
+            "EMBEDDING_CACHE_TTL_SECONDS": "3600",
+            "EMBEDDING_CACHE_PATH": "/tmp/embeddings.sqlite",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["embedding_cache_size"] == 0
+    assert kwargs["embedding_cache_ttl_seconds"] == 3600.0
+    assert kwargs["embedding_cache_path"] == "/tmp/embeddings.sqlite"
+
+
+def test_embedding_cache_env_defaults(_patch_setup):
+    """Test the embedding cache defaults to an in-memory LRU without TTL."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["embedding_cache_size"] == 1024
+    assert kwargs["embedding_cache_ttl_seconds"] is None
+    assert kwargs["embedding_cache_path"] is None
+
+
+def test_answer_cache_env_routing(_patch_setup):
+    """Test that answer cache settings are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "ANSWER_CACHE_SIZE": "128",
+            "ANSWER_CACHE_TTL_SECONDS": "600",
+            "ANSWER_CACHE_MAX_DISTANCE": "0.1",
+            "ANSWER_CACHE_VERSION_POLL_SECONDS": "5",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["answer_cache_size"] == 128
+    assert kwargs["answer_cache_ttl_seconds"] == 600.0
+    assert kwargs["answer_cache_max_distance"] == 0.1
+    assert kwargs["answer_cache_version_poll_seconds"] == 5.0
+
+
+def test_answer_cache_env_defaults(_patch_setup):
+    """Test that the answer cache is disabled by default."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["answer_cache_size"] == 0
+    assert kwargs["answer_cache_ttl_seconds"] == 3600
+    assert kwargs["answer_cache_max_distance"] == 0.05
+    assert kwargs["answer_cache_version_poll_seconds"] == 30
+
+
+def test_local_vector_index_env_routing(_patch_setup):
+    """Test that local vector index settings are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "LOCAL_VECTOR_INDEX": "primary",
+            "LOCAL_VECTOR_INDEX_REFRESH_SECONDS": "60",
+            "LOCAL_VECTOR_INDEX_MAX_DOCUMENTS": "5000",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["local_index_mode"] == LocalIndexMode.PRIMARY
+    assert kwargs["local_index_refresh_seconds"] == 60.0
+    assert kwargs["local_index_max_documents"] == 5000
+
+
+def test_local_vector_index_env_defaults(_patch_setup):
+    """Test that the local vector index is off by default."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["local_index_mode"] == LocalIndexMode.OFF
+    assert kwargs["local_index_refresh_seconds"] == 300
+    assert kwargs["local_index_max_documents"] == 100_000
+
+
+def test_unsupported_local_vector_index():
+    """Test that an unsupported LOCAL_VECTOR_INDEX raises ValueError."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key", "LOCAL_VECTOR_INDEX": "gpu"}), clear=True):
+        with pytest.raises(ValueError, match="Unsupported LOCAL_VECTOR_INDEX 'gpu'"):
+            AppConfig()
+
+
+def test_hybrid_env_routing(_patch_setup):
+    """Test that hybrid retrieval settings are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "HYBRID_KEYWORD_WEIGHT": "0.5",
+            "HYBRID_VECTOR_WEIGHT": "2",
+            "HYBRID_RRF_K": "10",
+            "RAG_HYBRID_CONTEXT": "true",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["hybrid_keyword_weight"] == 0.5
+    assert kwargs["hybrid_vector_weight"] == 2.0
+    assert kwargs["hybrid_rrf_k"] == 10
+    assert kwargs["rag_hybrid_context"] is True
+
+
+def test_hybrid_env_defaults(_patch_setup):
+    """Test the hybrid retrieval defaults."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["hybrid_keyword_weight"] == 1.0
+    assert kwargs["hybrid_vector_weight"] == 1.0
+    assert kwargs["hybrid_rrf_k"] == 60
+    assert kwargs["rag_hybrid_context"] is False
+
+
+def test_history_writer_env_routing(_patch_setup):
+    """Test that the chat history write-behind settings are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "HISTORY_WRITE_BEHIND": "false",
+            "HISTORY_QUEUE_SIZE": "10",
+            "HISTORY_BATCH_SIZE": "5",
+            "HISTORY_FLUSH_SECONDS": "0.2",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["history_write_behind"] is False
+    assert kwargs["history_queue_size"] == 10
+    assert kwargs["history_batch_size"] == 5
+    assert kwargs["history_flush_seconds"] == 0.2
+
+
+def test_history_writer_env_defaults(_patch_setup):
+    """Test that chat history is written behind the response by default."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["history_write_behind"] is True
+    assert kwargs["history_queue_size"] == 1000
+    assert kwargs["history_batch_size"] == 100
+    assert kwargs["history_flush_seconds"] == 0.05
+
+
+def test_session_history_env_routing(_patch_setup):
+    """Test that the server-side session history settings are read from the environment."""
+    env = _make_env({"AZURE_OPENAI_KEY": "key", "SESSION_CACHE_SIZE": "8", "SESSION_HISTORY_MAX_MESSAGES": "6"})
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["session_cache_size"] == 8
+    assert kwargs["session_history_max_messages"] == 6
+
+
+def test_rag_history_env_routing(_patch_setup):
+    """Test that the rephrase history budget and summary switch are read from the environment."""
+    env = _make_env({"AZURE_OPENAI_KEY": "key", "RAG_HISTORY_MAX_TOKENS": "300", "RAG_HISTORY_SUMMARY": "true"})
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["rag_history_max_tokens"] == 300
+    assert kwargs["rag_history_summary"] is True
+
+
+def test_stream_persist_partial_answers_env_routing(_patch_setup):
+    """Test that partial streamed answers are saved unless turned off in the environment."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+    assert _patch_setup.call_args.kwargs["stream_persist_partial_answers"] is True
+
+    env = _make_env({"AZURE_OPENAI_KEY": "key", "STREAM_PERSIST_PARTIAL_ANSWERS": "false"})
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+    assert _patch_setup.call_args.kwargs["stream_persist_partial_answers"] is False
+
+
+def test_stream_coalesce_env_routing(_patch_setup):
+    """Test that the NDJSON token coalescing thresholds are read from the environment."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+    assert _patch_setup.call_args.kwargs["stream_coalesce_ms"] == 30
+    assert _patch_setup.call_args.kwargs["stream_coalesce_chars"] == 64
+
+    env = _make_env({"AZURE_OPENAI_KEY": "key", "STREAM_COALESCE_MS": "0", "STREAM_COALESCE_CHARS": "0"})
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+    assert _patch_setup.call_args.kwargs["stream_coalesce_ms"] == 0
+    assert _patch_setup.call_args.kwargs["stream_coalesce_chars"] == 0
+
+
+def test_sse_replay_env_routing(_patch_setup):
+    """Test that the SSE replay buffer limits are read from the environment."""
+    env = _make_env(
+        {
+            "AZURE_OPENAI_KEY": "key",
+            "SSE_REPLAY_MAX_STREAMS": "16",
+            "SSE_REPLAY_MAX_EVENTS": "64",
+            "SSE_REPLAY_TTL_SECONDS": "30",
+        }
+    )
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    kwargs = _patch_setup.call_args.kwargs
+    assert kwargs["sse_replay_max_streams"] == 16
+    assert kwargs["sse_replay_max_events"] == 64
+    assert kwargs["sse_replay_ttl_seconds"] == 30
+
+
+def test_single_flight_env_routing(_patch_setup):
+    """Test that request coalescing is on unless turned off in the environment."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        assert AppConfig().single_flight is not None
+
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key", "SINGLE_FLIGHT": "false"}), clear=True):
+        assert AppConfig().single_flight is None
+
+
+def test_embedding_batch_env_routing(_patch_setup):
+    """Test that query embedding batching is on by default and configurable from the environment."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+
+    assert _patch_setup.call_args.kwargs["embedding_batch_window_ms"] == 5
+    assert _patch_setup.call_args.kwargs["embedding_batch_size"] == 16
+
+    env = _make_env({"AZURE_OPENAI_KEY": "key", "EMBEDDING_BATCH_WINDOW_MS": "2.5", "EMBEDDING_BATCH_SIZE": "1"})
+    with mock.patch.dict(os.environ, env, clear=True):
+        AppConfig()
+
+    assert _patch_setup.call_args.kwargs["embedding_batch_window_ms"] == 2.5
+    assert _patch_setup.call_args.kwargs["embedding_batch_size"] == 1
+
+
+def test_vector_ef_search_env_routing(_patch_setup):
+    """Test that the efSearch of HNSW queries is read from the environment."""
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key"}), clear=True):
+        AppConfig()
+    assert _patch_setup.call_args.kwargs["vector_ef_search"] == 40
+
+    with mock.patch.dict(os.environ, _make_env({"AZURE_OPENAI_KEY": "key", "VECTOR_EF_SEARCH": "100"}), clear=True):
+        AppConfig()
+    assert _patch_setup.call_args.kwargs["vector_ef_search"] == 100
@@ -0,0 +1,86 @@
+"""Tests for quartapp.approaches.embedding_batcher module."""
+
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from quartapp.approaches.embedding_batcher import BatchingEmbeddings
+
+
+@pytest.fixture
+def embeddings_mock():
+    embeddings = MagicMock()
+    embeddings.embed_query = MagicMock(side_effect=lambda text: [float(len(text)), 0.5])
+    embeddings.aembed_documents = AsyncMock(side_effect=lambda texts: [[float(len(text)), 0.5] for text in texts])
+    return embeddings
+
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_share_one_call(embeddings_mock):
+    """Test that queries arriving within the window are embedded with a single call."""
+    batcher = BatchingEmbeddings(embeddings_mock, max_batch_size=8, window_ms=10)
+
+    vectors = await asyncio.gather(
+        batcher.aembed_query("vegan"), batcher.aembed_query("spicy food"), batcher.aembed_query("vegan")
+    )
+
+    assert vectors == [[5.0, 0.5], [10.0, 0.5], [5.0, 0.5]]
+    embeddings_mock.aembed_documents.assert_awaited_once_with(["vegan", "spicy food"])
+    assert batcher.stats() == {
+        "batches": 1,
+        "queries": 3,
+        "avg_batch_size": 3.0,
+        "avg_batch_fill": 0.375,
+        "full_batches": 0,
+        "failed_batches": 0,
+        "max_batch_size": 8,
+    }
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_sent_without_waiting(embeddings_mock):
+    """Test that a batch is sent as soon as it is full, and the rest go in the next one."""
+    batcher = BatchingEmbeddings(embeddings_mock, max_batch_size=2, window_ms=60_000)
+
+    first = asyncio.gather(batcher.aembed_query("a"), batcher.aembed_query("bb"))
+    third = asyncio.ensure_future(batcher.aembed_query("ccc"))
+
+    assert await asyncio.wait_for(first, timeout=1) == [[1.0, 0.5], [2.0, 0.5]]
+    assert not third.done()
+    third.cancel()
+    assert batcher.stats()["full_batches"] == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_error_reaches_every_caller(embeddings_mock):
+    """Test that a failed batch raises its error in each waiting caller."""
+    embeddings_mock.aembed_documents.side_effect = RuntimeError("rate limited")
+    batcher = BatchingEmbeddings(embeddings_mock, max_batch_size=8, window_ms=1)
+
+    results = await asyncio.gather(batcher.aembed_query("a"), batcher.aembed_query("b"), return_exceptions=True)
+
+    assert [str(result) for result in results] == ["rate limited", "rate limited"]
+    assert batcher.stats()["failed_batches"] == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_affect_batch(embeddings_mock):
+    """Test that cancelling one caller still answers the others in its batch."""
+    batcher = BatchingEmbeddings(embeddings_mock, max_batch_size=8, window_ms=5)
+
+    cancelled = asyncio.ensure_future(batcher.aembed_query("a"))
+    other = asyncio.ensure_future(batcher.aembed_query("bb"))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+
+    assert await other == [2.0, 0.5]
+    assert cancelled.cancelled()
+
+
+def test_sync_calls_pass_through(embeddings_mock):
+    """Test that synchronous query embeddings are not batched."""
+    batcher = BatchingEmbeddings(embeddings_mock)
+
+    assert batcher.embed_query("abc") == [3.0, 0.5]
+    assert batcher.stats()["batches"] == 0
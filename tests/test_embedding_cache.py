@@ -0,0 +1,122 @@
+"""Tests for quartapp.approaches.embedding_cache module."""
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from quartapp.approaches.embedding_cache import CachedEmbeddings, normalize_query
+
+
+@pytest.fixture
+def embeddings_mock():
+    embeddings = MagicMock()
+    embeddings.embed_query = MagicMock(side_effect=lambda text: [float(len(text)), 0.5])
+    embeddings.aembed_query = AsyncMock(side_effect=lambda text: [float(len(text)), 0.5])
+    return embeddings
+
+
+def test_normalize_query():
+    """Test that case and whitespace differences normalize to the same query."""
+    assert normalize_query("  Vegan\tOPTIONS \n") == "vegan options"
+
+
+def test_embed_query_hits_and_misses(embeddings_mock):
+    """Test that repeated (normalized) queries are served from the cache."""
+    cache = CachedEmbeddings(embeddings_mock, model="text-embedding-3-small")
+
+    first = cache.embed_query("vegan options")
+    second = cache.embed_query("Vegan  options")
+
+    assert first == second == [13.0, 0.5]
+    assert embeddings_mock.embed_query.call_count == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5, "size": 1, "max_size": 1024}
+
+
+def test_key_includes_model_and_dimensions(embeddings_mock):
+    """Test that the model and dimensions are part of the cache key."""
+    small = CachedEmbeddings(embeddings_mock, model="text-embedding-3-small", dimensions=256)
+    large = CachedEmbeddings(embeddings_mock, model="text-embedding-3-large", dimensions=256)
+    small_full = CachedEmbeddings(embeddings_mock, model="text-embedding-3-small")
+
+    assert len({small._key("vegan"), large._key("vegan"), small_full._key("vegan")}) == 3
+
+
+def test_lru_eviction(embeddings_mock):
+    """Test that the least recently used entry is evicted first."""
+    cache = CachedEmbeddings(embeddings_mock, model="model", max_size=2)
+
+    cache.embed_query("a")
+    cache.embed_query("bb")
+    cache.embed_query("a")
+    cache.embed_query("ccc")
+    cache.embed_query("a")
+    cache.embed_query("bb")
+
+    assert [call.args[0] for call in embeddings_mock.embed_query.call_args_list] == ["a", "bb", "ccc", "bb"]
+    assert cache.stats()["size"] == 2
+
+
+def test_ttl_expiry(embeddings_mock):
+    """Test that entries older than the TTL are embedded again."""
+    cache = CachedEmbeddings(embeddings_mock, model="model", ttl_seconds=60)
+
+    with patch("quartapp.approaches.embedding_cache.time.time", return_value=1000.0):
+        cache.embed_query("smoothies")
+    with patch("quartapp.approaches.embedding_cache.time.time", return_value=1059.0):
+        cache.embed_query("smoothies")
+    with patch("quartapp.approaches.embedding_cache.time.time", return_value=1061.0):
+        cache.embed_query("smoothies")
+
+    assert embeddings_mock.embed_query.call_count == 2
+    assert cache.hits == 1
+
+
+def test_persists_to_disk(embeddings_mock, tmp_path):
+    """Test that vectors written to the on-disk store are reused by a new cache."""
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = CachedEmbeddings(embeddings_mock, model="model", path=path)
+    vector = cache.embed_query("smoothies under $6")
+    cache.close()
+
+    restarted = CachedEmbeddings(embeddings_mock, model="model", path=path)
+
+    assert restarted.embed_query("smoothies under $6") == vector
+    assert embeddings_mock.embed_query.call_count == 1
+    assert restarted.hits == 1
+    restarted.close()
+
+
+def test_disk_entries_expire(embeddings_mock, tmp_path):
+    """Test that expired on-disk entries are dropped when the cache is opened."""
+    path = str(tmp_path / "embeddings.sqlite")
+    with patch("quartapp.approaches.embedding_cache.time.time", return_value=1000.0):
+        CachedEmbeddings(embeddings_mock, model="model", path=path).embed_query("smoothies")
+
+    with patch("quartapp.approaches.embedding_cache.time.time", return_value=2000.0):
+        restarted = CachedEmbeddings(embeddings_mock, model="model", ttl_seconds=60, path=path)
+        restarted.embed_query("smoothies")
+
+    assert embeddings_mock.embed_query.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_aembed_query(embeddings_mock, tmp_path):
+    """Test that the async path shares the cache with the sync path."""
+    cache = CachedEmbeddings(embeddings_mock, model="model", path=str(tmp_path / "embeddings.sqlite"))
+
+    assert await cache.aembed_query("vegan") == [5.0, 0.5]
+    assert cache.embed_query("vegan") == [5.0, 0.5]
+    assert await cache.aembed_query("VEGAN") == [5.0, 0.5]
+
+    assert embeddings_mock.aembed_query.await_count == 1
+    assert embeddings_mock.embed_query.call_count == 0
+    assert cache.stats()["hits"] == 2
+
+
+def test_embed_documents_is_not_cached(embeddings_mock):
+    """Test that document embeddings are passed straight through."""
+    embeddings_mock.embed_documents = MagicMock(return_value=[[1.0], [2.0]])
+    cache = CachedEmbeddings(embeddings_mock, model="model")
+
+    assert cache.embed_documents(["a", "b"]) == [[1.0], [2.0]]
+    assert cache.stats()["size"] == 0
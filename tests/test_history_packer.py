@@ -0,0 +1,117 @@
+"""Tests for quartapp.approaches.history_packer module."""
+
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from quartapp.approaches.history_packer import (
+    HistoryPacker,
+    estimate_tokens,
+    format_message,
+    prefix_keys,
+    token_counter,
+)
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def _conversation(turns: int) -> list[dict]:
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"question {turn}"})
+        messages.append({"role": "assistant", "content": f"answer {turn}"})
+    return messages
+
+
+def test_format_message():
+    """Test that messages are compacted to role: content lines."""
+    assert format_message({"role": "assistant", "content": "We have tofu."}) == "assistant: We have tofu."
+    assert format_message({"content": "vegan dishes"}) == "user: vegan dishes"
+
+
+def test_prefix_keys_identify_prefixes():
+    """Test that prefix keys only depend on the messages up to that point."""
+    messages = _conversation(2)
+
+    assert prefix_keys(messages)[:2] == prefix_keys(messages[:2])
+    assert prefix_keys(messages)[1] != prefix_keys(_conversation(1)[::-1])[1]
+
+
+def test_pack_keeps_everything_within_budget():
+    """Test that a short history is kept whole, as plain text."""
+    packer = HistoryPacker(count_words, max_tokens=100)
+
+    packed = packer.pack(_conversation(2))
+
+    assert packed.text == "user: question 0\nassistant: answer 0\nuser: question 1\nassistant: answer 1"
+    assert (packed.kept, packed.dropped, packed.tokens) == (4, 0, 12)
+    assert packed.unpacked_tokens == count_words(str(_conversation(2)))
+
+
+def test_pack_keeps_the_most_recent_messages_within_budget():
+    """Test that the oldest messages are dropped to fit the token budget."""
+    packer = HistoryPacker(count_words, max_tokens=7)
+
+    packed = packer.pack(_conversation(3))
+
+    assert packed.text == "user: question 2\nassistant: answer 2"
+    assert (packed.kept, packed.dropped, packed.tokens) == (2, 4, 6)
+    assert packed.describe() == f"kept 2 of 6 messages, 6 tokens (saved {packed.unpacked_tokens - 6})"
+    stats = packer.stats()
+    assert stats["packs"] == 1
+    assert stats["dropped_messages"] == 4
+    assert stats["saved_tokens"] == packed.unpacked_tokens - 6
+
+
+def test_pack_empty_history():
+    """Test that an empty history packs to nothing."""
+    packed = HistoryPacker(count_words).pack([])
+
+    assert (packed.text, packed.tokens, packed.unpacked_tokens) == ("", 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_rolling_summary_replaces_dropped_messages(mock_runnable_or):
+    """Test that dropped messages are summarized in the background and the summary is used on later turns."""
+    mock_runnable_or.return_value.ainvoke = AsyncMock(return_value=MagicMock(content="likes tofu"))
+    packer = HistoryPacker(count_words, max_tokens=12, chat=MagicMock())
+
+    first = packer.pack(_conversation(3))
+    await asyncio.gather(*packer._summarizing.values())
+    second = packer.pack(_conversation(4))
+
+    assert first.summarized == 0
+    assert first.text == "user: question 1\nassistant: answer 1\nuser: question 2\nassistant: answer 2"
+    # The summary covers the first two messages, which makes room for only the last turn.
+    assert second.text == "summary of earlier messages: likes tofu\nuser: question 3\nassistant: answer 3"
+    assert (second.kept, second.summarized) == (2, 2)
+    assert mock_runnable_or.return_value.ainvoke.await_args.args[0] == {
+        "summary": "(none)",
+        "conversation": "user: question 0\nassistant: answer 0",
+    }
+    assert packer.stats()["summaries_created"] >= 1
+    assert packer.stats()["summaries_used"] == 1
+
+
+@pytest.mark.asyncio
+async def test_summary_failures_are_counted(mock_runnable_or):
+    """Test that a failed summary leaves the packed history unchanged."""
+    mock_runnable_or.return_value.ainvoke = AsyncMock(side_effect=RuntimeError("rate limited"))
+    packer = HistoryPacker(count_words, max_tokens=7, chat=MagicMock())
+
+    packer.pack(_conversation(3))
+    await asyncio.gather(*packer._summarizing.values())
+
+    assert packer.pack(_conversation(3)).summarized == 0
+    assert packer.stats()["summary_failures"] >= 1
+
+
+def test_token_counter_falls_back_to_an_estimate():
+    """Test that token counts are estimated when the tokenizer cannot be loaded."""
+    with patch("quartapp.approaches.history_packer.tiktoken.encoding_for_model", side_effect=OSError("offline")):
+        assert token_counter("offline-test-model") is estimate_tokens
+
+    assert estimate_tokens("12345678") == 2
@@ -0,0 +1,170 @@
+"""Tests for quartapp.approaches.history_writer module."""
+
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+from pymongo.errors import AutoReconnect
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.history_writer import HistoryMutation, HistoryWriter, merge_mutations
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)  # noqa: UP017
+
+
+class RecordingCollection:
+    """Stand-in for a pymongo Collection that records writes and can be held or made to fail."""
+
+    def __init__(self):
+        self.update_ones = []
+        self.bulk_writes = []
+        self.release = None
+        self.error = None
+
+    def _wait(self):
+        if self.release is not None:
+            self.release.wait()
+        if self.error is not None:
+            raise self.error
+
+    def update_one(self, filter, update, upsert=False):
+        self._wait()
+        self.update_ones.append((filter, update, upsert))
+
+    def bulk_write(self, requests, ordered=True):
+        self._wait()
+        self.bulk_writes.append((requests, ordered))
+
+
+def test_merge_mutations():
+    """Test that mutations fold into one upsert per session, keeping message order and timestamps."""
+    updates = merge_mutations(
+        [
+            HistoryMutation("a", [{"content": "q1"}, {"content": "a1"}], T0),
+            HistoryMutation("b", [{"content": "other"}], T0 + timedelta(seconds=1)),
+            HistoryMutation("a", [{"content": "q2"}, {"content": "a2"}], T0 + timedelta(seconds=2)),
+        ]
+    )
+
+    assert updates == [
+        (
+            {"_id": "a"},
+            {
+                "$push": {"messages": {"$each": [{"content": c} for c in ("q1", "a1", "q2", "a2")]}},
+                "$set": {"updated_at": T0 + timedelta(seconds=2)},
+                "$setOnInsert": {"created_at": T0},
+            },
+        ),
+        (
+            {"_id": "b"},
+            {
+                "$push": {"messages": {"$each": [{"content": "other"}]}},
+                "$set": {"updated_at": T0 + timedelta(seconds=1)},
+                "$setOnInsert": {"created_at": T0 + timedelta(seconds=1)},
+            },
+        ),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_inline_writes_create_then_append():
+    """Test that a writer that is not started upserts the session document right away."""
+    collection: mongomock.Collection = mongomock.MongoClient().db.Users
+    writer = HistoryWriter(AsyncCollection(collection))
+
+    await writer.enqueue(HistoryMutation("s", [{"content": "hi"}, {"content": "hello"}], T0))
+    await writer.enqueue(HistoryMutation("s", [{"content": "more"}], T0 + timedelta(seconds=5)))
+
+    document = collection.find_one({"_id": "s"})
+    assert document is not None
+    assert [message["content"] for message in document["messages"]] == ["hi", "hello", "more"]
+    assert document["created_at"].replace(tzinfo=timezone.utc) == T0  # noqa: UP017
+    assert document["updated_at"].replace(tzinfo=timezone.utc) == T0 + timedelta(seconds=5)  # noqa: UP017
+    assert writer.stats()["inline_writes"] == 2
+
+
+@pytest.mark.asyncio
+async def test_worker_batches_and_drains_on_stop():
+    """Test that queued mutations are flushed together in one bulk write and drained on stop."""
+    collection = RecordingCollection()
+    writer = HistoryWriter(AsyncCollection(collection), flush_interval_seconds=10)  # type: ignore[arg-type]
+    writer.start()
+
+    for session_id in ("a", "b", "a"):
+        await writer.enqueue(HistoryMutation(session_id, [{"content": session_id}], T0))
+    await writer.stop()
+
+    assert len(collection.bulk_writes) == 1
+    requests, ordered = collection.bulk_writes[0]
+    assert [request._filter for request in requests] == [{"_id": "a"}, {"_id": "b"}]
+    assert ordered is False
+    assert writer.stats() == {
+        "running": False,
+        "queued": 0,
+        "enqueued": 3,
+        "written": 3,
+        "batches": 1,
+        "failed": 0,
+        "inline_writes": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_worker_flushes_on_batch_size():
+    """Test that a full batch is flushed without waiting for the flush interval."""
+    collection = RecordingCollection()
+    writer = HistoryWriter(AsyncCollection(collection), max_batch_size=2, flush_interval_seconds=10)  # type: ignore[arg-type]
+    writer.start()
+
+    await writer.enqueue(HistoryMutation("a", [{"content": "1"}], T0))
+    await writer.enqueue(HistoryMutation("a", [{"content": "2"}], T0))
+    await asyncio.wait_for(writer._queue.join(), timeout=1)
+
+    assert collection.update_ones[0][1]["$push"] == {"messages": {"$each": [{"content": "1"}, {"content": "2"}]}}
+    assert collection.update_ones[0][2] is True
+    await writer.stop()
+
+
+@pytest.mark.asyncio
+async def test_full_queue_applies_backpressure():
+    """Test that enqueue waits while the queue is full."""
+    collection = RecordingCollection()
+    collection.release = threading.Event()
+    writer = HistoryWriter(AsyncCollection(collection), max_queue_size=1, max_batch_size=1)  # type: ignore[arg-type]
+    writer.start()
+
+    await writer.enqueue(HistoryMutation("a", [{"content": "1"}], T0))  # taken by the worker, which is held
+    await asyncio.sleep(0.01)
+    await writer.enqueue(HistoryMutation("a", [{"content": "2"}], T0))  # fills the queue
+    blocked = asyncio.create_task(writer.enqueue(HistoryMutation("a", [{"content": "3"}], T0)))
+    await asyncio.sleep(0.05)
+    assert not blocked.done()
+
+    collection.release.set()
+    await asyncio.wait_for(blocked, timeout=1)
+    await writer.stop()
+    assert [update[1]["$push"]["messages"]["$each"][0]["content"] for update in collection.update_ones] == [
+        "1",
+        "2",
+        "3",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_counted_and_worker_keeps_running():
+    """Test that a failed bulk write is logged and counted without stopping the worker."""
+    collection = RecordingCollection()
+    collection.error = AutoReconnect("connection reset")
+    writer = HistoryWriter(AsyncCollection(collection), flush_interval_seconds=0)  # type: ignore[arg-type]
+    writer.start()
+
+    await writer.enqueue(HistoryMutation("a", [{"content": "lost"}], T0))
+    await asyncio.wait_for(writer._queue.join(), timeout=1)
+    collection.error = None
+    await writer.enqueue(HistoryMutation("a", [{"content": "kept"}], T0))
+    await writer.stop()
+
+    assert writer.stats()["failed"] == 1
+    assert writer.stats()["written"] == 1
@@ -0,0 +1,372 @@
+"""Tests for quartapp.approaches.ingestion module."""
+
+import asyncio
+import io
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import httpx
+import mongomock
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from openai import RateLimitError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.ingestion import (
+    Checkpoint,
+    CheckpointMismatchError,
+    IngestionPipeline,
+    batched,
+    is_throttled,
+    iter_json_array,
+    read_documents,
+    stable_id,
+)
+
+
+def _rate_limit_error() -> RateLimitError:
+    response = httpx.Response(429, request=httpx.Request("POST", "https://example.com/embeddings"))
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+class FakeEmbeddings(Embeddings):
+    """Embeds each text as [len(text)], failing the first `throttle` calls and tracking concurrent calls."""
+
+    def __init__(self, throttle: int = 0):
+        self.calls: list[list[str]] = []
+        self.throttle = throttle
+        self.running = 0
+        self.max_running = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [float(len(text))]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.calls.append(texts)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            if self.throttle:
+                self.throttle -= 1
+                raise _rate_limit_error()
+            return self.embed_documents(texts)
+        finally:
+            self.running -= 1
+
+
+def _documents(count: int) -> list[Document]:
+    return [Document(page_content="x" * (i + 1), metadata={"seq_num": i + 1}) for i in range(count)]
+
+
+class BulkWriteCollection:
+    """mongomock collection that applies bulk writes one request at a time, which mongomock cannot do itself."""
+
+    def __init__(self):
+        self._collection: mongomock.Collection = mongomock.MongoClient().db.collection
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self._collection.update_one(request._filter, request._doc, upsert=request._upsert)
+
+
+@pytest.fixture
+def collection():
+    return BulkWriteCollection()
+
+
+def test_batched():
+    """Test that items are grouped lazily into batches of at most the given size."""
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
+
+
+def test_is_throttled():
+    """Test that rate limits from the embeddings API and the database are recognized."""
+    assert is_throttled(_rate_limit_error())
+    assert is_throttled(OperationFailure("throttled", code=16500))
+    assert not is_throttled(OperationFailure("bad query", code=2))
+    assert not is_throttled(ValueError("boom"))
+
+
+@pytest.mark.asyncio
+async def test_pipeline_embeds_and_inserts_in_batches(collection):
+    """Test that every document is embedded and written, with a bounded number of batches in flight."""
+    embeddings = FakeEmbeddings()
+    pipeline = IngestionPipeline(AsyncCollection(collection), embeddings, batch_size=3, concurrency=2)
+
+    stats = await pipeline.run(_documents(10))
+
+    assert [len(call) for call in embeddings.calls] == [3, 3, 3, 1]
+    assert embeddings.max_running == 2
+    assert stats.documents == 10
+    assert stats.batches == 4
+    assert stats.tokens == sum(-(-(i + 1) // 4) for i in range(10))
+    assert stats.inserted == 10
+    stored = sorted(collection.find({}, {"_id": 0, "contentHash": 0}), key=lambda record: record["metadata"]["seq_num"])
+    assert stored[0] == {"textContent": "x", "vectorContent": [1.0], "metadata": {"seq_num": 1}}
+    assert len(stored) == 10
+    assert pipeline.stats.snapshot()["docs_per_second"] > 0
+
+
+@pytest.mark.asyncio
+async def test_pipeline_retries_throttled_embeddings(collection):
+    """Test that throttled embeddings calls are retried with backoff."""
+    embeddings = FakeEmbeddings(throttle=2)
+    pipeline = IngestionPipeline(AsyncCollection(collection), embeddings, batch_size=5, backoff_base_seconds=0)
+
+    stats = await pipeline.run(_documents(5))
+
+    assert len(embeddings.calls) == 3
+    assert stats.throttled == 2
+    assert collection.count_documents({}) == 5
+
+
+@pytest.mark.asyncio
+async def test_pipeline_gives_up_after_max_retries(collection):
+    """Test that a call still throttled after the last retry fails the run."""
+    pipeline = IngestionPipeline(
+        AsyncCollection(collection), FakeEmbeddings(throttle=10), max_retries=2, backoff_base_seconds=0
+    )
+
+    with pytest.raises(RateLimitError):
+        await pipeline.run(_documents(1))
+    assert pipeline.stats.throttled == 2
+
+
+@pytest.mark.asyncio
+async def test_pipeline_retries_only_throttled_writes():
+    """Test that only the requests a partially throttled bulk write did not apply are sent again."""
+    async_collection = MagicMock()
+    async_collection.find = AsyncMock(return_value=[])
+    async_collection.delete_many = AsyncMock(return_value=MagicMock(deleted_count=0))
+    attempts: list[list[UpdateOne]] = []
+
+    async def bulk_write(requests, ordered=True):
+        attempts.append(list(requests))
+        if len(attempts) == 1:
+            raise BulkWriteError({"writeErrors": [{"index": 1, "code": 16500, "errmsg": "throttled"}]})
+
+    async_collection.bulk_write = bulk_write
+    pipeline = IngestionPipeline(async_collection, FakeEmbeddings(), backoff_base_seconds=0)
+
+    await pipeline.run(_documents(3))
+
+    assert [len(requests) for requests in attempts] == [3, 1]
+    retried = attempts[1][0]._doc
+    assert isinstance(retried, dict)
+    assert retried["$set"]["metadata"] == {"seq_num": 2}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_iter_json_array(chunk_size):
+    """Test that array items are parsed incrementally, whatever the chunk boundaries."""
+    items = [{"name": "Pad Thai", "price": 12.5, "tags": ["spicy", "]"]}, 1234567, [], "text", None]
+
+    assert list(iter_json_array(io.StringIO(json.dumps(items, indent=2)), chunk_size)) == items
+    assert list(iter_json_array(io.StringIO(" [ ] "), chunk_size)) == []
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize("text", ["[1.5]", "[1e5]", "[10.25, 2]", "[-0.5,1E-3]", "[ 123456 , 7.0e+2 ]"])
+def test_iter_json_array_numbers(text, chunk_size):
+    """Test that numbers split by a chunk boundary are parsed whole."""
+    assert list(iter_json_array(io.StringIO(text), chunk_size)) == json.loads(text)
+
+
+@pytest.mark.parametrize("text", ["", "{}", "[1 2]", "[1,]", "[1"])
+def test_iter_json_array_invalid(text):
+    """Test that anything but a complete top-level array is rejected."""
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text), 1))
+
+
+def test_iter_json_array_is_lazy():
+    """Test that items are yielded before the rest of the file is read."""
+    file = io.StringIO("[" + ",".join(['{"a": 1}'] * 1000) + "]")
+    items = iter_json_array(file, 16)
+
+    assert next(items) == {"a": 1}
+    assert file.tell() < 100
+
+
+def test_read_documents(tmp_path):
+    """Test that JSON arrays and JSON Lines files are read as numbered documents."""
+    array_file = tmp_path / "items.json"
+    array_file.write_text(json.dumps([{"name": "a"}, {"name": "b"}]))
+    lines_file = tmp_path / "items.jsonl"
+    lines_file.write_text('{"name": "a"}\n\n{"name": "b"}\n')
+
+    for path in (array_file, lines_file):
+        documents = list(read_documents(str(path)))
+        assert [document.page_content for document in documents] == ['{"name": "a"}', '{"name": "b"}']
+        assert documents[1].metadata == {"source": str(path), "seq_num": 2}
+        assert documents[1].id == stable_id({"name": "b"}, '{"name": "b"}')
+
+
+def test_read_documents_invalid_line(tmp_path):
+    """Test that an invalid JSON line reports its line number."""
+    lines_file = tmp_path / "items.jsonl"
+    lines_file.write_text('{"name": "a"}\n{"name": \n')
+
+    with pytest.raises(ValueError, match="line 2"):
+        list(read_documents(str(lines_file)))
+
+
+def test_stable_id():
+    """Test that menu items are identified by category and name, and anything else by its content."""
+    item = {"category": "Smoothies", "name": "Mango  Tango", "price": "5.49 USD"}
+
+    assert stable_id(item, json.dumps(item)) == "smoothies/mango tango"
+    assert stable_id({**item, "name": "mango tango", "price": "6.49 USD"}, "") == "smoothies/mango tango"
+    assert stable_id({"name": "no category"}, "a") == stable_id([1, 2], "a") != stable_id({"name": "x"}, "b")
+
+
+def _menu(**prices: str) -> list[Document]:
+    return [
+        Document(id=name, page_content=json.dumps({"name": name, "price": price}), metadata={"seq_num": idx + 1})
+        for idx, (name, price) in enumerate(prices.items())
+    ]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_reingestion_is_incremental(collection):
+    """Test that a rerun only embeds and writes new or changed items, and prunes removed ones when asked."""
+    embeddings = FakeEmbeddings()
+    pipeline = IngestionPipeline(AsyncCollection(collection), embeddings, batch_size=2)
+    await pipeline.run(_menu(soup="4", salad="5", tea="2"))
+    embeddings.calls.clear()
+
+    stats = await pipeline.run(_menu(soup="4", salad="6", cake="3"))
+
+    assert sorted(text for call in embeddings.calls for text in call) == [
+        '{"name": "cake", "price": "3"}',
+        '{"name": "salad", "price": "6"}',
+    ]
+    assert (stats.inserted, stats.updated, stats.skipped, stats.deleted) == (1, 1, 1, 0)
+    assert collection.count_documents({}) == 4
+    assert collection.find_one({"_id": "salad"})["textContent"] == '{"name": "salad", "price": "6"}'
+
+    stats = await pipeline.run(_menu(soup="4", salad="6", cake="3"), prune=True)
+
+    assert (stats.inserted, stats.updated, stats.skipped, stats.deleted) == (0, 0, 3, 1)
+    assert sorted(record["_id"] for record in collection.find({}, {"_id": 1})) == ["cake", "salad", "soup"]
+    assert stats.changed
+    assert not (await pipeline.run(_menu(soup="4", salad="6", cake="3"), prune=True)).changed
+
+
+@pytest.mark.asyncio
+async def test_pipeline_replaces_legacy_documents(collection):
+    """Test that documents stored without a content hash by earlier versions are replaced by their re-ingested copy."""
+    collection.insert_one({"textContent": '{"name": "soup", "price": "4"}', "vectorContent": [1.0], "metadata": {}})
+    collection.insert_one({"_id": "chat", "textContent": "no vector"})
+
+    stats = await IngestionPipeline(AsyncCollection(collection), FakeEmbeddings()).run(_menu(soup="4"))
+
+    assert (stats.inserted, stats.deleted) == (1, 1)
+    assert sorted(record["_id"] for record in collection.find({}, {"_id": 1})) == ["chat", "soup"]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_skips_duplicate_ids(collection):
+    """Test that only the first of several documents with the same id is ingested."""
+    documents = [*_menu(soup="4"), *_menu(soup="5")]
+
+    stats = await IngestionPipeline(AsyncCollection(collection), FakeEmbeddings()).run(documents)
+
+    assert (stats.inserted, stats.duplicates) == (1, 1)
+    assert collection.find_one({"_id": "soup"})["textContent"] == '{"name": "soup", "price": "4"}'
+
+
+FINGERPRINT = {"model": "text-embedding-3-small", "dimensions": 256, "source": "/data/items.json"}
+
+
+def test_checkpoint_save_and_resume(tmp_path):
+    """Test that a saved offset is resumed with the same fingerprint, and refused with another one."""
+    path = str(tmp_path / "items.checkpoint.json")
+    assert Checkpoint.resume(path, FINGERPRINT).offset == 0
+
+    Checkpoint(path, FINGERPRINT).save(128)
+
+    assert Checkpoint.resume(path, FINGERPRINT).offset == 128
+    with pytest.raises(CheckpointMismatchError, match="dimensions was 256, now 1536"):
+        Checkpoint.resume(path, {**FINGERPRINT, "dimensions": 1536})
+    with pytest.raises(CheckpointMismatchError, match="model"):
+        Checkpoint.resume(path, {**FINGERPRINT, "model": "text-embedding-3-large"})
+
+    Checkpoint(path, FINGERPRINT).remove()
+    assert not (tmp_path / "items.checkpoint.json").exists()
+
+
+class FailingEmbeddings(FakeEmbeddings):
+    """Fails (without throttling) on the given call."""
+
+    def __init__(self, fail_on_call: int):
+        super().__init__()
+        self.fail_on_call = fail_on_call
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        if len(self.calls) + 1 == self.fail_on_call:
+            self.calls.append(texts)
+            raise ConnectionError("network blip")
+        return await super().aembed_documents(texts)
+
+
+@pytest.mark.asyncio
+async def test_pipeline_resumes_from_checkpoint(collection, tmp_path):
+    """Test that a failed run saves its progress, and a resumed run only ingests the rest."""
+    path = str(tmp_path / "items.checkpoint.json")
+    documents = _documents(7)
+    failing = IngestionPipeline(
+        AsyncCollection(collection), FailingEmbeddings(fail_on_call=3), batch_size=2, concurrency=1
+    )
+
+    with pytest.raises(ConnectionError):
+        await failing.run(documents, checkpoint=Checkpoint(path, FINGERPRINT))
+
+    assert Checkpoint.resume(path, FINGERPRINT).offset == 4
+    embeddings = FakeEmbeddings()
+    resumed = IngestionPipeline(AsyncCollection(collection), embeddings, batch_size=2)
+
+    stats = await resumed.run(documents, prune=True, checkpoint=Checkpoint.resume(path, FINGERPRINT))
+
+    assert [len(call) for call in embeddings.calls] == [2, 1]
+    assert (stats.resumed, stats.inserted, stats.deleted) == (4, 3, 0)
+    assert collection.count_documents({}) == 7
+    assert not (tmp_path / "items.checkpoint.json").exists()
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_waits_for_earlier_batches(collection):
+    """Test that the offset only moves past a batch once every batch before it is written."""
+    release_first = asyncio.Event()
+
+    class SlowFirstBatch(FakeEmbeddings):
+        async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+            if not self.calls:
+                self.calls.append(texts)
+                await release_first.wait()
+                return [[1.0] for _ in texts]
+            return await super().aembed_documents(texts)
+
+    checkpoint = MagicMock(spec=Checkpoint, offset=0)
+    pipeline = IngestionPipeline(AsyncCollection(collection), SlowFirstBatch(), batch_size=2, concurrency=2)
+    run = asyncio.create_task(pipeline.run(_documents(4), checkpoint=checkpoint))
+
+    while pipeline.stats.batches < 1:
+        await asyncio.sleep(0.01)
+    checkpoint.save.assert_not_called()
+    release_first.set()
+    await run
+
+    checkpoint.save.assert_called_once_with(4)
+    checkpoint.remove.assert_called_once()
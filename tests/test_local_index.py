@@ -0,0 +1,150 @@
+"""Tests for quartapp.approaches.local_index module."""
+
+import asyncio
+
+import mongomock
+import pytest
+from pymongo.errors import OperationFailure
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.local_index import (
+    MISSING_SIMILARITY_INDEX_ERROR,
+    LocalVectorIndex,
+    is_missing_similarity_index_error,
+)
+
+
+def _item(_id: str, name: str, vector: list[float]) -> dict:
+    return {"_id": _id, "textContent": f'{{"name": "{name}"}}', "vectorContent": vector, "metadata": {"source": "menu"}}
+
+
+@pytest.fixture
+def collection():
+    collection: mongomock.Collection = mongomock.MongoClient().db.collection
+    collection.insert_many(
+        [
+            _item("1", "mango smoothie", [1.0, 0.0, 0.0]),
+            _item("2", "berry smoothie", [0.8, 0.6, 0.0]),
+            _item("3", "caesar salad", [0.0, 0.0, 2.0]),
+        ]
+    )
+    # Documents without an embedding (e.g. chat data in the same collection) are not indexed.
+    collection.insert_one({"_id": "4", "textContent": "no vector"})
+    return collection
+
+
+@pytest.fixture
+def local_index(collection):
+    return LocalVectorIndex(AsyncCollection(collection))
+
+
+def test_is_missing_similarity_index_error():
+    """Test the missing vector index error is recognized."""
+    assert is_missing_similarity_index_error(OperationFailure(MISSING_SIMILARITY_INDEX_ERROR, code=2))
+    assert not is_missing_similarity_index_error(OperationFailure(MISSING_SIMILARITY_INDEX_ERROR, code=8000))
+    assert not is_missing_similarity_index_error(OperationFailure("Something else", code=2))
+
+
+@pytest.mark.asyncio
+async def test_search_top_k(local_index):
+    """Test that search returns the top-k documents by cosine similarity, like the Cosmos COS index."""
+    await local_index.load()
+
+    results = local_index.search([2.0, 0.0, 0.0], k=2)
+
+    assert [document.metadata["_id"] for document, _ in results] == ["1", "2"]
+    assert [score for _, score in results] == pytest.approx([1.0, 0.8])
+    assert results[0][0].page_content == '{"name": "mango smoothie"}'
+    assert results[0][0].metadata == {"source": "menu", "_id": "1"}
+    assert local_index.stats()["documents"] == 3
+    assert local_index.stats()["dimensions"] == 3
+
+
+@pytest.mark.asyncio
+async def test_search_score_threshold_and_large_k(local_index):
+    """Test that k larger than the index returns everything above the threshold, best first."""
+    await local_index.load()
+
+    results = local_index.search([0.0, 0.0, 1.0], k=10, score_threshold=0.5)
+
+    assert [document.metadata["_id"] for document, _ in results] == ["3"]
+
+
+@pytest.mark.asyncio
+async def test_search_before_load(local_index):
+    """Test that an empty index returns no results."""
+    assert local_index.search([1.0, 0.0, 0.0], k=3) == []
+
+
+@pytest.mark.asyncio
+async def test_refresh_is_incremental(local_index, collection):
+    """Test that refresh picks up added and removed documents."""
+    await local_index.load()
+    collection.delete_one({"_id": "1"})
+    collection.insert_one(_item("5", "lemonade", [0.0, 1.0, 0.0]))
+
+    await local_index.refresh()
+
+    assert len(local_index) == 3
+    assert [document.metadata["_id"] for document, _ in local_index.search([0.0, 1.0, 0.0], k=1)] == ["5"]
+    assert "1" not in [document.metadata["_id"] for document, _ in local_index.search([1.0, 0.0, 0.0], k=3)]
+
+
+@pytest.mark.asyncio
+async def test_collection_above_max_documents_is_not_loaded(collection):
+    """Test that a collection larger than the limit is not loaded, and is unloaded when it grows past it."""
+    local_index = LocalVectorIndex(AsyncCollection(collection), max_documents=4)
+    await local_index.load()
+    assert (local_index.loaded, len(local_index)) == (True, 3)
+
+    collection.insert_one(_item("5", "lemonade", [0.0, 1.0, 0.0]))
+    await local_index.refresh()
+
+    assert (local_index.loaded, len(local_index)) == (False, 0)
+    assert local_index.search([1.0, 0.0, 0.0], k=1) == []
+    await local_index.load()
+    assert not local_index.loaded
+
+
+@pytest.mark.asyncio
+async def test_refresh_reloads_changed_documents(local_index, collection):
+    """Test that refresh fetches again the documents whose content hash changed, and only those."""
+    collection.update_many({}, {"$set": {"contentHash": "v1"}})
+    await local_index.load()
+    collection.update_one(
+        {"_id": "2"}, {"$set": {"textContent": '{"name": "kiwi smoothie"}', "vectorContent": [0.0, 1.0, 0.0]}}
+    )
+    await local_index.refresh()
+
+    assert local_index.search([0.0, 1.0, 0.0], k=1)[0][0].page_content == '{"name": "berry smoothie"}'
+
+    collection.update_one({"_id": "2"}, {"$set": {"contentHash": "v2"}})
+    await local_index.refresh()
+
+    assert len(local_index) == 3
+    document, score = local_index.search([0.0, 1.0, 0.0], k=1)[0]
+    assert (document.page_content, document.metadata["_id"], score) == ('{"name": "kiwi smoothie"}', "2", 1.0)
+
+
+@pytest.mark.asyncio
+async def test_refresh_loads_first(local_index):
+    """Test that the first refresh does a full load."""
+    await local_index.refresh()
+
+    assert local_index.loaded
+    assert len(local_index) == 3
+
+
+@pytest.mark.asyncio
+async def test_start_and_stop(local_index):
+    """Test that the background refresh loads the index and stops cleanly."""
+    local_index.start(interval_seconds=60)
+    for _ in range(100):
+        if local_index.loaded:
+            break
+        await asyncio.sleep(0.01)
+
+    await local_index.stop()
+
+    assert local_index.loaded
+    assert local_index._refresh_task is None
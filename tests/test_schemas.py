@@ -7,6 +7,8 @@ from quartapp.approaches.schemas import (
     Message,
     RetrievalResponse,
     RetrievalResponseDelta,
+    StageEvent,
+    StreamStage,
     Thought,
 )
 
@@ -107,6 +109,20 @@ def test_retrieval_response_delta_to_dict_full():
     assert result["delta"]["content"] == "test message"  # type: ignore[index]
 
 
+def test_retrieval_response_delta_to_dict_with_stage():
+    """Test that RetrievalResponseDelta only includes the stage when it is set."""
+
+    delta = RetrievalResponseDelta(stage=StageEvent(StreamStage.REPHRASED, 12.5, "vegan dishes"))
+
+    assert delta.to_dict() == {
+        "context": None,
+        "delta": None,
+        "sessionState": None,
+        "stage": {"name": "rephrased", "elapsed_ms": 12.5, "detail": "vegan dishes"},
+    }
+    assert "stage" not in RetrievalResponseDelta(delta=Message(content="hi")).to_dict()
+
+
 def test_message_default_role():
     """Test Message default role assignment."""
     message = Message(content="test")
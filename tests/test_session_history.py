@@ -0,0 +1,68 @@
+"""Tests for quartapp.approaches.session_history module."""
+
+import mongomock
+import pytest
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.session_history import SessionHistory
+
+
+def _messages(*contents: str) -> list[dict]:
+    return [{"content": content, "role": "user"} for content in contents]
+
+
+@pytest.fixture
+def users_collection():
+    collection: mongomock.Collection = mongomock.MongoClient().db.Users
+    collection.insert_one({"_id": "stored", "messages": _messages("q1", "a1", "q2", "a2")})
+    return collection
+
+
+@pytest.mark.asyncio
+async def test_get_reads_through_and_caches(users_collection):
+    """Test that a session is read from the collection once and then served from memory."""
+    session_history = SessionHistory(AsyncCollection(users_collection))
+
+    assert await session_history.get("stored") == _messages("q1", "a1", "q2", "a2")
+    users_collection.delete_one({"_id": "stored"})
+    assert await session_history.get("stored") == _messages("q1", "a1", "q2", "a2")
+    assert await session_history.get("unknown") == []
+    assert session_history.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3, "sessions": 2, "max_sessions": 1024}
+
+
+@pytest.mark.asyncio
+async def test_get_keeps_the_newest_messages(users_collection):
+    """Test that only the last max_messages messages are read and kept."""
+    session_history = SessionHistory(AsyncCollection(users_collection), max_messages=3)
+
+    assert await session_history.get("stored") == _messages("a1", "q2", "a2")
+    session_history.append("stored", _messages("q3", "a3"), new_session=False)
+    assert await session_history.get("stored") == _messages("a2", "q3", "a3")
+
+
+@pytest.mark.asyncio
+async def test_append(users_collection):
+    """Test that new sessions are cached, follow-ups extend cached sessions and uncached follow-ups are skipped."""
+    session_history = SessionHistory(AsyncCollection(users_collection))
+
+    session_history.append("new", _messages("q1", "a1"), new_session=True)
+    session_history.append("new", _messages("q2", "a2"), new_session=False)
+    session_history.append("stored", _messages("q3", "a3"), new_session=False)
+
+    assert await session_history.get("new") == _messages("q1", "a1", "q2", "a2")
+    # Not cached when the follow-up was appended, so the collection is the source of truth.
+    assert await session_history.get("stored") == _messages("q1", "a1", "q2", "a2")
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_session_is_evicted(users_collection):
+    """Test that the cache holds at most max_sessions conversations."""
+    session_history = SessionHistory(AsyncCollection(users_collection), max_sessions=2)
+
+    session_history.append("a", _messages("a"), new_session=True)
+    session_history.append("b", _messages("b"), new_session=True)
+    await session_history.get("a")
+    session_history.append("c", _messages("c"), new_session=True)
+
+    assert await session_history.get("b") == []
+    assert session_history.stats()["misses"] == 1
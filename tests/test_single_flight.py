@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from quartapp.approaches.single_flight import SingleFlight, normalize_messages
+
+
+def test_normalize_messages():
+    """Test that messages differing only in case and whitespace normalize to the same key."""
+    assert normalize_messages([{"role": "user", "content": "  What's today's   SPECIAL?"}]) == normalize_messages(
+        [{"role": "user", "content": "what's today's special?"}]
+    )
+    assert normalize_messages([{"content": "special"}]) == (("user", "special"),)
+    assert normalize_messages([{"role": "assistant", "content": "a"}]) != normalize_messages([{"content": "a"}])
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_concurrent_calls():
+    """Test that concurrent calls with the same key share one computation."""
+    single_flight = SingleFlight()
+    release = asyncio.Event()
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await release.wait()
+        return value
+
+    waiters = [asyncio.create_task(single_flight.do("a", lambda: compute("a"))) for _ in range(3)]
+    other = asyncio.create_task(single_flight.do("b", lambda: compute("b")))
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.gather(*waiters, other) == ["a", "a", "a", "b"]
+    assert calls == ["a", "b"]
+    assert single_flight.stats() == {"started": 2, "shared": 2, "shared_rate": 0.5, "in_flight": 0}
+
+    # Once a computation is done, the next call starts a new one.
+    assert await single_flight.do("a", lambda: compute("a")) == "a"
+    assert calls == ["a", "b", "a"]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_errors():
+    """Test that every waiter gets the error of the shared computation."""
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("search failed")
+
+    results = await asyncio.gather(single_flight.do("a", fail), single_flight.do("a", fail), return_exceptions=True)
+
+    assert [str(result) for result in results] == ["search failed", "search failed"]
+    assert single_flight.stats()["started"] == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancelled_caller():
+    """Test that cancelling one caller does not cancel the computation shared with the others."""
+    single_flight = SingleFlight()
+    release = asyncio.Event()
+
+    async def compute():
+        await release.wait()
+        return "done"
+
+    first = asyncio.create_task(single_flight.do("a", compute))
+    second = asyncio.create_task(single_flight.do("a", compute))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await second == "done"
+    assert first.cancelled()
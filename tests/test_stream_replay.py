@@ -0,0 +1,116 @@
+import asyncio
+import time
+from collections.abc import AsyncGenerator
+
+import pytest
+
+from quartapp.approaches.stream_replay import ReplayGapError, ReplayStream, StreamReplay
+
+
+async def _lines(*lines: str, wait: asyncio.Event | None = None) -> AsyncGenerator[str, None]:
+    for line in lines:
+        if wait is not None:
+            await wait.wait()
+        yield line
+
+
+async def _follow(stream: ReplayStream, after: int = 0) -> list[tuple[int, str]]:
+    return [event async for event in stream.follow(after)]
+
+
+@pytest.mark.asyncio
+async def test_stream_replay_follow_and_resume():
+    """Test that readers get every event, and can resume after the last one they received."""
+    replay = StreamReplay()
+    stream = replay.start("s", _lines("a", "b", "c"))
+
+    assert await _follow(stream) == [(1, "a"), (2, "b"), (3, "c")]
+    resumed = replay.resume("s")
+    assert resumed is stream
+    assert await _follow(resumed, 1) == [(2, "b"), (3, "c")]
+    assert replay.resume("unknown") is None
+    assert replay.stats()["resumed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_replay_follows_live_events():
+    """Test that a reader waits for events that are not produced yet."""
+    produce = asyncio.Event()
+    stream = StreamReplay().start("s", _lines("a", "b", wait=produce))
+    reader = asyncio.create_task(_follow(stream))
+
+    await asyncio.sleep(0)
+    assert not reader.done()
+    produce.set()
+
+    assert await asyncio.wait_for(reader, timeout=1) == [(1, "a"), (2, "b")]
+
+
+@pytest.mark.asyncio
+async def test_stream_replay_gap():
+    """Test that resuming after events that were dropped from the ring buffer fails."""
+    stream = StreamReplay(max_events=2).start("s", _lines("a", "b", "c"))
+    assert stream.producer is not None
+    await stream.producer
+
+    assert await _follow(stream, 1) == [(2, "b"), (3, "c")]
+    assert not stream.can_resume(0)
+    with pytest.raises(ReplayGapError):
+        await _follow(stream, 0)
+
+
+@pytest.mark.asyncio
+async def test_stream_replay_new_answer_cancels_previous():
+    """Test that a new answer in a session replaces the one still being produced."""
+    closed = asyncio.Event()
+
+    async def never_ending() -> AsyncGenerator[str, None]:
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        finally:
+            closed.set()
+
+    replay = StreamReplay()
+    first = replay.start("s", never_ending())
+    await asyncio.sleep(0)
+    second = replay.start("s", _lines("c"))
+
+    await asyncio.wait_for(closed.wait(), timeout=1)
+    assert await _follow(first) == [(1, "a")]
+    assert await _follow(second) == [(1, "c")]
+    assert replay.resume("s") is second
+
+
+@pytest.mark.asyncio
+async def test_stream_replay_bounded():
+    """Test that the oldest streams are evicted, and finished ones expire."""
+    replay = StreamReplay(max_streams=2, ttl_seconds=60)
+    for key in ("a", "b", "c"):
+        producer = replay.start(key, _lines("x")).producer
+        assert producer is not None
+        await producer
+
+    assert replay.resume("a") is None
+    assert replay.stats()["evicted"] == 1
+
+    stream = replay.resume("b")
+    assert stream is not None
+    stream.updated_at = time.monotonic() - 61
+    assert replay.resume("b") is None
+    assert replay.stats()["expired"] == 1
+    assert replay.stats()["streams"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_replay_close():
+    """Test that closing the replay buffers cancels the answers still being produced."""
+    replay = StreamReplay()
+    stream = replay.start("s", _lines("a", wait=asyncio.Event()))
+    await asyncio.sleep(0)
+
+    await replay.close()
+
+    assert stream.finished
+    assert replay.stats()["streams"] == 0
@@ -2,14 +2,23 @@
 
 from unittest.mock import MagicMock, patch
 
+import mongomock
 import pytest
+from langchain_community.vectorstores.azure_cosmos_db import CosmosDBVectorSearchType
+from langchain_core.documents import Document
 from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings, ChatOpenAI, OpenAIEmbeddings
 from pydantic import SecretStr
+from pymongo import monitoring
 from pymongo.errors import ServerSelectionTimeoutError
 
 from quartapp.approaches.utils import (
+    ConnectionPoolStats,
+    ProjectedVectorSearch,
+    bump_data_version,
     chat_api,
+    cosine_similarity,
     embeddings_api,
+    mongo_client_api,
     setup_data_collection,
     setup_users_collection,
     vector_store_api,
@@ -183,69 +192,156 @@ def test_chat_api_ollama_custom_endpoint():
 
 
 def test_vector_store_api():
-    """Test vector_store_api function."""
+    """Test vector_store_api builds the store on the shared client."""
     mock_embedding = MagicMock()
+    mock_client = MagicMock()
 
-    with patch("quartapp.approaches.utils.AzureCosmosDBVectorSearch.from_connection_string") as mock_vector_store:
-        mock_vector_store.return_value = MagicMock()
-
-        vector_store_api(connection_string="test-connection", namespace="test-namespace", embedding=mock_embedding)
+    with patch("quartapp.approaches.utils.ProjectedVectorSearch") as mock_vector_store:
+        vector_store_api(mongo_client=mock_client, namespace="test-db.test-collection", embedding=mock_embedding)
 
+        mock_client.__getitem__.assert_called_once_with("test-db")
+        mock_client.__getitem__.return_value.__getitem__.assert_called_once_with("test-collection")
         mock_vector_store.assert_called_once_with(
-            connection_string="test-connection", namespace="test-namespace", embedding=mock_embedding
+            collection=mock_client.__getitem__.return_value.__getitem__.return_value, embedding=mock_embedding
         )
 
 
+@pytest.mark.parametrize(
+    "kind",
+    [
+        CosmosDBVectorSearchType.VECTOR_IVF,
+        CosmosDBVectorSearchType.VECTOR_HNSW,
+        CosmosDBVectorSearchType.VECTOR_DISKANN,
+    ],
+)
+def test_projected_vector_search(kind):
+    """Test that vector search pipelines leave the embedding out and still parse into documents."""
+    mock_collection = MagicMock()
+    mock_collection.aggregate.return_value = [
+        {"similarityScore": 0.9, "document": {"_id": "1", "textContent": "mango", "metadata": {"source": "menu"}}}
+    ]
+    vector_store = ProjectedVectorSearch(collection=mock_collection, embedding=MagicMock())
+
+    results = vector_store._similarity_search_with_score([1.0, 0.0], k=3, kind=kind)
+
+    pipeline = mock_collection.aggregate.call_args.args[0]
+    assert pipeline[-1]["$project"] == {
+        "similarityScore": {"$meta": "searchScore"},
+        "document": {"_id": "$_id", "textContent": "$textContent", "metadata": "$metadata"},
+    }
+    assert "$$ROOT" not in str(pipeline)
+    assert results == [(Document(page_content="mango", metadata={"source": "menu", "_id": "1"}), 0.9)]
+
+
+def test_mongo_client_api():
+    """Test mongo_client_api forwards the pool settings and listener."""
+    pool_stats = ConnectionPoolStats()
+    with patch("quartapp.approaches.utils.MongoClient") as mock_mongo_client:
+        mongo_client_api(
+            connection_string="test-connection",
+            max_pool_size=10,
+            max_idle_time_ms=30000,
+            server_selection_timeout_ms=2000,
+            pool_stats=pool_stats,
+        )
+
+        mock_mongo_client.assert_called_once_with(
+            "test-connection",
+            maxPoolSize=10,
+            maxIdleTimeMS=30000,
+            serverSelectionTimeoutMS=2000,
+            event_listeners=[pool_stats],
+        )
+
+
+def test_connection_pool_stats():
+    """Test ConnectionPoolStats counts connections over all servers, without their addresses."""
+    pool_stats = ConnectionPoolStats()
+    address = ("localhost", 27017)
+
+    pool_stats.connection_created(monitoring.ConnectionCreatedEvent(address, 1))
+    pool_stats.connection_created(monitoring.ConnectionCreatedEvent(address, 2))
+    pool_stats.connection_checked_out(monitoring.ConnectionCheckedOutEvent(address, 1, None))
+    pool_stats.connection_checked_out(monitoring.ConnectionCheckedOutEvent(address, 2, None))
+    pool_stats.connection_checked_in(monitoring.ConnectionCheckedInEvent(address, 2))
+    pool_stats.connection_closed(monitoring.ConnectionClosedEvent(address, 2, "idle"))
+    pool_stats.connection_check_out_failed(monitoring.ConnectionCheckOutFailedEvent(address, "timeout", None))
+
+    assert pool_stats.snapshot() == {
+        "servers": 1,
+        "open": 1,
+        "in_use": 1,
+        "created": 2,
+        "closed": 1,
+        "checkout_failures": 1,
+        "cleared": 0,
+    }
+
+
+def test_cosine_similarity():
+    """Test cosine similarity between embeddings."""
+    assert cosine_similarity([1.0, 0.0], [2.0, 0.0]) == pytest.approx(1.0)
+    assert cosine_similarity([1.0, 0.0], [0.0, 3.0]) == pytest.approx(0.0)
+    assert cosine_similarity([1.0, 1.0], [-1.0, -1.0]) == pytest.approx(-1.0)
+    assert cosine_similarity([0.0, 0.0], [1.0, 0.0]) == 0.0
+
+
 def test_setup_users_collection():
     """Test setup_users_collection function."""
-    with patch("quartapp.approaches.utils.MongoClient") as mock_mongo_client:
-        mock_client_instance = MagicMock()
-        mock_mongo_client.return_value = mock_client_instance
-        mock_db = MagicMock()
-        mock_client_instance.__getitem__.return_value = mock_db
-        mock_collection = MagicMock()
-        mock_db.__getitem__.return_value = mock_collection
+    mock_client_instance = MagicMock()
+    mock_db = MagicMock()
+    mock_client_instance.__getitem__.return_value = mock_db
+    mock_collection = MagicMock()
+    mock_db.__getitem__.return_value = mock_collection
+
+    result = setup_users_collection(mongo_client=mock_client_instance, database_name="test-db")
+
+    mock_client_instance.__getitem__.assert_called_once_with("test-db")
+    mock_db.__getitem__.assert_called_once_with("Users")
+    assert result.collection == mock_collection
 
-        result = setup_users_collection(connection_string="test-connection", database_name="test-db")
 
-        mock_mongo_client.assert_called_once_with("test-connection")
-        mock_client_instance.__getitem__.assert_called_once_with("test-db")
-        mock_db.__getitem__.assert_called_once_with("Users")
-        assert result == mock_collection
+def test_bump_data_version():
+    """Test that the data version of a collection is created and then incremented."""
+    metadata_collection: mongomock.Collection = mongomock.MongoClient().db.Metadata
+
+    bump_data_version(metadata_collection, "menu")
+    bump_data_version(metadata_collection, "menu")
+
+    metadata = metadata_collection.find_one({"_id": "menu"})
+    assert metadata is not None
+    assert metadata["data_version"] == 2
 
 
 def test_setup_data_collection_success():
     """Test setup_data_collection function with successful connection."""
-    with patch("quartapp.approaches.utils.MongoClient") as mock_mongo_client:
-        mock_client_instance = MagicMock()
-        mock_mongo_client.return_value = mock_client_instance
-        mock_db = MagicMock()
-        mock_client_instance.__getitem__.return_value = mock_db
-        mock_collection = MagicMock()
-        mock_db.__getitem__.return_value = mock_collection
-
-        result = setup_data_collection(
-            connection_string="test-connection", database_name="test-db", collection_name="test-collection"
-        )
+    mock_client_instance = MagicMock()
+    mock_db = MagicMock()
+    mock_client_instance.__getitem__.return_value = mock_db
+    mock_collection = MagicMock()
+    mock_db.__getitem__.return_value = mock_collection
+
+    result = setup_data_collection(
+        mongo_client=mock_client_instance, database_name="test-db", collection_name="test-collection"
+    )
 
-        mock_mongo_client.assert_called_once_with("test-connection", serverSelectionTimeoutMS=1000)
-        mock_client_instance.__getitem__.assert_called_once_with("test-db")
-        mock_db.__getitem__.assert_called_once_with("test-collection")
-        mock_collection.create_index.assert_called_once_with({"textContent": "text"}, name="search_text_index")
-        assert result == mock_collection
+    mock_client_instance.__getitem__.assert_called_once_with("test-db")
+    mock_db.__getitem__.assert_called_once_with("test-collection")
+    mock_collection.create_index.assert_called_once_with({"textContent": "text"}, name="search_text_index")
+    assert result.collection == mock_collection
 
 
 def test_setup_data_collection_timeout_error():
     """Test setup_data_collection function with ServerSelectionTimeoutError."""
-    with patch("quartapp.approaches.utils.MongoClient") as mock_mongo_client:
-        mock_mongo_client.side_effect = ServerSelectionTimeoutError("Timeout")
-
-        with pytest.raises(ServerSelectionTimeoutError):
-            setup_data_collection(
-                connection_string="test-connection", database_name="test-db", collection_name="test-collection"
-            )
+    mock_client_instance = MagicMock()
+    mock_client_instance.__getitem__.return_value.__getitem__.return_value.create_index.side_effect = (
+        ServerSelectionTimeoutError("Timeout")
+    )
 
-        mock_mongo_client.assert_called_once_with("test-connection", serverSelectionTimeoutMS=1000)
+    with pytest.raises(ServerSelectionTimeoutError):
+        setup_data_collection(
+            mongo_client=mock_client_instance, database_name="test-db", collection_name="test-collection"
+        )
 
 
 def test_embeddings_api_unsupported_host():
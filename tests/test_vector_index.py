@@ -0,0 +1,137 @@
+"""Tests for quartapp.approaches.vector_index module."""
+
+from argparse import ArgumentParser
+from unittest.mock import AsyncMock, MagicMock
+
+import mongomock
+import pytest
+from langchain_community.vectorstores.azure_cosmos_db import CosmosDBVectorSearchType
+from pymongo.errors import PyMongoError
+
+from quartapp.approaches.async_collection import AsyncCollection
+from quartapp.approaches.vector_index import (
+    RecordedVectorIndex,
+    VectorIndexParams,
+    add_index_arguments,
+    choose_index_params,
+    ensure_vector_index,
+    index_params_from_args,
+    recorded_index,
+    stored_dimensions,
+)
+
+
+@pytest.mark.parametrize(
+    ("document_count", "kind", "num_lists"),
+    [
+        (151, CosmosDBVectorSearchType.VECTOR_IVF, 1),
+        (20_000, CosmosDBVectorSearchType.VECTOR_IVF, 20),
+        (500_000, CosmosDBVectorSearchType.VECTOR_HNSW, 500),
+        (4_000_000, CosmosDBVectorSearchType.VECTOR_IVF, 2000),
+    ],
+)
+def test_choose_index_params(document_count, kind, num_lists):
+    """Test that the index kind and number of lists follow the collection size."""
+    params = choose_index_params(document_count, 256)
+
+    assert (params.kind, params.num_lists, params.dimensions) == (kind, num_lists, 256)
+
+
+def test_choose_index_params_overrides():
+    """Test that explicit options win over the ones chosen from the size, and invalid HNSW options are refused."""
+    params = choose_index_params(151, 256, kind=CosmosDBVectorSearchType.VECTOR_HNSW, m=32, ef_construction=128)
+
+    assert params.to_dict() == {
+        "kind": "vector-hnsw",
+        "dimensions": 256,
+        "similarity": "COS",
+        "m": 32,
+        "ef_construction": 128,
+    }
+    assert choose_index_params(151, 256, num_lists=12).to_dict()["num_lists"] == 12
+    with pytest.raises(ValueError, match="ef_construction"):
+        choose_index_params(151, 256, kind=CosmosDBVectorSearchType.VECTOR_HNSW, m=64)
+
+
+def test_index_params_from_args():
+    """Test that the command line options are mapped to index options."""
+    parser = ArgumentParser()
+    add_index_arguments(parser)
+
+    assert index_params_from_args(parser.parse_args([]), 151, 256).kind == CosmosDBVectorSearchType.VECTOR_IVF
+    params = index_params_from_args(parser.parse_args(["--index-kind", "diskann"]), 151, 256)
+    assert params.to_dict() == {
+        "kind": "vector-diskann",
+        "dimensions": 256,
+        "similarity": "COS",
+        "max_degree": 32,
+        "l_build": 50,
+    }
+
+
+def test_stored_dimensions():
+    """Test that the dimensions are read from a stored embedding."""
+    collection: mongomock.Collection = mongomock.MongoClient().db.collection
+    assert stored_dimensions(collection) is None
+
+    collection.insert_one({"_id": "a", "textContent": "a", "vectorContent": [0.1, 0.2, 0.3]})
+
+    assert stored_dimensions(collection) == 3
+
+
+def test_ensure_vector_index():
+    """Test that the index is only rebuilt when its options change, and the options are recorded."""
+    metadata_collection: mongomock.Collection = mongomock.MongoClient().db.Metadata
+    vector_store = MagicMock()
+    vector_store.index_exists.return_value = False
+    small = VectorIndexParams(kind=CosmosDBVectorSearchType.VECTOR_IVF, dimensions=256)
+
+    assert ensure_vector_index(vector_store, metadata_collection, "collection", small, 151)
+
+    vector_store.delete_index.assert_not_called()
+    assert vector_store.create_index.call_args.kwargs["num_lists"] == 1
+    recorded = recorded_index(metadata_collection, "collection")
+    assert recorded is not None
+    assert (recorded["params"], recorded["document_count"]) == (small.to_dict(), 151)
+
+    vector_store.index_exists.return_value = True
+    assert not ensure_vector_index(vector_store, metadata_collection, "collection", small, 160)
+    assert vector_store.create_index.call_count == 1
+
+    larger = choose_index_params(20_000, 256)
+    assert ensure_vector_index(vector_store, metadata_collection, "collection", larger, 20_000)
+    vector_store.delete_index.assert_called_once()
+    recorded = recorded_index(metadata_collection, "collection")
+    assert recorded is not None
+    assert recorded["params"]["num_lists"] == 20
+
+    assert ensure_vector_index(vector_store, metadata_collection, "collection", larger, 20_000, rebuild=True)
+    assert vector_store.create_index.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_recorded_vector_index_search_options():
+    """Test that queries use the kind of the recorded index, IVF until one is recorded, with efSearch at least k."""
+    metadata_collection: mongomock.Collection = mongomock.MongoClient().db.Metadata
+    vector_index = RecordedVectorIndex(AsyncCollection(metadata_collection), "collection", poll_seconds=0)
+
+    assert await vector_index.search_options(3) == {"kind": CosmosDBVectorSearchType.VECTOR_IVF, "ef_search": 40}
+
+    hnsw = choose_index_params(500_000, 256)
+    ensure_vector_index(MagicMock(), metadata_collection, "collection", hnsw, 500_000)
+
+    assert await vector_index.search_options(3) == {"kind": CosmosDBVectorSearchType.VECTOR_HNSW, "ef_search": 40}
+    assert (await vector_index.search_options(100))["ef_search"] == 100
+
+
+@pytest.mark.asyncio
+async def test_recorded_vector_index_keeps_kind_when_unreadable():
+    """Test that the last known kind is kept while the metadata cannot be read."""
+    metadata_collection = MagicMock()
+    metadata_collection.find_one = AsyncMock(return_value={"vector_index": {"params": {"kind": "vector-hnsw"}}})
+    vector_index = RecordedVectorIndex(metadata_collection, "collection", ef_search=64, poll_seconds=0)
+    assert await vector_index.search_options(3) == {"kind": CosmosDBVectorSearchType.VECTOR_HNSW, "ef_search": 64}
+
+    metadata_collection.find_one = AsyncMock(side_effect=PyMongoError("unreachable"))
+
+    assert (await vector_index.search_options(3))["kind"] == CosmosDBVectorSearchType.VECTOR_HNSW